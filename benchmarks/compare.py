@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""
+Compare two result files of run.py.
+
+The records of both runs are matched by benchmark and configuration. For every measurement the relative change
+from the baseline is printed, with the sign flipped for latencies and memory so that a negative change always
+is a regression. Exits with status 1 if any regression exceeds --threshold.
+
+    python benchmarks/compare.py baseline.json results.json --threshold 0.1
+"""
+
+import argparse
+import json
+import sys
+
+
+# measurements where lower values are better, all others are throughputs
+LOWER_IS_BETTER = ('latency_ms', 'stage_ms_per_sample', 'peak_rss')
+CONFIGURATION = ('benchmark', 'classes', 'objects', 'workers')
+
+
+def _key(record):
+    return tuple(record.get(name) for name in CONFIGURATION)
+
+
+def compare(baseline, results):
+    """ Relative change of every measurement of results over baseline.
+
+    Returns
+        List of (configuration, measurement, baseline value, value, improvement) tuples, improvement is the relative
+        change, positive if results is better than baseline.
+    """
+    baseline_records = {_key(record): record for record in baseline['results']}
+    changes = []
+    for record in results['results']:
+        reference = baseline_records.get(_key(record))
+        if reference is None:
+            continue
+        for name, value in record.items():
+            if name in CONFIGURATION or not isinstance(value, (int, float)) or not isinstance(reference.get(name), (int, float)):
+                continue
+            if reference[name] == 0:
+                continue
+            if name.startswith(LOWER_IS_BETTER):
+                change = (reference[name] - value) / reference[name]
+            else:
+                change = (value - reference[name]) / reference[name]
+            changes.append((_key(record), name, reference[name], value, change))
+    return changes
+
+
+def parse_args(args):
+    """ Parse the arguments.
+    """
+    parser     = argparse.ArgumentParser(description='Compare two benchmark runs.')
+
+    parser.add_argument('baseline',           help='Results of the baseline run.')
+    parser.add_argument('results',            help='Results of the run to compare.')
+    parser.add_argument('--threshold',        help='Relative regression that fails the comparison.', type=float, default=0.1)
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    # parse arguments
+    if args is None:
+        args = sys.argv[1:]
+    args = parse_args(args)
+
+    with open(args.baseline) as js:
+        baseline = json.load(js)
+    with open(args.results) as js:
+        results = json.load(js)
+
+    if baseline['environment'].get('platform') != results['environment'].get('platform') or \
+            baseline['environment'].get('cpu_count') != results['environment'].get('cpu_count'):
+        print('Warning: the runs were made on different machines.')
+
+    regressions = 0
+    for key, name, reference, value, change in compare(baseline, results):
+        configuration = ' '.join('{}={}'.format(field, entry) for field, entry in zip(CONFIGURATION, key) if entry is not None)
+        regression = change < -args.threshold
+        regressions += regression
+        print('{:<60} {:<40} {:12.3f} {:12.3f} {:+8.1%}{}'.format(configuration, name, reference, value, change, '  REGRESSION' if regression else ''))
+
+    if regressions:
+        print('{} measurements regressed by more than {:.0%}.'.format(regressions, args.threshold))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""
+Throughput benchmarks of COPE on a synthetic dataset.
+
+For every class count a synthetic dataset is written to a temporary directory and the selected benchmarks of
+suite.py are run, each in its own process. The results are written as JSON, one record per benchmark and
+configuration with its measurements and the peak RSS of its process, together with the environment and the
+arguments of the run. Compare two runs with compare.py.
+
+    python benchmarks/run.py --classes 1,15,30 --output results.json
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import queue
+import resource
+import subprocess
+import sys
+import tempfile
+import traceback
+
+# Allow relative imports when being executed as script, also when spawned benchmark processes re-run it as __mp_main__.
+if __name__ in ("__main__", "__mp_main__") and not __package__:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+    import benchmarks  # noqa: F401
+    __package__ = "benchmarks"
+
+from . import suite
+from .synthetic_dataset import make_dataset
+
+
+BENCHMARKS = ['generator', 'anchor_targets', 'train_step', 'inference', 'filter_detections']
+
+
+def _peak_rss_mb(who=resource.RUSAGE_SELF):
+    """ Peak resident set size of this process or of the largest of its terminated children in MB.
+    """
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    scale = 1.0 / 1024.0 if sys.platform != 'darwin' else 1.0 / (1024.0 * 1024.0)
+    return resource.getrusage(who).ru_maxrss * scale
+
+
+def _run_benchmark(name, kwargs, results):
+    try:
+        import tensorflow as tf
+        tf.random.set_seed(0)
+        record = getattr(suite, name)(**kwargs)
+        record['peak_rss_mb'] = _peak_rss_mb()
+        if kwargs.get('workers'):
+            record['peak_rss_workers_mb'] = _peak_rss_mb(resource.RUSAGE_CHILDREN)
+        results.put(record)
+    except Exception:
+        results.put({'error': traceback.format_exc()})
+
+
+def run_isolated(name, poll_seconds=5.0, **kwargs):
+    """ Run the benchmark name of suite.py in a new process, returns its measurements.
+
+    A process that dies without a result, e.g. from a segfault or the OOM killer, gives an error record.
+    """
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    process = ctx.Process(target=_run_benchmark, args=(name, kwargs, results))
+    process.start()
+    try:
+        while True:
+            try:
+                return results.get(timeout=poll_seconds)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+            # a record put right before the process exited may still be in flight
+            try:
+                return results.get(timeout=1.0)
+            except queue.Empty:
+                return {'error': 'Benchmark process exited with code {} without a result.'.format(process.exitcode)}
+    finally:
+        process.join()
+
+
+def environment():
+    """ Description of the machine and the software the benchmarks ran with.
+    """
+    import numpy as np
+    import tensorflow as tf
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'tensorflow': tf.__version__,
+            'gpus': len(tf.config.list_physical_devices('GPU')),
+            'commit': commit}
+
+
+def parse_args(args):
+    """ Parse the arguments.
+    """
+    parser     = argparse.ArgumentParser(description='Throughput benchmarks of COPE on a synthetic dataset.')
+
+    parser.add_argument('--benchmarks',        help='Comma separated benchmarks to run, of ' + ', '.join(BENCHMARKS) + '.', default=','.join(BENCHMARKS))
+    parser.add_argument('--classes',           help='Comma separated numbers of object classes.', default='1,15,30')
+    parser.add_argument('--objects',           help='Comma separated numbers of objects of the filter_detections benchmark.', default='0,1,5,10,25,50')
+    parser.add_argument('--images',            help='Number of images of the synthetic dataset.', type=int, default=32)
+    parser.add_argument('--objects-per-image', help='Number of annotated objects per image of the synthetic dataset.', type=int, default=4)
+    parser.add_argument('--batch-size',        help='Size of the batches.', type=int, default=2)
+    parser.add_argument('--batches',           help='Number of timed batches of the data benchmarks.', type=int, default=10)
+    parser.add_argument('--workers',           help='Number of data loading worker processes of the generator benchmark.', type=int, default=0)
+    parser.add_argument('--steps',             help='Number of timed train steps.', type=int, default=5)
+    parser.add_argument('--repeats',           help='Number of timed calls of the latency benchmarks.', type=int, default=20)
+    parser.add_argument('--warmup',            help='Number of untimed batches, steps or calls before every benchmark.', type=int, default=2)
+    parser.add_argument('--backbone',          help='The backbone of the model.', default='resnet101')
+    parser.add_argument('--jit-compile',       help='Compile the train step and the inference model with XLA.', action='store_true')
+    parser.add_argument('--output',            help='Path of the JSON results, printed if not set.')
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    # parse arguments
+    if args is None:
+        args = sys.argv[1:]
+    args = parse_args(args)
+
+    benchmarks = args.benchmarks.split(',')
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            raise ValueError('Unknown benchmark {}, choose from {}.'.format(name, ', '.join(BENCHMARKS)))
+
+    records = []
+    with tempfile.TemporaryDirectory() as data_root:
+        for num_classes in [int(value) for value in args.classes.split(',')]:
+            data_dir = os.path.join(data_root, 'classes_{}'.format(num_classes))
+            correspondences, diameters = make_dataset(data_dir, num_classes=num_classes, num_images=args.images, objects_per_image=args.objects_per_image)
+
+            configurations = []
+            if 'generator' in benchmarks:
+                configurations.append(('generator', {'workers': args.workers}, dict(data_dir=data_dir, num_classes=num_classes, batch_size=args.batch_size,
+                                                                                   batches=args.batches, warmup=args.warmup, workers=args.workers)))
+            if 'anchor_targets' in benchmarks:
+                configurations.append(('anchor_targets', {}, dict(data_dir=data_dir, num_classes=num_classes, batch_size=args.batch_size,
+                                                                  batches=args.batches, warmup=args.warmup)))
+            if 'train_step' in benchmarks:
+                configurations.append(('train_step', {}, dict(data_dir=data_dir, num_classes=num_classes, correspondences=correspondences, diameters=diameters,
+                                                              backbone=args.backbone, batch_size=args.batch_size, steps=args.steps, warmup=args.warmup,
+                                                              jit_compile=args.jit_compile)))
+            if 'inference' in benchmarks:
+                configurations.append(('inference', {}, dict(num_classes=num_classes, correspondences=correspondences, diameters=diameters,
+                                                             backbone=args.backbone, warmup=args.warmup, repeats=args.repeats, jit_compile=args.jit_compile)))
+            if 'filter_detections' in benchmarks:
+                for num_objects in [int(value) for value in args.objects.split(',')]:
+                    configurations.append(('filter_detections', {'objects': num_objects}, dict(num_classes=num_classes, num_objects=num_objects, warmup=args.warmup,
+                                                                                                 repeats=args.repeats, jit_compile=args.jit_compile)))
+
+            for name, key, kwargs in configurations:
+                print('Running {} with {} classes {}'.format(name, num_classes, key), file=sys.stderr)
+                record = {'benchmark': name, 'classes': num_classes}
+                record.update(key)
+                record.update(run_isolated(name, **kwargs))
+                records.append(record)
+
+    results = json.dumps({'environment': environment(), 'arguments': vars(args), 'results': records}, indent=4)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(results)
+    else:
+        print(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+Benchmarks of the training input pipeline, the train step and inference.
+
+Every benchmark returns a flat dictionary of its measurements. They are run in a fresh process each by run.py, so
+the peak RSS it reports belongs to the benchmark alone.
+"""
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+def _latencies(function, warmup, repeats):
+    """ Call function warmup + repeats times, returns the percentiles of the latencies of the timed calls in ms.
+    """
+    for _ in range(warmup):
+        function()
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000.0
+    return {'latency_ms_mean': float(np.mean(latencies)),
+            'latency_ms_p50': float(np.percentile(latencies, 50)),
+            'latency_ms_p90': float(np.percentile(latencies, 90))}
+
+
+def generator(data_dir, num_classes, batch_size=2, batches=10, warmup=2, workers=0):
+    """ Samples/s of GeneratorDataset, including the anchor targets computed in its map, and the time per sample of
+    every generator stage.
+    """
+    from cope.preprocessing.data_generator import GeneratorDataset
+    from cope.utils.pipeline_stats import PipelineStats
+
+    stats = PipelineStats()
+    dataset = GeneratorDataset(data_dir, 'train', num_classes=num_classes, batch_size=batch_size, workers=workers, seed=0, pipeline_stats=stats)
+    iterator = iter(dataset)
+    for _ in range(warmup):
+        next(iterator)
+
+    start = time.perf_counter()
+    for _ in range(batches):
+        next(iterator)
+    elapsed = time.perf_counter() - start
+
+    results = {'samples_per_second': batches * batch_size / elapsed}
+    for stage, stage_stats in stats.report()['stages'].items():
+        results['stage_ms_per_sample/' + stage] = stage_stats['ms_per_sample']
+    return results
+
+
+def anchor_targets(data_dir, num_classes, batch_size=2, batches=10, warmup=2):
+    """ Samples/s of anchor_targets_graph on batches of the training generator.
+    """
+    from cope.preprocessing.data_generator import GeneratorDataset
+    from cope.utils.anchors import anchor_targets_graph
+
+    generate = GeneratorDataset._generate(data_dir.encode('utf-8'), b'train', batch_size=batch_size, seed=0)
+    annotations = [next(generate)[2] for _ in range(warmup + batches)]
+
+    # the number of objects differs between batches, traced once as in the input pipeline
+    masks, objects = annotations[0]
+    targets = anchor_targets_graph.get_concrete_function(
+        tf.TensorSpec(masks.shape, masks.dtype),
+        tuple(tf.TensorSpec((None,) + array.shape[1:], array.dtype) for array in objects))
+
+    def run(masks, objects):
+        return [target.numpy() for target in targets(tf.constant(masks), tuple(tf.constant(array) for array in objects))]
+
+    for masks, objects in annotations[:warmup]:
+        run(masks, objects)
+    start = time.perf_counter()
+    for masks, objects in annotations[warmup:]:
+        run(masks, objects)
+    elapsed = time.perf_counter() - start
+
+    return {'samples_per_second': batches * batch_size / elapsed}
+
+
+def _create_models(backbone, num_classes, correspondences, diameters, jit_compile=False):
+    from cope import models
+    from cope.bin.train import create_models
+
+    return create_models(models.backbone(backbone).model, num_classes, correspondences, diameters, None, jit_compile=jit_compile)
+
+
+def train_step(data_dir, num_classes, correspondences, diameters, backbone='resnet101', batch_size=2, steps=5, warmup=2, jit_compile=False):
+    """ Steps/s of CustomModel.train_step on a batch of the training generator.
+    """
+    from cope.preprocessing.data_generator import GeneratorDataset
+
+    dataset = GeneratorDataset(data_dir, 'train', num_classes=num_classes, batch_size=batch_size, seed=0)
+    batch = next(iter(dataset))
+    dataset = tf.data.Dataset.from_tensors(batch).repeat()
+
+    _, training_model = _create_models(backbone, num_classes, correspondences, diameters, jit_compile=jit_compile)
+    training_model.fit(dataset, steps_per_epoch=warmup, epochs=1, verbose=0)
+    start = time.perf_counter()
+    training_model.fit(dataset, steps_per_epoch=steps, epochs=1, verbose=0)
+    elapsed = time.perf_counter() - start
+
+    return {'steps_per_second': steps / elapsed, 'samples_per_second': steps * batch_size / elapsed}
+
+
+def inference(num_classes, correspondences, diameters, backbone='resnet101', warmup=2, repeats=20, jit_compile=False):
+    """ Latency of the inference model on a single image.
+    """
+    from cope import models
+
+    model, _ = _create_models(backbone, num_classes, correspondences, diameters)
+    inference_model = models.convert_model(model, diameters=diameters, classes=num_classes)
+    predict = tf.function(lambda inputs: inference_model(inputs, training=False), jit_compile=jit_compile)
+
+    rng = np.random.RandomState(0)
+    image = tf.constant(rng.uniform(-120.0, 150.0, (1, 480, 640, 3)).astype(np.float32))
+    intrinsics = tf.constant([[572.4114, 573.57043, 325.2611, 242.04899]], dtype=tf.float32)
+
+    return _latencies(lambda: [output.numpy() for output in predict([image, intrinsics])], warmup, repeats)
+
+
+def filter_detections(num_classes, num_objects, num_locations=6300, detections_per_object=20, warmup=2, repeats=20, jit_compile=False):
+    """ Latency of FilterDetections on head outputs with num_objects objects, each detected at detections_per_object
+    locations with overlapping boxes.
+    """
+    from cope.layers import FilterDetections
+
+    rng = np.random.RandomState(0)
+    classification = rng.uniform(0.0, 0.3, (1, num_locations, num_classes)).astype(np.float32)
+    corners = rng.uniform(0.0, 600.0, (1, num_locations, num_classes, 2))
+    boxes = np.concatenate([corners, corners + rng.uniform(20.0, 150.0, corners.shape)], axis=-1).astype(np.float32)
+    for index in range(num_objects):
+        label = index % num_classes
+        locations = rng.choice(num_locations, detections_per_object, replace=False)
+        corner = rng.uniform(0.0, 500.0, 2)
+        box = np.concatenate([corner, corner + rng.uniform(40.0, 140.0, 2)])
+        classification[0, locations, label] = rng.uniform(0.6, 1.0, detections_per_object)
+        boxes[0, locations, label] = box + rng.uniform(-4.0, 4.0, (detections_per_object, 4))
+
+    inputs = [tf.constant(rng.uniform(0.0, 640.0, (1, num_locations, num_classes, 16)).astype(np.float32)),
+              tf.constant(boxes),
+              tf.constant(classification),
+              tf.constant(rng.uniform(-1.0, 1.0, (1, num_locations, num_classes, 12)).astype(np.float32)),
+              tf.constant(rng.uniform(0.0, 1.0, (1, num_locations, num_classes)).astype(np.float32))]
+
+    layer = FilterDetections(num_classes=num_classes)
+    predict = tf.function(lambda inputs: layer(inputs), jit_compile=jit_compile)
+
+    return _latencies(lambda: [output.numpy() for output in predict(inputs)], warmup, repeats)
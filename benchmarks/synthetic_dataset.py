@@ -0,0 +1,94 @@
+"""
+Synthetic dataset in the COPE format.
+
+make_dataset writes
+    meshes/models_info.json: Objects with random box extents, every third with discrete and every fifth with a continuous symmetry,
+        cached as meshes/object_catalog.npz.
+    annotations/instances_<set_name>.json: Images with intrinsics and per object category, bbox, pose, mask_id and visibility.
+    images/<set_name>/<id>_rgb.png, <id>_mask.png: Random noise images and masks with a rectangle per object.
+
+All content is drawn from a seeded random state, the same arguments always produce the same dataset.
+"""
+
+import json
+import os
+
+import cv2
+import numpy as np
+
+from cope.utils.object_catalog import ObjectCatalog
+
+
+def _random_quaternion(rng):
+    quaternion = rng.randn(4)
+    return quaternion / np.linalg.norm(quaternion)
+
+
+def make_dataset(root, num_classes=15, num_images=32, objects_per_image=4, set_name='train', image_shape=(480, 640), seed=0):
+    """ Write a synthetic dataset to root.
+
+    Args
+        root: Directory the dataset is written to.
+        num_classes: Number of objects in models_info.json.
+        num_images: Number of images of the set.
+        objects_per_image: Number of annotated objects in every image.
+        set_name: Name of the set, e.g. 'train'.
+        image_shape: (height, width) of the images and masks.
+        seed: Seed of the random content.
+
+    Returns
+        correspondences: (num_classes, 8, 3) corners of the 3D boxes of the objects in mm.
+        diameters: (num_classes,) diameters of the 3D boxes of the objects in mm.
+    """
+    rng = np.random.RandomState(seed)
+    height, width = image_shape
+    for directory in ['meshes', 'annotations', os.path.join('images', set_name)]:
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+
+    models_info = {}
+    for index in range(num_classes):
+        size = rng.uniform(40.0, 200.0, 3)
+        minimum = -size / 2.0
+        info = {'diameter': float(np.linalg.norm(size)),
+                'min_x': float(minimum[0]), 'min_y': float(minimum[1]), 'min_z': float(minimum[2]),
+                'size_x': float(size[0]), 'size_y': float(size[1]), 'size_z': float(size[2])}
+        if index % 3 == 0:
+            # rotation by pi around the z axis
+            info['symmetries_discrete'] = [[-1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0]]
+        if index % 5 == 0:
+            info['symmetries_continuous'] = [{'axis': [0.0, 0.0, 1.0], 'offset': [0.0, 0.0, 0.0]}]
+        models_info[str(index + 1)] = info
+
+    with open(os.path.join(root, 'meshes', 'models_info.json'), 'w') as js:
+        json.dump(models_info, js)
+
+    images, annotations = [], []
+    for image_id in range(num_images):
+        file_name = '{:06d}.png'.format(image_id)
+        image = rng.randint(0, 256, (height, width, 3), dtype=np.uint8)
+        mask = np.zeros((height, width), dtype=np.uint8)
+
+        for mask_id in range(1, objects_per_image + 1):
+            box_width, box_height = rng.randint(40, width // 4), rng.randint(40, height // 4)
+            x, y = rng.randint(0, width - box_width), rng.randint(0, height - box_height)
+            mask[y:y + box_height, x:x + box_width] = mask_id
+            translation = [rng.uniform(-150.0, 150.0), rng.uniform(-100.0, 100.0), rng.uniform(500.0, 1500.0)]
+            annotations.append({'id': len(annotations),
+                                'image_id': image_id,
+                                'category_id': int(rng.randint(1, num_classes + 1)),
+                                'bbox': [int(x), int(y), int(box_width), int(box_height)],
+                                'pose': translation + _random_quaternion(rng).tolist(),
+                                'mask_id': mask_id,
+                                'feature_visibility': float(rng.uniform(0.3, 1.0))})
+
+        cv2.imwrite(os.path.join(root, 'images', set_name, file_name[:-4] + '_rgb.png'), image)
+        cv2.imwrite(os.path.join(root, 'images', set_name, file_name[:-4] + '_mask.png'), mask)
+        images.append({'id': image_id, 'file_name': file_name, 'fx': 572.4114, 'fy': 573.57043, 'cx': 325.2611, 'cy': 242.04899})
+
+    with open(os.path.join(root, 'annotations', 'instances_' + set_name + '.json'), 'w') as js:
+        json.dump({'images': images,
+                   'annotations': annotations,
+                   'categories': [{'id': index + 1, 'name': 'object_{}'.format(index + 1)} for index in range(num_classes)]}, js)
+
+    catalog = ObjectCatalog.load_or_build(os.path.join(root, 'meshes'))
+    return catalog.corners, catalog.diameters
@@ -26,7 +26,8 @@ import tensorflow as tf
 from matplotlib import pyplot
 
 # Allow relative imports when being executed as script.
-if __name__ == "__main__" and __package__ is None:
+# Spawned evaluation workers import the script as __mp_main__.
+if __name__ in ("__main__", "__mp_main__") and not __package__:
     sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
     import cope.bin  # noqa: F401
     __package__ = "cope.bin"
@@ -38,32 +39,13 @@ def create_generator(args):
     """ Create generators for evaluation.
     """
     from ..preprocessing.data_generator import GeneratorDataset
+    from ..utils.object_catalog import ObjectCatalog
 
-    mesh_info = os.path.join(args.data_path, 'meshes', 'models_info' + '.json')
-    #num_classes = len(json.load(open(mesh_info)).items())
-    num_classes = 15
+    catalog = ObjectCatalog.load_or_build(os.path.join(args.data_path, 'meshes'))
+    num_classes = catalog.num_classes
     dataset = GeneratorDataset(args.data_path, 'val', num_classes=num_classes, batch_size=1)
-    correspondences = np.ndarray((num_classes, 8, 3), dtype=np.float32)
-    sphere_diameters = np.ndarray((num_classes), dtype=np.float32)
-    for key, value in json.load(open(mesh_info)).items():
-        x_minus = value['min_x']
-        y_minus = value['min_y']
-        z_minus = value['min_z']
-        x_plus = value['size_x'] + x_minus
-        y_plus = value['size_y'] + y_minus
-        z_plus = value['size_z'] + z_minus
-        norm_pts = np.linalg.norm(np.array([value['size_x'], value['size_y'], value['size_z']]))
-        three_box_solo = np.array([[x_plus, y_plus, z_plus],
-                                   [x_plus, y_plus, z_minus],
-                                   [x_plus, y_minus, z_minus],
-                                   [x_plus, y_minus, z_plus],
-                                   [x_minus, y_plus, z_plus],
-                                   [x_minus, y_plus, z_minus],
-                                   [x_minus, y_minus, z_minus],
-                                   [x_minus, y_minus, z_plus]])
-        correspondences[int(key) - 1, :, :] = three_box_solo
-        # sphere_diameters[int(key) - 1] = value['diameter']
-        sphere_diameters[int(key) - 1] = norm_pts
+    correspondences = catalog.corners
+    sphere_diameters = catalog.diameters
 
     return dataset, num_classes, correspondences, sphere_diameters
 
@@ -79,14 +61,36 @@ def parse_args(args):
     parser.add_argument('--convert-model',    help='Convert the model to an inference model (ie. the input is a training model).', action='store_true')
     parser.add_argument('--backbone',         help='The backbone of the model.', default='resnet50')
     parser.add_argument('--gpu',              help='Id of the GPU to use (as reported by nvidia-smi).')
-    parser.add_argument('--score-threshold',  help='Threshold on score to filter detections with (defaults to 0.05).', default=0.5, type=float)
-    parser.add_argument('--iou-threshold',    help='IoU Threshold to count for a positive detection (defaults to 0.5).', default=0.5, type=float)
-    parser.add_argument('--max-detections',   help='Max Detections per image (defaults to 100).', default=100, type=int)
+    parser.add_argument('--score-threshold',  help='Threshold on score to filter detections with (defaults to 0.5).', type=float)
+    parser.add_argument('--iou-threshold',    help='IoU threshold of the boxes clustered into one detection (defaults to 0.5).', type=float)
+    parser.add_argument('--max-detections',   help='Max Detections per image (defaults to 100).', type=int)
     parser.add_argument('--save-path',        help='Path for saving images with detections (doesn\'t work for COCO).')
     parser.add_argument('--image-min-side',   help='Rescale the image so the smallest side is min_side.', type=int, default=480)
     parser.add_argument('--image-max-side',   help='Rescale the image if the largest side is larger than max_side.', type=int, default=640)
-
-    return parser.parse_args(args)
+    parser.add_argument('--batch-size',       help='Number of images per inference call.', type=int, default=1)
+    parser.add_argument('--workers',          help='Number of processes computing the metrics, 0 computes them in the main process.', type=int, default=0)
+    parser.add_argument('--num-shards',       help='Number of shards the evaluation images are split in.', type=int, default=1)
+    parser.add_argument('--shard-index',      help='Index of the shard evaluated by this process.', type=int, default=0)
+    parser.add_argument('--shard-output',     help='Write the counters of this shard to this file instead of reporting them.')
+    parser.add_argument('--results-path',     help='Path of the BOP results csv (defaults to sthalham-cope-<dataset>-test.csv in the working directory).')
+    parser.add_argument('--prediction-cache', help='Directory caching the unfiltered network outputs per checkpoint and image, the filter and metrics rerun from it.')
+    parser.add_argument('--cache-min-score',  help='Lowest score threshold the prediction cache serves.', type=float, default=0.05)
+    parser.add_argument('--pose-hyps',        help='Number of pose hypotheses averaged per detection (defaults to 10).', type=int)
+    parser.add_argument('--merge',            help='Report the merged counters of the given shard outputs instead of evaluating.', nargs='+')
+
+    args = parser.parse_args(args)
+
+    # the filter of a model that is loaded already converted can not be changed, the flags only apply when the
+    # model is converted here or its outputs are filtered from the prediction cache
+    filter_defaults = {'score_threshold': 0.5, 'iou_threshold': 0.5, 'pose_hyps': 10, 'max_detections': 100}
+    given = ['--' + name.replace('_', '-') for name in filter_defaults if getattr(args, name) is not None]
+    if given and not args.merge and not args.convert_model and not args.prediction_cache:
+        parser.error('The filter flags {} need --convert-model or --prediction-cache.'.format(', '.join(given)))
+    for name, default in filter_defaults.items():
+        if getattr(args, name) is None:
+            setattr(args, name, default)
+
+    return args
 
 
 def main(args=None):
@@ -99,6 +103,11 @@ def main(args=None):
     if args.gpu:
         os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
 
+    if args.merge:
+        from ..utils.data_eval import merge_evaluations
+        merge_evaluations(args.merge, args.dataset, results_path=args.results_path)
+        return
+
     # make save path if it doesn't exist
     if args.save_path is not None and not os.path.exists(args.save_path):
         os.makedirs(args.save_path)
@@ -112,13 +121,24 @@ def main(args=None):
 
     # optionally convert the model
     if args.convert_model:
-        model = models.convert_model(model, diameters=obj_diameters, classes=num_classes)
+        model = models.convert_model(model, diameters=obj_diameters, classes=num_classes, score_threshold=args.score_threshold,
+                                     iou_threshold=args.iou_threshold, pose_hyps=args.pose_hyps, max_detections=args.max_detections)
 
     # print model summary
     print(model.summary())
 
+    # optionally serve the network outputs from the cache, filtered with the thresholds of the arguments
+    cache = None
+    if args.prediction_cache:
+        from ..utils.prediction_cache import PredictionCache, checkpoint_key
+        key = checkpoint_key(args.model, obj_diameters if args.convert_model else None)
+        cache = PredictionCache(args.prediction_cache, key, num_classes, min_score=args.cache_min_score, score_threshold=args.score_threshold,
+                                iou_threshold=args.iou_threshold, pose_hyps=args.pose_hyps, max_detections=args.max_detections)
+
     from ..utils.data_eval import evaluate_data
-    evaluate_data(generator, model, args.dataset, args.data_path, args.score_threshold)
+    evaluate_data(generator, model, args.dataset, args.data_path, args.score_threshold, batch_size=args.batch_size, workers=args.workers,
+                  save_path=args.save_path, shard_index=args.shard_index, num_shards=args.num_shards, shard_output=args.shard_output,
+                  results_path=args.results_path, cache=cache)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2017-2018 Fizyr (https://fizyr.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import os
+import sys
+
+# Allow relative imports when being executed as script.
+if __name__ == "__main__" and __package__ is None:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+    import cope.bin  # noqa: F401
+    __package__ = "cope.bin"
+
+from ..preprocessing.packed_dataset import pack_dataset
+from ..preprocessing.tfrecord_dataset import write_tfrecords
+
+
+def parse_args(args):
+    """ Parse the arguments.
+    """
+    parser     = argparse.ArgumentParser(description='Pack a dataset into memory-mappable shards of decoded images, masks and annotations.')
+
+    parser.add_argument('data_path',    help='Path to dataset directory (ie. /tmp/your_converted_dataset).')
+    parser.add_argument('--set',        help='Name of the set to pack.', default='train')
+    parser.add_argument('--output',     help='Output directory (defaults to <data_path>/packed/<set>).')
+    parser.add_argument('--shard-size', help='Number of images per shard.', type=int, default=1000)
+    parser.add_argument('--format',     help='Memory-mappable npy shards or TFRecord shards for the tf.data pipeline.', choices=['npy', 'tfrecord'], default='npy')
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    # parse arguments
+    if args is None:
+        args = sys.argv[1:]
+    args = parse_args(args)
+
+    output = args.output
+    if output is None:
+        output = os.path.join(args.data_path, 'packed' if args.format == 'npy' else 'tfrecords', args.set)
+
+    if args.format == 'npy':
+        pack_dataset(args.data_path, args.set, output, shard_size=args.shard_size)
+    else:
+        write_tfrecords(args.data_path, args.set, output, shard_size=args.shard_size)
+    print('Packed {} set to {}'.format(args.set, output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2017-2018 Fizyr (https://fizyr.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import ipaddress
+import os
+import secrets
+import socket
+import sys
+import threading
+
+# Allow relative imports when being executed as script.
+if __name__ == "__main__" and __package__ is None:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+    import cope.bin  # noqa: F401
+    __package__ = "cope.bin"
+
+from .. import models
+from ..utils.object_catalog import ObjectCatalog
+from ..utils.serving import MicroBatcher, InferenceServer, run_load_test
+
+
+def load_diameters(data_path):
+    """ Number of classes and the object diameters from the mesh info of a dataset.
+    """
+    catalog = ObjectCatalog.load_or_build(os.path.join(data_path, 'meshes'))
+    num_classes = catalog.num_classes
+    sphere_diameters = catalog.diameters
+
+    return num_classes, sphere_diameters
+
+
+def is_loopback(host):
+    """ Whether host resolves to a loopback address.
+    """
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def parse_args(args):
+    """ Parse the arguments.
+    """
+    parser     = argparse.ArgumentParser(description='Batched inference server for a COPE model.')
+
+    parser.add_argument('model',              help='Path to the model.')
+    parser.add_argument('--data-path',        help='Path to dataset directory, the object diameters are read from its mesh info (only used with --convert-model).')
+    parser.add_argument('--convert-model',    help='Convert the model to an inference model (ie. the input is a training model).', action='store_true')
+    parser.add_argument('--backbone',         help='The backbone of the model.', default='resnet50')
+    parser.add_argument('--gpu',              help='Id of the GPU to use (as reported by nvidia-smi).')
+    parser.add_argument('--host',             help='Address to listen on.', default='localhost')
+    parser.add_argument('--port',             help='Port to listen on.', type=int, default=6000)
+    parser.add_argument('--authkey',          help='Authentication key of the clients, required for a non-loopback host (defaults to a random key that is printed).')
+    parser.add_argument('--max-batch-size',   help='Maximum number of images run at once.', type=int, default=8)
+    parser.add_argument('--max-latency-ms',   help='Time a request waits for further requests to batch with.', type=float, default=10.0)
+    parser.add_argument('--jit-compile',      help='Compile the inference model with XLA.', action='store_true')
+    parser.add_argument('--load-test',        help='Run a loopback load test against the server and exit.', action='store_true')
+    parser.add_argument('--cameras',          help='Number of simulated cameras of the load test.', type=int, default=6)
+    parser.add_argument('--requests',         help='Number of requests per camera of the load test.', type=int, default=100)
+    parser.add_argument('--fps',              help='Frame rate per camera of the load test, as fast as possible if not set.', type=float)
+
+    args = parser.parse_args(args)
+
+    # clients that know the key can run code on the server, see cope.utils.serving
+    if args.authkey is None and not is_loopback(args.host):
+        parser.error('--authkey is required to listen on the non-loopback host {}.'.format(args.host))
+
+    return args
+
+
+def main(args=None):
+    # parse arguments
+    if args is None:
+        args = sys.argv[1:]
+    args = parse_args(args)
+
+    # optionally choose specific GPU
+    if args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+
+    # load the model
+    print('Loading model, this may take a second...')
+    model = models.load_model(args.model, backbone_name=args.backbone)
+
+    # optionally convert the model
+    if args.convert_model:
+        num_classes, obj_diameters = load_diameters(args.data_path)
+        model = models.convert_model(model, diameters=obj_diameters, classes=num_classes)
+
+    if args.authkey is None:
+        args.authkey = secrets.token_hex(16)
+        print('Generated authentication key: {}'.format(args.authkey))
+
+    batcher = MicroBatcher(model, max_batch_size=args.max_batch_size, max_latency_ms=args.max_latency_ms, jit_compile=args.jit_compile)
+    server = InferenceServer(batcher, args.authkey.encode('utf-8'), address=(args.host, args.port))
+    print('Serving on {}:{}'.format(*server.address))
+
+    if not args.load_test:
+        server.serve_forever()
+        return
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    results = run_load_test(args.authkey.encode('utf-8'), server.address, cameras=args.cameras, requests_per_camera=args.requests, fps=args.fps)
+    for key, value in results.items():
+        print('{}: {:.2f}'.format(key, value))
+
+
+if __name__ == '__main__':
+    main()
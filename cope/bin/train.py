@@ -26,7 +26,8 @@ import tensorflow as tf
 import json
 
 # Allow relative imports when being executed as script.
-if __name__ == "__main__" and __package__ is None:
+# Spawned loader workers import the script as __mp_main__.
+if __name__ in ("__main__", "__mp_main__") and not __package__:
     sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
     import cope.bin  # noqa: F401
     __package__ = "cope.bin"
@@ -34,7 +35,7 @@ if __name__ == "__main__" and __package__ is None:
 from .. import layers  # noqa: F401
 from .. import losses
 from .. import models
-from ..callbacks import RedirectModel
+from ..callbacks import RedirectModel, StepProfiler
 from ..utils.model import freeze as freeze_model
 from ..models.train_step import CustomModel
 
@@ -56,47 +57,53 @@ def model_with_weights(model, weights, skip_mismatch):
     return model
 
 
-def create_models(backbone_model, num_classes, obj_correspondences, obj_diameters, weights, multi_gpu=0,
-                  freeze_backbone=False, lr=1e-5):
+def create_models(backbone_model, num_classes, obj_correspondences, obj_diameters, weights, strategy=None,
+                  freeze_backbone=False, lr=1e-5, jit_compile=False, accumulation_steps=1):
 
     modifier = freeze_model if freeze_backbone else None
 
-    # Keras recommends initialising a multi-gpu model on the CPU to ease weight sharing, and to prevent OOM errors.
-    # optionally wrap in a parallel model
-    # deprecated, not tested with tensorflow [ST]
-    if multi_gpu > 1:
-        from tensorflow.keras.utils import multi_gpu_model
-        with tf.device('/cpu:0'):
-            model = model_with_weights(backbone_model(num_classes=num_classes, correspondences=obj_correspondences, obj_diameters=obj_diameters, modifier=modifier), weights=weights, skip_mismatch=True)
-        training_model = multi_gpu_model(model, gpus=multi_gpu)
-    else:
-        model          = model_with_weights(backbone_model(num_classes=num_classes, correspondences=obj_correspondences, obj_diameters=obj_diameters, modifier=modifier), weights=weights, skip_mismatch=True)
-        training_model = model
-
-    custom_model = CustomModel(model=training_model)
-
-    # compile model
-    custom_model.compile(
-        loss={
-            'pts'           : losses.per_cls_l1_sym(num_classes=num_classes, weight=1.3),
-            'box'           : losses.per_cls_l1(num_classes=num_classes, weight=1.0),
-            'cls'           : losses.focal(),
-            'tra'           : losses.per_cls_l1_trans(num_classes=num_classes, weight=1.0),
-            'rot'           : losses.per_cls_l1_sym(num_classes=num_classes, weight=0.3),
-            'con'           : losses.projection_deviation(num_classes=num_classes, weight=0.1),
-            'pro'           : losses.per_cls_l1_rep(num_classes=num_classes, weight=0.15),
-        },
-        optimizer=keras.optimizers.Adam(learning_rate=lr, clipnorm=0.001)
-    )
+    # variables, optimizer slots and metrics have to be created under the scope of the strategy to be mirrored
+    if strategy is None:
+        strategy = tf.distribute.get_strategy()
+    with strategy.scope():
+        model = model_with_weights(backbone_model(num_classes=num_classes, correspondences=obj_correspondences, obj_diameters=obj_diameters, modifier=modifier), weights=weights, skip_mismatch=True)
+        custom_model = CustomModel(model=model)
+
+        # compile model
+        custom_model.compile(
+            loss={
+                'pts'           : losses.per_cls_l1_sym(num_classes=num_classes, weight=1.3),
+                'box'           : losses.per_cls_l1(num_classes=num_classes, weight=1.0),
+                'cls'           : losses.focal(),
+                'tra'           : losses.per_cls_l1_trans(num_classes=num_classes, weight=1.0),
+                'rot'           : losses.per_cls_l1_sym(num_classes=num_classes, weight=0.3),
+                'con'           : losses.projection_deviation(num_classes=num_classes, weight=0.1),
+                'pro'           : losses.per_cls_l1_rep(num_classes=num_classes, weight=0.15),
+            },
+            optimizer=keras.optimizers.Adam(learning_rate=lr, clipnorm=0.001),
+            jit_compile=jit_compile,
+            accumulation_steps=accumulation_steps
+        )
 
     return model, custom_model
 
 
-def create_callbacks(model, args):
+def is_chief(strategy):
+    """ Whether this process is the chief of a multi-worker training, the only one writing snapshots.
+    """
+    cluster_resolver = getattr(strategy, 'cluster_resolver', None)
+    if cluster_resolver is None or not cluster_resolver.task_type:
+        return True
+    if cluster_resolver.task_type == 'chief':
+        return True
+    return cluster_resolver.task_type == 'worker' and cluster_resolver.task_id == 0 and 'chief' not in cluster_resolver.cluster_spec().as_dict()
+
+
+def create_callbacks(model, args, strategy=None):
     callbacks = []
 
     # save the model
-    if args.snapshots:
+    if args.snapshots and is_chief(strategy):
         # ensure directory created first; otherwise h5py will error after epoch.
         makedirs(args.snapshot_path)
         checkpoint = keras.callbacks.ModelCheckpoint(
@@ -119,43 +126,56 @@ def create_callbacks(model, args):
         min_lr     = 0
     ))
 
+    # time spent waiting for data and in every stage of the train step, profiler trace of a window of steps
+    if args.profile and is_chief(strategy):
+        trace_steps = tuple(int(step) for step in args.profile_trace_steps.split(',')) if args.profile_trace_steps else None
+        callbacks.append(StepProfiler(args.tensorboard_dir, trace_steps=trace_steps))
+
     return callbacks
 
 
-def create_generators(args):
+def create_generators(args, strategy=None):
 
     from ..preprocessing.data_generator import GeneratorDataset
+    from ..preprocessing.tfrecord_dataset import create_tfrecord_dataset
+    from ..utils.object_catalog import ObjectCatalog
+    from ..utils.pipeline_stats import PipelineStats, LogSink, TensorBoardSink
 
-    mesh_info = os.path.join(args.data_path, 'meshes', 'models_info' + '.json')
-    num_classes = len(json.load(open(mesh_info)).items())
+    catalog = ObjectCatalog.load_or_build(os.path.join(args.data_path, 'meshes'))
+    num_classes = catalog.num_classes
     train_samples = 50000
-    dataset = GeneratorDataset(args.data_path, 'train', num_classes=num_classes, batch_size=args.batch_size)
-    dataset = tf.data.Dataset.range(args.workers).interleave(
-        lambda _: dataset,
-        # num_parallel_calls=tf.data.experimental.AUTOTUNE
-        num_parallel_calls=args.workers
-    )
-    dataset = dataset.shuffle(1, reshuffle_each_iteration=True)
-    correspondences = np.ndarray((num_classes, 8, 3), dtype=np.float32)
-    sphere_diameters = np.ndarray((num_classes), dtype=np.float32)
-    for key, value in json.load(open(mesh_info)).items():
-        x_minus = value['min_x']
-        y_minus = value['min_y']
-        z_minus = value['min_z']
-        x_plus = value['size_x'] + x_minus
-        y_plus = value['size_y'] + y_minus
-        z_plus = value['size_z'] + z_minus
-        norm_pts = np.linalg.norm(np.array([value['size_x'], value['size_y'], value['size_z']]))
-        three_box_solo = np.array([[x_plus, y_plus, z_plus],
-                                   [x_plus, y_plus, z_minus],
-                                   [x_plus, y_minus, z_minus],
-                                   [x_plus, y_minus, z_plus],
-                                   [x_minus, y_plus, z_plus],
-                                   [x_minus, y_plus, z_minus],
-                                   [x_minus, y_minus, z_minus],
-                                   [x_minus, y_minus, z_plus]])
-        correspondences[int(key)-1, :, :] = three_box_solo
-        sphere_diameters[int(key)-1] = norm_pts
+
+    def dataset_fn(input_context):
+        # --batch-size is the global batch, every replica gets batches of its own images, the sparse targets
+        # index into the images of a batch and can not be split along the batch dimension afterwards,
+        # in multi-worker training every worker reads a disjoint shard of the images,
+        # with gradient accumulation a step reads --accumulation-steps micro-batches at once
+        batch_size = input_context.get_per_replica_batch_size(args.batch_size * args.accumulation_steps)
+        if args.tfrecord_dir:
+            # native tf.data pipeline, decoding and augmentation run in parallel maps
+            dataset = create_tfrecord_dataset(args.tfrecord_dir, args.data_path, 'train', batch_size=batch_size, seed=args.seed,
+                                              shard_index=input_context.input_pipeline_id, num_shards=input_context.num_input_pipelines)
+        else:
+            # per stage timing of the generator, reported every --pipeline-stats-every batches
+            pipeline_stats = None
+            if args.pipeline_stats == 'log':
+                pipeline_stats = PipelineStats(LogSink(), report_every=args.pipeline_stats_every)
+            elif args.pipeline_stats == 'tensorboard':
+                log_dir = os.path.join(args.tensorboard_dir, 'data_pipeline_{}'.format(input_context.input_pipeline_id))
+                pipeline_stats = PipelineStats(TensorBoardSink(log_dir), report_every=args.pipeline_stats_every)
+
+            # worker processes load disjoint shards of the images into shared memory
+            dataset = GeneratorDataset(args.data_path, 'train', num_classes=num_classes, batch_size=batch_size, workers=args.workers, seed=args.seed, pack_dir=args.pack_dir,
+                                       shard_index=input_context.input_pipeline_id, num_shards=input_context.num_input_pipelines, pipeline_stats=pipeline_stats)
+            dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+        return dataset.shuffle(1, reshuffle_each_iteration=True)
+
+    if strategy is not None and strategy.num_replicas_in_sync > 1:
+        dataset = strategy.distribute_datasets_from_function(dataset_fn)
+    else:
+        dataset = dataset_fn(tf.distribute.InputContext())
+    correspondences = catalog.corners
+    sphere_diameters = catalog.diameters
 
     return dataset, num_classes, correspondences, sphere_diameters, train_samples
 
@@ -175,8 +195,13 @@ def parse_args(args):
 
     parser.add_argument('dataset',             help='Path to dataset directory (ie. /tmp/your_converted_dataset).')
     parser.add_argument('--data-path',           help='Path to dataset directory (ie. /tmp/your_converted_dataset).')
+    parser.add_argument('--tfrecord-dir',     help='Read the training set from TFRecord shards written by pack_dataset.py --format tfrecord.')
+    parser.add_argument('--pack-dir',         help='Read the training set from a directory written by pack_dataset.py instead of decoding the images.')
     parser.add_argument('--batch-size',       help='Size of the batches.', default=1, type=int)
+    parser.add_argument('--accumulation-steps', help='Number of micro-batches of --batch-size whose gradients are accumulated per optimizer step.', type=int, default=1)
     parser.add_argument('--gpu',              help='Id of the GPU to use (as reported by nvidia-smi).')
+    parser.add_argument('--multi-worker',     help='Train on the workers of the cluster defined in TF_CONFIG, gradients are all-reduced across hosts.', action='store_true')
+    parser.add_argument('--multi-gpu',        help='Number of GPUs to use for synchronous data-parallel training, --batch-size is split between them.', type=int, default=0)
     parser.add_argument('--epochs',           help='Number of epochs to train.', type=int, default=100)
     parser.add_argument('--lr',               help='Learning rate.', type=float, default=1e-5)
     parser.add_argument('--snapshot-path',    help='Path to store snapshots of models during training (defaults to \'./models\')', default='./models')
@@ -185,9 +210,16 @@ def parse_args(args):
     parser.add_argument('--freeze-backbone',  help='Freeze training of backbone layers.', action='store_true')
     parser.add_argument('--image-min-side',   help='Rescale the image so the smallest side is min_side.', type=int, default=480)
     parser.add_argument('--image-max-side',   help='Rescale the image if the largest side is larger than max_side.', type=int, default=640)
+    parser.add_argument('--jit-compile',      help='Compile the forward and backward pass of the model with XLA.', action='store_true')
+    parser.add_argument('--profile',          help='Log the time every step waits for data, its compute time and the time of every loss term to --tensorboard-dir.', action='store_true')
+    parser.add_argument('--profile-trace-steps', help='First and last step traced by the TensorFlow profiler with --profile, e.g. 10,20. Empty to not trace.', default='10,20')
+    parser.add_argument('--mixed-precision',  help='Train with a mixed precision policy, mixed_float16 on GPUs or mixed_bfloat16 on GPUs and CPUs.', choices=['mixed_float16', 'mixed_bfloat16'])
 
     # Fit generator arguments
     parser.add_argument('--workers', help='Number of multiprocessing workers. To disable multiprocessing, set workers to 0', type=int, default=1)
+    parser.add_argument('--seed', help='Base seed of the data loading workers, worker i uses seed + i.', type=int, default=None)
+    parser.add_argument('--pipeline-stats', help='Time the stages of the training generator and print the percentiles or write them to --tensorboard-dir.', choices=['log', 'tensorboard'])
+    parser.add_argument('--pipeline-stats-every', help='Number of batches between two reports of --pipeline-stats.', type=int, default=100)
     parser.add_argument('--max-queue-size', help='Queue length for multiprocessing workers in fit generator.', type=int, default=1)
 
     return parser.parse_args(args)
@@ -207,13 +239,27 @@ def main(args=None):
     if args.gpu:
         os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
 
+    # float16 or bfloat16 compute with float32 variables, the model has to be created under the policy
+    if args.mixed_precision:
+        keras.mixed_precision.set_global_policy(args.mixed_precision)
+
+    # synchronous data-parallel training, every GPU runs a replica of the model on its part of the batch
+    if args.multi_worker:
+        # the cluster and the task of this process are read from TF_CONFIG, all workers run with the same arguments
+        strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    elif args.multi_gpu > 1:
+        strategy = tf.distribute.MirroredStrategy(devices=['/gpu:{}'.format(gpu) for gpu in range(args.multi_gpu)])
+    else:
+        strategy = tf.distribute.get_strategy()
+
     # create the generators
-    dataset, num_classes, correspondences, obj_diameters, train_samples = create_generators(args)
+    dataset, num_classes, correspondences, obj_diameters, train_samples = create_generators(args, strategy)
 
     # create the model
     if args.snapshot is not None:
         print('Loading model, this may take a second...')
-        model            = models.load_model(args.snapshot, backbone_name=args.backbone)
+        with strategy.scope():
+            model        = models.load_model(args.snapshot, backbone_name=args.backbone)
         training_model   = model
     else:
         weights = args.weights
@@ -225,9 +271,11 @@ def main(args=None):
             obj_correspondences=correspondences,
             obj_diameters=obj_diameters,
             weights=weights,
-            multi_gpu=0,
+            strategy=strategy,
             freeze_backbone=args.freeze_backbone,
             lr=args.lr,
+            jit_compile=args.jit_compile,
+            accumulation_steps=args.accumulation_steps,
         )
 
     # print model summary
@@ -237,6 +285,7 @@ def main(args=None):
     callbacks = create_callbacks(
         model,
         args,
+        strategy,
     )
 
     # Use multiprocessing if workers > 0
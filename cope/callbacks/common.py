@@ -21,6 +21,12 @@ Comment: stale and unused
 """
 
 
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
 import tensorflow.keras.callbacks
 
 
@@ -67,3 +73,91 @@ class RedirectModel(tensorflow.keras.callbacks.Callback):
 
     def on_train_end(self, logs=None):
         self.callback.on_train_end(logs=logs)
+
+
+class StepProfiler(tensorflow.keras.callbacks.Callback):
+    """Records where the time of every training step of a CustomModel goes.
+
+    Per step the time the train function was blocked waiting for the next batch of the input pipeline, the compute
+    time of the step and the time of every stage of CustomModel.train_step (forward pass, target gathering, every loss
+    term, backward pass) are written to TensorBoard. The remainder of the compute time, mostly the optimizer update, is
+    logged as 'optimizer'. The TensorFlow profiler traces the steps of trace_steps. At the end of training the mean,
+    median and 90th percentile of every time, without the first step that traces the train function, are written
+    to step_profile.json in log_dir.
+
+    Timing the stages serializes them and waits for the device after every stage, which slows the step down.
+
+    Args
+        log_dir     : directory of the TensorBoard summaries, the profiler trace and the JSON summary.
+        trace_steps : (first, last) step traced by the TensorFlow profiler, None to not trace.
+    """
+
+    def __init__(self,
+                 log_dir,
+                 trace_steps=(10, 20)):
+        super(StepProfiler, self).__init__()
+
+        self.log_dir = log_dir
+        self.trace_steps = trace_steps
+        self.tracing = False
+
+    def set_model(self, model):
+        super(StepProfiler, self).set_model(model)
+
+        # the timing of the stages is traced into the train function, which fit creates after setting the model
+        if not model.profile_step:
+            model.profile_step = True
+            model.train_function = None
+
+    def on_train_begin(self, logs=None):
+        self.writer = tf.summary.create_file_writer(os.path.join(self.log_dir, 'train'))
+        self.step = 0
+        self.records = []
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.trace_steps is not None and self.step == self.trace_steps[0]:
+            tf.profiler.experimental.start(self.log_dir)
+            self.tracing = True
+        self.batch_begin = time.time()
+
+    def on_train_batch_end(self, batch, logs=None):
+        # the logs are synchronized before the callbacks are called, the step has finished
+        batch_end = time.time()
+        timings = self.model.step_timings.numpy()
+        start, durations = timings[0], timings[1:]
+
+        record = {'data_wait': start - self.batch_begin, 'compute': batch_end - start}
+        record.update(zip(self.model.step_timing_names, durations))
+        record['optimizer'] = record['compute'] - np.sum(durations)
+        self.records.append(record)
+
+        with self.writer.as_default():
+            for name, value in record.items():
+                tf.summary.scalar('step_time/' + name, value, step=self.step)
+
+        if self.tracing and self.step == self.trace_steps[1]:
+            self._stop_trace()
+        self.step += 1
+
+    def on_train_end(self, logs=None):
+        if self.tracing:
+            self._stop_trace()
+        self.writer.close()
+
+        records = self.records[1:]
+        summary = {'steps': len(records)}
+        if records:
+            for name in records[0]:
+                values = np.array([record[name] for record in records])
+                summary[name] = {'mean': float(np.mean(values)),
+                                 'median': float(np.median(values)),
+                                 'p90': float(np.percentile(values, 90))}
+            total = sum(record['data_wait'] + record['compute'] for record in records)
+            summary['data_wait_fraction'] = float(sum(record['data_wait'] for record in records) / total)
+
+        with open(os.path.join(self.log_dir, 'step_profile.json'), 'w') as js:
+            json.dump(summary, js, indent=4)
+
+    def _stop_trace(self):
+        tf.profiler.experimental.stop()
+        self.tracing = False
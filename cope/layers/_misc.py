@@ -16,7 +16,7 @@ limitations under the License.
 
 import tensorflow.keras as keras
 import tensorflow as tf
-from ..backend import resize_images, transpose, shift, bbox_transform_inv, clip_by_value, box3D_transform_inv, box3D_denorm, box3D_norm, poses_denorm, box_projection
+from ..backend import resize_nearest, transpose, shift, bbox_transform_inv, clip_by_value, box3D_transform_inv, box3D_denorm, box3D_norm, poses_denorm, box_projection
 from ..utils import anchors as utils_anchors
 
 import numpy as np
@@ -171,11 +171,11 @@ class UpsampleLike(keras.layers.Layer):
         target_shape = keras.backend.shape(target)
         if keras.backend.image_data_format() == 'channels_first':
             source = transpose(source, (0, 2, 3, 1))
-            output = resize_images(source, (target_shape[2], target_shape[3]), method='nearest')
+            output = resize_nearest(source, (target_shape[2], target_shape[3]))
             output = transpose(output, (0, 3, 1, 2))
             return output
         else:
-            return resize_images(source, (target_shape[1], target_shape[2]), method='nearest')
+            return resize_nearest(source, (target_shape[1], target_shape[2]))
 
     def compute_output_shape(self, input_shape):
         if keras.backend.image_data_format() == 'channels_first':
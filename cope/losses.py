@@ -14,11 +14,173 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import contextlib
+
 import tensorflow.keras as keras
 import tensorflow as tf
 from . import backend
 
 
+def gather_targets(targets, locations, batch_size, num_classes, std=0.65):
+    """ Compute the targets of the positive locations from the sparse targets of anchors.anchor_targets_sparse.
+
+    The per-location regression targets are derived on the device from the per-object payloads, the host only
+    ships the positive location indices and one payload per object. Only the classification targets cover all
+    locations, the regression losses are evaluated on the predictions gathered at the positive locations.
+
+    Args
+        targets: Tuple of (label_indices, pose_indices, boxes3D, symmetry_mask, bboxes, diameters, translations, rotations).
+        locations: Tensor of shape (num_locations, 2) containing the image coordinates of all locations.
+        batch_size: Number of images in the batch.
+        num_classes: Number of object classes.
+        std: The standard deviation used for normalizing the 3D box regression.
+
+    Returns
+        positive_indices: (P, 3) batch, location and class index of every location with pose supervision.
+        symmetry_mask: (P, 8) valid symmetry hypotheses of every positive location.
+        targets: Tuple of the (regression, detections, labels, translations, rotations) targets, the 3D box
+                 regression (P, 8, 16), 2D box regression (P, 4), translations (P, 3) and rotations (P, 8, 6) of the
+                 positive locations and the dense (batch_size, num_locations, num_classes + 1) labels, the last value
+                 of the labels is the anchor state.
+    """
+    label_indices, pose_indices, boxes3D, symmetry_mask, bboxes, diameters, translations, rotations = targets
+    locations = tf.convert_to_tensor(locations, dtype=tf.float32)
+    num_locations = tf.shape(locations)[0]
+
+    label_indices = tf.cast(label_indices, dtype=tf.int32)
+    pose_indices = tf.cast(pose_indices, dtype=tf.int32)
+    positive_indices = pose_indices[:, :3]
+    object_indices = pose_indices[:, 3]
+
+    # per-object payloads to per-location payloads
+    loc = tf.gather(locations, pose_indices[:, 1])
+    boxes3D = tf.gather(boxes3D, object_indices)
+    symmetry_mask = tf.gather(symmetry_mask, object_indices)
+    bboxes = tf.gather(bboxes, object_indices)
+    diameters = tf.gather(diameters, object_indices)[:, tf.newaxis]
+    translations = tf.gather(translations, object_indices)
+    rotations = tf.gather(rotations, object_indices)
+
+    regression = (tf.tile(loc, [1, 8])[:, tf.newaxis, :] - boxes3D) / (std * diameters[:, :, tf.newaxis])
+    detections = (tf.tile(loc, [1, 2]) - bboxes) / diameters
+    translations = tf.concat([translations[:, :2] * 0.002, ((translations[:, 2:] * 0.001) - 1.0) * 3.0], axis=1)
+
+    # class and anchor state of every positive location
+    state_indices = tf.concat([label_indices[:, :2], tf.fill([tf.shape(label_indices)[0], 1], num_classes)], axis=1)
+    labels_batch = tf.zeros([batch_size, num_locations, num_classes + 1], dtype=tf.float32)
+    labels_batch = tf.tensor_scatter_nd_update(labels_batch, tf.concat([label_indices, state_indices], axis=0),
+                                               tf.ones([2 * tf.shape(label_indices)[0]], dtype=tf.float32))
+
+    return positive_indices, symmetry_mask, (regression, detections, labels_batch, translations, rotations)
+
+
+def cross_replica_sum(value):
+    """ Sum a tensor over the replicas of the current tf.distribute strategy.
+
+    The loss normalizers are summed before dividing, so the losses of the replicas add up to the loss of the global
+    batch and the summed gradients equal the gradients of single device training on that batch.
+
+    Args
+        value: Tensor computed by every replica.
+
+    Returns
+        The sum of value over all replicas, value itself if there is a single replica.
+    """
+    replica_context = tf.distribute.get_replica_context()
+    if replica_context is None or replica_context.num_replicas_in_sync == 1:
+        return value
+    return replica_context.all_reduce(tf.distribute.ReduceOp.SUM, value)
+
+
+def slice_targets(targets, start, size):
+    """ Select the sparse targets of the images start to start + size of a batch.
+
+    Args
+        targets: Tuple of sparse targets as returned by anchors.anchor_targets_sparse.
+        start: Index of the first image.
+        size: Number of images.
+
+    Returns
+        The sparse targets of the selected images, their batch indices start at 0. The per-object payloads are
+        indexed by the pose indices and are passed on unchanged.
+    """
+    label_indices, pose_indices = targets[:2]
+
+    def select(indices):
+        in_slice = tf.logical_and(indices[:, 0] >= start, indices[:, 0] < start + size)
+        indices = tf.boolean_mask(indices, in_slice)
+        return tf.concat([indices[:, :1] - start, indices[:, 1:]], axis=1)
+
+    return (select(label_indices), select(pose_indices)) + tuple(targets[2:])
+
+
+class _NormalizerScope:
+    """ Normalizers recorded or returned by normalizer_sum within a record_normalizers or fixed_normalizers scope.
+    """
+
+    def __init__(self, values, record):
+        self.values = values
+        self.record = record
+        self.index = 0
+
+    def __call__(self, value):
+        if self.record:
+            self.values.append(value)
+            return value
+        value = self.values[self.index]
+        self.index += 1
+        return value
+
+
+_normalizer_scope = None
+
+
+@contextlib.contextmanager
+def _scope(scope):
+    global _normalizer_scope
+    _normalizer_scope = scope
+    try:
+        yield scope.values
+    finally:
+        _normalizer_scope = None
+
+
+def record_normalizers():
+    """ Context manager collecting the normalizers of the losses computed within, in the order they are computed.
+
+    The normalizers are local to the replica and are not summed, the context yields the list they are appended to.
+    """
+    return _scope(_NormalizerScope([], record=True))
+
+
+def fixed_normalizers(totals):
+    """ Context manager replacing the normalizers of the losses computed within by totals.
+
+    Args
+        totals: Normalizers in the order the losses compute them, as recorded by record_normalizers and summed over
+                all parts of the batch.
+    """
+    return _scope(_NormalizerScope(totals, record=False))
+
+
+def normalizer_sum(value):
+    """ Sum a loss normalizer over all parts of the batch.
+
+    The parts are the replicas of the current tf.distribute strategy, see cross_replica_sum. Within
+    record_normalizers or fixed_normalizers the normalizer is recorded or replaced instead, gradient accumulation
+    uses them to normalize every micro-batch by the normalizer of the whole batch.
+
+    Args
+        value: Normalizer computed by a loss.
+
+    Returns
+        The normalizer of the whole batch.
+    """
+    if _normalizer_scope is not None:
+        return _normalizer_scope(value)
+    return cross_replica_sum(value)
+
+
 def focal(alpha=0.25, gamma=2.0):
     """ Create a functor for computing the focal loss.
 
@@ -64,7 +226,7 @@ def focal(alpha=0.25, gamma=2.0):
         # compute the normalizer: the number of positive anchors
         normalizer = backend.where(keras.backend.equal(anchor_state, 1))
         normalizer = keras.backend.cast(keras.backend.shape(normalizer)[0], keras.backend.floatx())
-        normalizer = keras.backend.maximum(keras.backend.cast_to_floatx(1.0), normalizer)
+        normalizer = keras.backend.maximum(keras.backend.cast_to_floatx(1.0), normalizer_sum(normalizer))
 
         return keras.backend.sum(cls_loss) / normalizer
 
@@ -92,7 +254,7 @@ def per_cls_focal(num_classes=0, weight=1.2, alpha=0.25, gamma=2.0):
         cls_loss = focal_weight * keras.backend.binary_crossentropy(labels, classification)
 
         # comp norm per class
-        normalizer = tf.math.reduce_sum(labels, axis=0) * tf.cast(num_classes, dtype=tf.float32)
+        normalizer = normalizer_sum(tf.math.reduce_sum(labels, axis=0) * tf.cast(num_classes, dtype=tf.float32))
         per_cls_loss = tf.math.reduce_sum(cls_loss, axis=[0])
 
         loss = tf.math.divide_no_nan(per_cls_loss, normalizer)
@@ -303,7 +465,7 @@ def confidence_loss(num_classes=0, weight=1.0):
         conf_loss = tf.math.abs(tf.math.exp(-1.0 * exp) - confidence)
 
         # comp norm per class
-        normalizer = tf.math.reduce_sum(anchor_state, axis=[0, 1])
+        normalizer = normalizer_sum(tf.math.reduce_sum(anchor_state, axis=[0, 1]))
         conf_loss = tf.where(tf.math.equal(anchor_state, 1), conf_loss, 0.0)
 
         per_cls_loss = tf.math.reduce_sum(conf_loss, axis=[0, 1])
@@ -314,295 +476,181 @@ def confidence_loss(num_classes=0, weight=1.0):
     return _confidence_loss
 
 
-def per_cls_l1_trans(num_classes=0, weight=1.0, sigma=3.0):
-
-    sigma_squared = sigma ** 2
-
-    def _per_cls_l1_trans(y_true, y_pred):
-        regression_target = y_true[:, :, :, :-1]
-        anchor_state = y_true[:, :, :, -1]
-
-        in_shape = tf.shape(regression_target)
-        anchor_state = tf.reshape(anchor_state, [in_shape[0] * in_shape[1], in_shape[2]])
-        indices = tf.math.reduce_max(anchor_state, axis=1)
-        indices = tf.where(tf.math.equal(indices, 1))[:, 0]
-
-        y_pred_res = tf.reshape(y_pred, [in_shape[0] * in_shape[1], in_shape[2], in_shape[3]])
-        regression = tf.gather(y_pred_res, indices, axis=0)
-        y_true_res = tf.reshape(regression_target, [in_shape[0] * in_shape[1], in_shape[2], in_shape[3]])
-        regression_target = tf.gather(y_true_res, indices, axis=0)
+def _smooth_l1(regression_diff, sigma_squared):
+    """ Smooth L1 of the absolute regression differences.
 
-        regression = tf.transpose(regression, perm=[1, 2, 0])
-        regression_target = tf.transpose(regression_target, perm=[1, 2, 0])
+    f(x) = 0.5 * (sigma * x)^2          if |x| < 1 / sigma / sigma
+           |x| - 0.5 / sigma / sigma    otherwise
+    """
+    return backend.where(
+        keras.backend.less(regression_diff, 1.0 / sigma_squared),
+        0.5 * sigma_squared * keras.backend.pow(regression_diff, 2),
+        regression_diff - 0.5 / sigma_squared
+    )
 
-        regression_diff = regression_target - regression
-        regression_diff = keras.backend.abs(regression_diff)
-        regression_loss = backend.where(
-            keras.backend.less(regression_diff, 1.0 / sigma_squared),
-            0.5 * sigma_squared * keras.backend.pow(regression_diff, 2),
-            regression_diff - 0.5 / sigma_squared
-        )
-        per_cls_loss = tf.math.reduce_sum(regression_loss, axis=1)
 
-        anchor_anno = tf.gather(anchor_state, indices, axis=0)
-        anchor_anno = tf.transpose(anchor_anno, perm=[1, 0])
+def _per_cls_normalize(per_loc_loss, classes, num_classes, num_values):
+    """ Sum the losses of the positive locations per class and normalize every class by its number of locations.
 
-        regression_loss = tf.where(tf.math.equal(anchor_anno, 1), per_cls_loss, 0.0)
-        per_cls_loss = tf.math.reduce_sum(regression_loss, axis=1)
+    Args
+        per_loc_loss: (P,) loss of every positive location.
+        classes: (P,) class of every positive location.
+        num_classes: Number of object classes.
+        num_values: Number of regressed values the normalizer is scaled with.
 
-        # comp norm per class
-        normalizer = tf.math.reduce_sum(anchor_anno, axis=1) * tf.cast(num_classes, dtype=tf.float32) # accumulate over batch, locations and regressed values
-        loss = tf.math.divide_no_nan(per_cls_loss, normalizer) # normalize per cls separately
+    Returns
+        The sum of the normalized per class losses.
+    """
+    per_cls_loss = tf.math.unsorted_segment_sum(per_loc_loss, classes, num_classes)
+    normalizer = tf.math.unsorted_segment_sum(tf.ones_like(per_loc_loss), classes, num_classes) * tf.cast(num_values, dtype=tf.float32) # accumulate over batch, locations and regressed values
+    normalizer = normalizer_sum(normalizer) # accumulate over replicas and micro-batches
+    loss = tf.math.divide_no_nan(per_cls_loss, normalizer) # normalize per cls separately
 
-        return weight * tf.math.reduce_sum(loss, axis=0)
+    return tf.math.reduce_sum(loss, axis=0)
 
-    return _per_cls_l1_trans
 
+def per_cls_l1_trans(num_classes=0, weight=1.0, sigma=3.0):
+    """ Create a smooth L1 loss on the translations of the positive locations, normalized per class.
 
-def per_cls_l1(num_classes=0, weight=1.0, sigma=3.0):
+    Args
+        num_classes: Number of object classes.
+        weight: Factor of the loss.
+        sigma: Point where the loss changes from L2 to L1.
 
+    Returns
+        A functor computing the loss from the (P, 3) targets, the (P, 3) predictions and the (P,) classes of the
+        positive locations.
+    """
     sigma_squared = sigma ** 2
 
-    def _per_cls_l1(y_true, y_pred):
-        regression_target = y_true[:, :, :, :-1]
-        anchor_state = y_true[:, :, :, -1]
+    def _per_cls_l1_trans(y_true, y_pred, classes):
+        regression_diff = keras.backend.abs(y_true - y_pred)
+        per_loc_loss = tf.math.reduce_sum(_smooth_l1(regression_diff, sigma_squared), axis=1)
 
-        in_shape = tf.shape(regression_target)
-        anchor_state = tf.reshape(anchor_state, [in_shape[0] * in_shape[1], in_shape[2]])
-        indices = tf.math.reduce_max(anchor_state, axis=1)
-        indices = tf.where(tf.math.equal(indices, 1))[:, 0]
+        return weight * _per_cls_normalize(per_loc_loss, classes, num_classes, num_classes)
 
-        y_pred_res = tf.reshape(y_pred, [in_shape[0] * in_shape[1], in_shape[3]])
-        regression = tf.gather(y_pred_res, indices, axis=0)
-        y_true_res = tf.reshape(regression_target, [in_shape[0] * in_shape[1], in_shape[2], in_shape[3]])
-        regression_target = tf.gather(y_true_res, indices, axis=0)
+    return _per_cls_l1_trans
 
-        regression = tf.transpose(regression, perm=[1, 0])
-        regression_target = tf.transpose(regression_target, perm=[1, 2, 0])
 
-        regression_diff = regression_target - regression
-        regression_diff = keras.backend.abs(regression_diff)
-        regression_loss = backend.where(
-            keras.backend.less(regression_diff, 1.0 / sigma_squared),
-            0.5 * sigma_squared * keras.backend.pow(regression_diff, 2),
-            regression_diff - 0.5 / sigma_squared
-        )
-        per_cls_loss = tf.math.reduce_sum(regression_loss, axis=1)
+def per_cls_l1(num_classes=0, weight=1.0, sigma=3.0):
+    """ Create a smooth L1 loss on the class agnostic regression of the positive locations, normalized per class.
 
-        anchor_anno = tf.gather(anchor_state, indices, axis=0)
-        anchor_anno = tf.transpose(anchor_anno, perm=[1, 0])
+    Args
+        num_classes: Number of object classes.
+        weight: Factor of the loss.
+        sigma: Point where the loss changes from L2 to L1.
 
-        regression_loss = tf.where(tf.math.equal(anchor_anno, 1), per_cls_loss, 0.0)
-        per_cls_loss = tf.math.reduce_sum(regression_loss, axis=1)
+    Returns
+        A functor computing the loss from the (P, V) targets, the (P, V) predictions and the (P,) classes of the
+        positive locations.
+    """
+    sigma_squared = sigma ** 2
 
-        # comp norm per class
-        normalizer = tf.math.reduce_sum(anchor_anno, axis=1) * tf.cast(in_shape[3], dtype=tf.float32) # accumulate over batch, locations and regressed values
-        loss = tf.math.divide_no_nan(per_cls_loss, normalizer) # normalize per cls separately
+    def _per_cls_l1(y_true, y_pred, classes):
+        regression_diff = keras.backend.abs(y_true - y_pred)
+        per_loc_loss = tf.math.reduce_sum(_smooth_l1(regression_diff, sigma_squared), axis=1)
 
-        return weight * tf.math.reduce_sum(loss, axis=0)
+        return weight * _per_cls_normalize(per_loc_loss, classes, num_classes, tf.shape(y_true)[1])
 
     return _per_cls_l1
 
 
 def per_cls_l1_sym(num_classes=0, weight=1.0, sigma=3.0):
+    """ Create a smooth L1 loss over the symmetry hypotheses of the positive locations, normalized per class.
 
-    sigma_squared = sigma ** 2
-
-    def _per_cls_l1_sym(y_true, y_pred, hyp_mask):
-
-        regression_target = y_true[:, :, :, :, :-1]
-        anchor_state = y_true[:, :, :, :, -1]
+    Without a hypothesis mask the hypotheses are re-weighted towards the closest one and the mask of the closest
+    annotated hypothesis is returned, with a mask only the masked hypothesis contributes.
 
-        in_shape = tf.shape(regression_target)
-        anchor_state = tf.reshape(anchor_state, [in_shape[0] * in_shape[1], in_shape[2], in_shape[3]])
-        indices = tf.math.reduce_max(anchor_state, axis=[1, 2])
-        indices = tf.where(tf.math.equal(indices, 1))[:, 0]
-
-        if hyp_mask == None:
-            y_pred_res = tf.reshape(y_pred, [in_shape[0] * in_shape[1], in_shape[4]])
-        else:
-            y_pred_res = tf.reshape(y_pred, [in_shape[0] * in_shape[1], in_shape[2], in_shape[4]])
+    Args
+        num_classes: Number of object classes.
+        weight: Factor of the loss.
+        sigma: Point where the loss changes from L2 to L1.
 
-        regression = tf.gather(y_pred_res, indices, axis=0)
-        y_true_res = tf.reshape(regression_target, [in_shape[0] * in_shape[1], in_shape[2], in_shape[3], in_shape[4]])
-        regression_target = tf.gather(y_true_res, indices, axis=0)
+    Returns
+        A functor computing the loss and the hypothesis mask from the (P, 8, V) targets of all hypotheses, the
+        (P, V) predictions, the (P,) classes and (P, 8) symmetry mask of the positive locations and a (P, 8)
+        hypothesis mask or None.
+    """
+    sigma_squared = sigma ** 2
 
-        if hyp_mask == None:
-            regression = tf.transpose(regression, perm=[1, 0])
-        else:
-            regression = tf.transpose(regression, perm=[1, 2, 0])
-        regression_target = tf.transpose(regression_target, perm=[2, 1, 3, 0])
+    def _per_cls_l1_sym(y_true, y_pred, classes, symmetry_mask, hyp_mask):
+        regression_diff = keras.backend.abs(y_true - y_pred[:, tf.newaxis, :])
+        regression_loss = tf.math.reduce_sum(_smooth_l1(regression_diff, sigma_squared), axis=2)
 
-        # compute smooth L1 loss
-        # f(x) = 0.5 * (sigma * x)^2          if |x| < 1 / sigma / sigma
-        #        |x| - 0.5 / sigma / sigma    otherwise
-        regression_diff = regression_target - regression
-        regression_diff = keras.backend.abs(regression_diff)
-        regression_loss = backend.where(
-            keras.backend.less(regression_diff, 1.0 / sigma_squared),
-            0.5 * sigma_squared * keras.backend.pow(regression_diff, 2),
-            regression_diff - 0.5 / sigma_squared
-        )
-        # symmetry-handling by re-weighting
-        # loss:  [8 33 3 1067]
-        # anchor:  [25200 33 8]
-        # indices:  [1067]
-        # don't want sparse tensors
-        # L = 2 * l ((min+max) - x) * (1/(min+max))
-        regression_loss = tf.math.reduce_sum(regression_loss, axis=2)
-        if hyp_mask == None:
-            minmax = (tf.math.reduce_min(regression_loss, axis=0) + tf.math.reduce_max(regression_loss, axis=0))
+        if hyp_mask is None:
+            # symmetry-handling by re-weighting
+            # L = 2 * l ((min+max) - x) * (1/(min+max))
+            minmax = (tf.math.reduce_min(regression_loss, axis=1) + tf.math.reduce_max(regression_loss, axis=1))[:, tf.newaxis]
             scaler = (tf.math.divide_no_nan(1.0, minmax)) * (minmax - regression_loss)
             regression_loss = regression_loss * scaler * 2.0
-
-        regression_loss = tf.transpose(regression_loss, perm=[2, 1, 0])
-        anchor_anno = tf.gather(anchor_state, indices, axis=0)
-        pose_hyp_anno = tf.math.reduce_sum(anchor_anno, axis=2)
-        regression_loss = tf.where(tf.math.equal(anchor_anno, 1.0), regression_loss, 0.0)
-
-        if hyp_mask == None:
-            regression_loss = tf.math.reduce_sum(regression_loss, axis=2)
-            scaler = tf.transpose(scaler, perm=[2, 1, 0])
-            scaler_mask = tf.tile(tf.math.reduce_max(scaler, axis=2)[:, :, tf.newaxis], [1, 1, 8])
-            hyp_mask = tf.where(tf.math.equal(scaler, scaler_mask), 1.0, 0.0)
-            hyp_mask = tf.where(tf.math.equal(anchor_anno, 0.0), 0.0, hyp_mask)
-            #tf.print('scaler: ', tf.math.reduce_min(scaler), tf.math.reduce_max(scaler))
+            regression_loss = tf.where(tf.math.equal(symmetry_mask, 1.0), regression_loss, 0.0)
+            pose_hyp_anno = tf.math.reduce_sum(symmetry_mask, axis=1)
+
+            # select among the annotated hypotheses only, unannotated duplicates would otherwise win ties depending
+            # on the rounding of the batch and leave the location without a hypothesis
+            scaler = tf.where(tf.math.equal(symmetry_mask, 1.0), scaler, -1.0)
+            hyp_mask = tf.where(tf.math.equal(scaler, tf.math.reduce_max(scaler, axis=1, keepdims=True)), 1.0, 0.0)
+            hyp_mask = tf.where(tf.math.equal(symmetry_mask, 0.0), 0.0, hyp_mask)
         else:
             regression_loss = tf.where(tf.math.equal(hyp_mask, 1.0), regression_loss, 0.0)
-            regression_loss = tf.math.reduce_sum(regression_loss, axis=2)
-            pose_hyp_anno = tf.math.reduce_sum(hyp_mask, axis=2)
-
-        regression_loss = tf.math.divide_no_nan(regression_loss, pose_hyp_anno)
-
-        per_cls_loss = tf.math.reduce_sum(regression_loss, axis=0)
-        normalizer = tf.math.reduce_max(anchor_state, axis=2)
-        normalizer = tf.math.reduce_sum(normalizer, axis=0) * tf.cast(num_classes, dtype=tf.float32)
-        # * tf.cast(num_classes, dtype=tf.float32)
-        #* tf.cast(in_shape[4], dtype=tf.float32)  # accumulate over batch, locations and regressed values
-        loss = tf.math.divide_no_nan(per_cls_loss, normalizer)
-
-        #tf.print('per_cls_loss: ', per_cls_loss)
-        #tf.print('normalizer: ', normalizer)
+            pose_hyp_anno = tf.math.reduce_sum(hyp_mask, axis=1)
 
-        #vanilla best sym_hyp
-        #regression_loss = tf.math.reduce_min(regression_loss, axis=0) # reduce regression loss to min hypothesis
-        #per_cls_loss = tf.math.reduce_sum(regression_loss, axis=1)
+        per_loc_loss = tf.math.divide_no_nan(tf.math.reduce_sum(regression_loss, axis=1), pose_hyp_anno)
 
-        #anchor_anno = tf.math.reduce_max(anchor_state, axis=2)
-        #anchor_anno = tf.gather(anchor_anno, indices, axis=0)
-        #anchor_anno = tf.transpose(anchor_anno, perm=[1, 0])
-
-        #regression_loss = tf.where(tf.math.equal(anchor_anno, 1), per_cls_loss, 0.0)
-        #per_cls_loss = tf.math.reduce_sum(regression_loss, axis=1)
-
-        # comp norm per class
-        #normalizer = tf.math.reduce_max(anchor_state, axis=2) # reduce normalizer to single hypothesis per location
-        #normalizer = tf.math.reduce_sum(normalizer, axis=0) * tf.cast(in_shape[4], dtype=tf.float32) # accumulate over batch, locations and regressed values
-        #loss = tf.math.divide_no_nan(per_cls_loss, normalizer) # normalize per cls separately
-
-        return weight * tf.math.reduce_sum(loss, axis=0), hyp_mask
+        return weight * _per_cls_normalize(per_loc_loss, classes, num_classes, num_classes), hyp_mask
 
     return _per_cls_l1_sym
 
 
 def per_cls_l1_rep(num_classes=0, weight=1.0, sigma=3.0):
+    """ Create a smooth L1 loss of the reprojected 3D boxes against the hypotheses selected by a hypothesis mask.
 
-    sigma_squared = sigma ** 2
-
-    def _per_cls_l1_rep(y_true, y_pred, hyp_mask):
-
-        regression_target = y_true[:, :, :, :, :-1]
-        anchor_state = y_true[:, :, :, :, -1]
-
-        in_shape = tf.shape(regression_target)
-        anchor_state = tf.reshape(anchor_state, [in_shape[0] * in_shape[1], in_shape[2], in_shape[3]])
-        indices = tf.math.reduce_max(anchor_state, axis=[1, 2])
-        indices = tf.where(tf.math.equal(indices, 1))[:, 0]
+    Args
+        num_classes: Number of object classes.
+        weight: Factor of the loss.
+        sigma: Point where the loss changes from L2 to L1.
 
-        y_pred_res = tf.reshape(y_pred, [in_shape[0] * in_shape[1], in_shape[2], in_shape[4]])
-        regression = tf.gather(y_pred_res, indices, axis=0)
-        y_true_res = tf.reshape(regression_target, [in_shape[0] * in_shape[1], in_shape[2], in_shape[3], in_shape[4]])
-        regression_target = tf.gather(y_true_res, indices, axis=0)
+    Returns
+        A functor computing the loss from the (P, 8, 16) 3D box targets of all hypotheses, the (P, 16) reprojected
+        boxes, the (P,) classes and the (P, 8) hypothesis mask of the positive locations.
+    """
+    sigma_squared = sigma ** 2
 
-        regression = tf.transpose(regression, perm=[1, 2, 0])
-        regression_target = tf.transpose(regression_target, perm=[2, 1, 3, 0])
-
-        # compute smooth L1 loss
-        # f(x) = 0.5 * (sigma * x)^2          if |x| < 1 / sigma / sigma
-        #        |x| - 0.5 / sigma / sigma    otherwise
-        regression_diff = regression_target - regression
-        regression_diff = keras.backend.abs(regression_diff)
-        regression_loss = backend.where(
-            keras.backend.less(regression_diff, 1.0 / sigma_squared),
-            0.5 * sigma_squared * keras.backend.pow(regression_diff, 2),
-            regression_diff - 0.5 / sigma_squared
-        )
-        # symmetry-handling by re-weighting
-        # loss:  [8 33 3 1067]
-        # anchor:  [25200 33 8]
-        # indices:  [1067]
-        # don't want sparse tensors
-        # L = 2 * l ((min+max) - x) * (1/(min+max))
-        regression_loss = tf.math.reduce_sum(regression_loss, axis=2)
-
-        regression_loss = tf.transpose(regression_loss, perm=[2, 1, 0])
-        anchor_anno = tf.gather(anchor_state, indices, axis=0)
-        regression_loss = tf.where(tf.math.equal(anchor_anno, 1.0), regression_loss, 0.0)
+    def _per_cls_l1_rep(y_true, y_pred, classes, hyp_mask):
+        regression_diff = keras.backend.abs(y_true - y_pred[:, tf.newaxis, :])
+        regression_loss = tf.math.reduce_sum(_smooth_l1(regression_diff, sigma_squared), axis=2)
 
         regression_loss = tf.where(tf.math.equal(hyp_mask, 1.0), regression_loss, 0.0)
-        regression_loss = tf.math.reduce_sum(regression_loss, axis=2)
-        pose_hyp_anno = tf.math.reduce_sum(hyp_mask, axis=2)
-
-        regression_loss = tf.math.divide_no_nan(regression_loss, pose_hyp_anno)
-
-        per_cls_loss = tf.math.reduce_sum(regression_loss, axis=0)
-        normalizer = tf.math.reduce_max(anchor_state, axis=2)
-        normalizer = tf.math.reduce_sum(normalizer, axis=0) * tf.cast(num_classes, dtype=tf.float32)
-
-        loss = tf.math.divide_no_nan(per_cls_loss, normalizer)
+        pose_hyp_anno = tf.math.reduce_sum(hyp_mask, axis=1)
+        per_loc_loss = tf.math.divide_no_nan(tf.math.reduce_sum(regression_loss, axis=1), pose_hyp_anno)
 
-        return weight * tf.math.reduce_sum(loss, axis=0)
+        return weight * _per_cls_normalize(per_loc_loss, classes, num_classes, num_classes)
 
     return _per_cls_l1_rep
 
 
 def projection_deviation(num_classes=0, weight=1.0, sigma=3.0):
+    """ Create a smooth L1 loss on the deviation between the regressed and the reprojected 3D boxes.
 
-    sigma_squared = sigma ** 2
-
-    def _projection_deviation(y_true, y_pred):
-
-        in_shape_gt = tf.shape(y_true)
-        in_shape_es = tf.shape(y_pred)
-        anchor_state = tf.reshape(y_true, [in_shape_gt[0] * in_shape_gt[1], in_shape_gt[2]])
-        indices = tf.math.reduce_max(anchor_state, axis=1)
-        indices = tf.where(tf.math.equal(indices, 1))[:, 0]
-
-        regression = tf.reshape(y_pred, [in_shape_es[0] * in_shape_es[1], in_shape_es[2], in_shape_es[3]])
-        regression = tf.gather(regression, indices, axis=0)
-
-        #regression_diff = keras.backend.abs(regression) #* 0.01
-        regression_diff = regression
-        regression_loss = backend.where(
-            keras.backend.less(regression_diff, 1.0 / sigma_squared),
-            0.5 * sigma_squared * keras.backend.pow(regression_diff, 2),
-            regression_diff - 0.5 / sigma_squared
-        )
-        per_loc_loss = tf.math.reduce_sum(regression_loss, axis=2) # accumulate over points
-
-        anchor_anno = tf.gather(anchor_state, indices, axis=0)
-        regression_loss = tf.where(tf.math.equal(anchor_anno, 1), per_loc_loss, 0.0)
+    Args
+        num_classes: Number of object classes.
+        weight: Factor of the loss.
+        sigma: Point where the loss changes from L2 to L1.
 
-        # comp norm per class
-        normalizer = tf.math.reduce_sum(anchor_state, axis=0) * tf.cast(num_classes, dtype=tf.float32)
-        per_cls_loss = tf.math.reduce_sum(regression_loss, axis=[0])
+    Returns
+        A functor computing the loss from the (P, 16) absolute deviations and the (P,) classes of the positive
+        locations.
+    """
+    sigma_squared = sigma ** 2
 
-        loss = tf.math.divide_no_nan(per_cls_loss, normalizer)
+    def _projection_deviation(y_pred, classes):
+        per_loc_loss = tf.math.reduce_sum(_smooth_l1(y_pred, sigma_squared), axis=1) # accumulate over points
 
-        return weight * tf.math.reduce_sum(loss, axis=0)
+        return weight * _per_cls_normalize(per_loc_loss, classes, num_classes, num_classes)
 
     return _projection_deviation
 
+
 '''
 def projection_deviation(num_classes=0, weight=1.0, sigma=3.0):
 
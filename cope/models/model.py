@@ -46,7 +46,7 @@ def default_classification_model(
     if keras.backend.image_data_format() == 'channels_first':
         labels = keras.layers.Permute((2, 3, 1))(labels)
     labels = keras.layers.Reshape((-1, num_classes))(labels)
-    labels = keras.layers.Activation('sigmoid')(labels)
+    labels = keras.layers.Activation('sigmoid', dtype='float32')(labels)
 
     # cent = keras.layers.Conv2D(
     #    filters=1,
@@ -116,10 +116,11 @@ def default_pose_model(num_classes):
     outputs = keras.layers.Reshape((-1, num_classes * 16))(outputs)
     outputs = keras.layers.Conv1D(filters=512, activation=tfa.activations.mish, **options)(outputs)
     outputs = keras.layers.Conv1D(filters=256, activation=tfa.activations.mish, **options)(outputs)
-    translations = keras.layers.Conv1D(num_classes * 3, **options)(outputs)
-    translations = keras.layers.Reshape((-1, num_classes, 3))(translations)
-    rotations = keras.layers.Conv1D(num_classes * 6, **options)(outputs)
-    rotations = keras.layers.Reshape((-1, num_classes, 6))(rotations)
+    # the pose outputs and the normalization of the rotations stay in float32 under mixed precision
+    translations = keras.layers.Conv1D(num_classes * 3, dtype='float32', **options)(outputs)
+    translations = keras.layers.Reshape((-1, num_classes, 3), dtype='float32')(translations)
+    rotations = keras.layers.Conv1D(num_classes * 6, dtype='float32', **options)(outputs)
+    rotations = keras.layers.Reshape((-1, num_classes, 6), dtype='float32')(rotations)
 
     # translations = tf.concat(translations, axis=2)
     # rotations = tf.concat(rotations, axis=2)
@@ -184,11 +185,9 @@ def cope(
         create_pyramid_features=__create_PFPN,
         name='cope'
 ):
-    fx, fy, cx, cy = tf.split(inputs[1], num_or_size_splits=4, axis=1)
-    fx = tf.squeeze(fx, axis=1)
-    fy = tf.squeeze(fy, axis=1)
-    cx = tf.squeeze(cx, axis=1)
-    cy = tf.squeeze(cy, axis=1)
+    # per image focal lengths and principal point, shaped to broadcast against (batch, locations, classes, points, xy)
+    focal_length = inputs[1][:, tf.newaxis, tf.newaxis, tf.newaxis, :2]
+    principal_point = inputs[1][:, tf.newaxis, tf.newaxis, tf.newaxis, 2:]
 
     regression_branch = default_regression_model(16)
     detections_branch = default_regression_model(4)
@@ -198,41 +197,37 @@ def cope(
     b1, b2, b3 = backbone_layers
     P3, P4, P5 = create_pyramid_features(b1, b2, b3)
 
+    # the heads run in the compute dtype of the global policy, their outputs and the reprojection onto the
+    # image are computed in float32
     pyramids = []
     regression_P3 = regression_branch(P3)
     regression_P4 = regression_branch(P4)
     regression_P5 = regression_branch(P5)
-    regression = keras.layers.Concatenate(axis=1, name='pts')([regression_P3, regression_P4, regression_P5])
+    regression = keras.layers.Concatenate(axis=1, name='pts', dtype='float32')([regression_P3, regression_P4, regression_P5])
     pyramids.append(regression)
 
     detections_P3 = detections_branch(P3)
     detections_P4 = detections_branch(P4)
     detections_P5 = detections_branch(P5)
-    detections = keras.layers.Concatenate(axis=1, name='box')([detections_P3, detections_P4, detections_P5])
+    detections = keras.layers.Concatenate(axis=1, name='box', dtype='float32')([detections_P3, detections_P4, detections_P5])
     pyramids.append(detections)
 
     location_P3 = location_branch(P3)
     location_P4 = location_branch(P4)
     location_P5 = location_branch(P5)
-    pyramids.append(keras.layers.Concatenate(axis=1, name='cls')([location_P3, location_P4, location_P5]))
-
-    location_coordinates = layers.Locations_Hacked(name='denorm_locations')(P3)
-    locations_tiled = tf.tile(tf.expand_dims(location_coordinates, axis=2, name='locations_expanded'),
-                              [1, 1, num_classes, 1])
-    rep_object_diameters = tf.tile(obj_diameters[tf.newaxis, tf.newaxis, :, tf.newaxis], [1, 6300, 1, 16])
-
-    regression_tiled = tf.tile(tf.expand_dims(regression, axis=2, name='regression_expanded'), [1, 1, num_classes, 1],
-                               name='regression_tiled')
-    regression_tiled = regression_tiled * rep_object_diameters
-
-    destd_boxes = layers.DenormRegression(name='DenormRegression')([regression_tiled, locations_tiled])
-    destd_boxes = tf.transpose(destd_boxes, perm=[1, 2, 3, 0])
-    destd_boxes_x = tf.math.subtract(destd_boxes[:, :, ::2, :], cx)
-    destd_boxes_y = tf.math.subtract(destd_boxes[:, :, 1::2, :], cy)
-    destd_boxes_x = tf.transpose(destd_boxes_x, perm=[3, 0, 1, 2])
-    destd_boxes_y = tf.transpose(destd_boxes_y, perm=[3, 0, 1, 2])
-    destd_boxes = tf.concat([destd_boxes_x[:, :, :, :, tf.newaxis], destd_boxes_y[:, :, :, :, tf.newaxis]], axis=4)
-    destd_boxes = tf.reshape(destd_boxes, shape=[tf.shape(regression)[0], tf.shape(regression)[1], num_classes, 16]) * 0.01 # factor for scaling
+    pyramids.append(keras.layers.Concatenate(axis=1, name='cls', dtype='float32')([location_P3, location_P4, location_P5]))
+
+    # the class axis is added by broadcasting, none of the per class inputs are tiled
+    location_coordinates = layers.Locations_Hacked(name='denorm_locations', dtype='float32')(P3)
+    location_coordinates = location_coordinates[:, :, tf.newaxis, :]
+    object_diameters = obj_diameters[tf.newaxis, tf.newaxis, :, tf.newaxis]
+    batch_size = tf.shape(regression)[0]
+    num_locations = tf.shape(regression)[1]
+
+    regression_scaled = regression[:, :, tf.newaxis, :] * object_diameters
+    destd_boxes = layers.DenormRegression(name='DenormRegression', dtype='float32')([regression_scaled, location_coordinates])
+    destd_boxes = tf.reshape(destd_boxes, shape=[batch_size, num_locations, num_classes, 8, 2]) - principal_point
+    destd_boxes = tf.reshape(destd_boxes, shape=[batch_size, num_locations, num_classes, 16]) * 0.01 # factor for scaling
 
     location = pose_branch[1](destd_boxes)
     rotation = pose_branch[0](destd_boxes)
@@ -243,7 +238,6 @@ def cope(
     y = location[:, :, :, 1] * 500.0
     z = ((location[:, :, :, 2] * (1 / 3)) + 1.0) * 1000.0
     trans = tf.stack([x, y, z], axis=3)
-    trans = tf.tile(trans[:, :, :, tf.newaxis, :], [1, 1, 1, 8, 1])
 
     r1 = rotation[:, :, :, :3]
     r2 = rotation[:, :, :, 3:]
@@ -251,42 +245,27 @@ def cope(
     r3 = tf.math.l2_normalize(r3, axis=3)
     rot = tf.stack([r1, r2, r3], axis=4)
 
-    rep_obj_correspondences = tf.tile(obj_correspondences[tf.newaxis, tf.newaxis, :, :, :], [tf.shape(location)[0], tf.shape(location)[1], 1, 1, 1])
-    box3d = tf.linalg.matmul(rot, rep_obj_correspondences, transpose_a=False, transpose_b=True)
-    box3d = tf.transpose(box3d, perm=[0, 1, 2, 4, 3])
-    box3d = tf.math.add(box3d, trans)
-
-    box3d = tf.transpose(box3d, perm=[1, 2, 3, 4, 0])
-    projected_boxes_x = box3d[:, :, :, 0, :] * fx
-    projected_boxes_x = tf.math.divide_no_nan(projected_boxes_x, box3d[:, :, :, 2, :])
-    projected_boxes_x = tf.transpose(projected_boxes_x, perm=[3, 0, 1, 2])
-    projected_boxes_y = box3d[:, :, :, 1, :] * fy
-    projected_boxes_y = tf.math.divide_no_nan(projected_boxes_y, box3d[:, :, :, 2, :])
-    projected_boxes_y = tf.transpose(projected_boxes_y, perm=[3, 0, 1, 2])
-    pro_boxes = tf.stack([projected_boxes_x, projected_boxes_y], axis=4)
-    pro_boxes = tf.reshape(pro_boxes, shape=[tf.shape(location)[0], tf.shape(location)[1], num_classes, 16]) * 0.01 # factor for scaling
+    # rotate the correspondences of every class, (batch, locations, classes, 8, 3)
+    box3d = tf.einsum('blcij,ckj->blcki', rot, obj_correspondences)
+    box3d = tf.math.add(box3d, trans[:, :, :, tf.newaxis, :])
+
+    projected_boxes = tf.math.divide_no_nan(box3d[:, :, :, :, :2] * focal_length, box3d[:, :, :, :, 2:])
+    pro_boxes = tf.reshape(projected_boxes, shape=[batch_size, num_locations, num_classes, 16]) * 0.01 # factor for scaling
 
     #discrepancy = tf.concat([destd_boxes, pro_boxes], axis=3)
     discrepancy = destd_boxes - pro_boxes
     discrepancy = tf.math.abs(discrepancy)
 
-    rename_layer = keras.layers.Lambda(lambda x: x, name='con')
+    rename_layer = keras.layers.Lambda(lambda x: x, name='con', dtype='float32')
     consistency = rename_layer(discrepancy)
     pyramids.append(consistency)
 
     # standardized reprojection
-    projected_boxes_y = tf.transpose(projected_boxes_y, perm=[1, 2, 3, 0])
-    projected_boxes_x = tf.transpose(projected_boxes_x, perm=[1, 2, 3, 0])
-    projected_boxes_y = tf.math.add(projected_boxes_y, cy)
-    projected_boxes_x = tf.math.add(projected_boxes_x, cx)
-    projected_boxes_y = tf.transpose(projected_boxes_y, perm=[3, 0, 1, 2])
-    projected_boxes_x = tf.transpose(projected_boxes_x, perm=[3, 0, 1, 2])
-    projection = tf.stack([projected_boxes_x, projected_boxes_y], axis=4)
-    projection = tf.reshape(projection, shape=[tf.shape(location)[0], tf.shape(location)[1], num_classes, 16])
-    projection= layers.NormRegression(name='NormProjection')([projection, locations_tiled])
-    projection = tf.math.divide_no_nan(projection, rep_object_diameters)
-
-    rename_layer_2 = keras.layers.Lambda(lambda x: x, name='pro')
+    projection = tf.reshape(projected_boxes + principal_point, shape=[batch_size, num_locations, num_classes, 16])
+    projection = layers.NormRegression(name='NormProjection', dtype='float32')([projection, location_coordinates])
+    projection = tf.math.divide_no_nan(projection, object_diameters)
+
+    rename_layer_2 = keras.layers.Lambda(lambda x: x, name='pro', dtype='float32')
     projection2img = rename_layer_2(projection)
 
     pyramids.append(projection2img)
@@ -311,6 +290,7 @@ def inference_model(
         pose_hyps=10,
         iou_threshold=0.5,
         max_detections=100,
+        max_candidates=1000,
         **kwargs
 ):
     if model is None:
@@ -333,16 +313,16 @@ def inference_model(
     rotations = model.outputs[4]
     consistency = model.outputs[5]
 
-    tf_diameter = tf.convert_to_tensor(object_diameters)
-    rep_object_diameters = tf.tile(tf_diameter[tf.newaxis, tf.newaxis, :], [tf.shape(regression)[0], tf.shape(regression)[1], 1])
-    rep_regression = tf.tile(regression[:, :, tf.newaxis, :], [1, 1, num_classes, 1])
-    rep_locations = tf.tile(locations[:, :, tf.newaxis, :], [1, 1, num_classes, 1])
-    rep_detections = tf.tile(detections[:, :, tf.newaxis, :], [1, 1, num_classes, 1])
+    # regression, detections and locations are shared by all classes and broadcast against the class diameters
+    tf_diameter = tf.convert_to_tensor(object_diameters, dtype=tf.float32)
+    rep_regression = regression[:, :, tf.newaxis, :]
+    rep_locations = locations[:, :, tf.newaxis, :]
+    rep_detections = detections[:, :, tf.newaxis, :]
 
     poses = tf.concat([translations, rotations], axis=3)
     poses = layers.DenormPoses(name='poses_world')(poses)
-    boxes3D = layers.RegressBoxes3D(name='boxes3D')([rep_regression, rep_locations, rep_object_diameters])
-    boxes = layers.RegressBoxes(name='boxes')([rep_detections, rep_locations, rep_object_diameters])
+    boxes3D = layers.RegressBoxes3D(name='boxes3D')([rep_regression, rep_locations, tf_diameter])
+    boxes = layers.RegressBoxes(name='boxes')([rep_detections, rep_locations, tf_diameter])
 
     consistency = tf.math.reduce_sum(consistency, axis=3)
 
@@ -350,6 +330,7 @@ def inference_model(
         name='filtered_detections',
         score_threshold=score_threshold,
         max_detections=max_detections,
+        max_candidates=max_candidates,
         num_classes=num_classes,
         pose_hyps=pose_hyps,
         iou_threshold=iou_threshold,
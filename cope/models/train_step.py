@@ -1,6 +1,62 @@
 import tensorflow.keras as keras
 import tensorflow as tf
 
+from ..losses import gather_targets, cross_replica_sum, slice_targets, record_normalizers, fixed_normalizers
+from ..utils.anchors import locations_for_shape
+
+
+class StepTimer:
+    """ Measures the duration of the stages of a train step inside the traced graph.
+
+    Every stage runs after the previous one has finished, its duration is the time between the timestamp taken
+    once its outputs are computed and the timestamp of the previous stage. Stages called within a stage belong to it
+    and are not timed on their own. Disabled timers call the stages unchanged.
+
+    Args
+        enabled: Whether the stages are timed.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.durations = {}
+        self.last = None
+        self.in_stage = False
+
+    def start(self, *tensors):
+        """ Take the first timestamp once tensors are available, returns it or None when disabled.
+        """
+        if not self.enabled:
+            return None
+        self.last = self._timestamp(tensors)
+        return self.last
+
+    def __call__(self, name, function, *args):
+        """ Call function(*args) as the stage name, the durations of stages with the same name are summed.
+        """
+        if not self.enabled or self.in_stage:
+            return function(*args)
+        self.in_stage = True
+        try:
+            with tf.control_dependencies([self.last]):
+                outputs = function(*args)
+        finally:
+            self.in_stage = False
+        now = self._timestamp(outputs)
+        self.durations[name] = self.durations.get(name, 0.0) + (now - self.last)
+        self.last = now
+        return outputs
+
+    @staticmethod
+    def _timestamp(tensors):
+        # a control dependency on device ops only waits for their kernels to be launched, copying a reduction of
+        # every output to the host waits until they are computed
+        ready = [tf.reduce_sum(tf.cast(tensor, tf.float32)) for tensor in tf.nest.flatten(tensors, expand_composites=True)
+                 if tensor is not None]
+        with tf.device('/cpu:0'):
+            ready = [tf.identity(value) for value in ready]
+            with tf.control_dependencies(ready):
+                return tf.timestamp()
+
 
 class CustomModel(tf.keras.Model):
     def __init__(self, model):
@@ -14,45 +70,173 @@ class CustomModel(tf.keras.Model):
         self.rotations_tracker = tf.keras.metrics.Mean()
         self.consistency_tracker = tf.keras.metrics.Mean()
         self.projection_tracker = tf.keras.metrics.Mean()
+        # every replica returns the losses of the global batch, the logs must not be summed over the replicas again
+        self.distribute_reduction_method = 'first'
+        # set before the train function is traced to record the duration of the stages of every step, see StepProfiler
+        self.profile_step = False
 
-    def compile(self, optimizer, loss, **kwargs):
+    def compile(self, optimizer, loss, jit_compile=False, accumulation_steps=1, **kwargs):
         super(CustomModel, self).compile(**kwargs)
+        # every batch is split into accumulation_steps micro-batches, the optimizer is applied once per batch
+        self.accumulation_steps = accumulation_steps
+        # the forward and backward pass of the model are compiled with XLA, target densification and the losses
+        # gather the positive locations with data dependent shapes and run outside of the compiled cluster
+        if jit_compile:
+            self.forward = tf.function(lambda inputs: self.model(inputs, training=True), jit_compile=True)
+        else:
+            self.forward = self.model
+        # float16 gradients underflow without loss scaling, bfloat16 has the exponent range of float32 and needs none
+        if self.compute_dtype == 'float16' and not isinstance(optimizer, keras.mixed_precision.LossScaleOptimizer):
+            optimizer = keras.mixed_precision.LossScaleOptimizer(optimizer)
         self.optimizer = optimizer
         self.loss = loss
+        # start of the last step and the duration of its stages, the first replica writes them when profile_step is set
+        self.step_timing_names = (['normalizers'] if accumulation_steps > 1 else []) + ['forward', 'targets'] + list(loss) + ['backward']
+        self.step_timings = tf.Variable(tf.zeros(len(self.step_timing_names) + 1, dtype=tf.float64), trainable=False,
+                                        synchronization=tf.VariableSynchronization.ON_READ,
+                                        aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA)
 
-    @tf.function
-    def train_step(self, data):
+    def compute_losses(self, y, predicts, locations, batch_size, timer):
+        """ Evaluate the losses in the order of self.loss.
 
-        x, intri, y = data
+        The locations with pose supervision are found once per batch, the targets and predictions are gathered at
+        them into compact tensors and every regression loss is evaluated on those. Only the classification loss
+        covers all locations.
+
+        Args
+            y: The sparse targets as returned by anchors.anchor_targets_sparse.
+            predicts: The outputs of the model.
+            locations: (num_locations, 2) image coordinates of all locations.
+            batch_size: Number of images in the batch.
+            timer: StepTimer of the step.
+
+        Returns
+            A list with the value of every loss.
+        """
+        positive_indices, symmetry_mask, targets = timer('targets', gather_targets, y, locations, batch_size, predicts[2].shape[-1])
+        regression, detections, labels, translations, rotations = targets
+        classes = positive_indices[:, 2]
 
-        loss_names = []
         losses = []
-        loss_sum = 0
-        pose_mask = None
-        keypoints_gt = None
+        hyp_mask = None
+
+        for ldx, loss_func in enumerate(self.loss):
+            # the 3D and 2D box regression are class agnostic, the pose heads predict every class
+            if loss_func in ['pts', 'box']:
+                y_pred = tf.gather_nd(predicts[ldx], positive_indices[:, :2])
+            elif loss_func != 'cls':
+                y_pred = tf.gather_nd(predicts[ldx], positive_indices)
+
+            if loss_func == 'pts':
+                args = (regression, y_pred, classes, symmetry_mask, hyp_mask)
+            elif loss_func == 'box':
+                args = (detections, y_pred, classes)
+            elif loss_func == 'cls':
+                args = (labels, predicts[ldx])
+            elif loss_func == 'tra':
+                args = (translations, y_pred, classes)
+            elif loss_func == 'rot':
+                args = (rotations, y_pred, classes, symmetry_mask, hyp_mask)
+            elif loss_func == 'con':
+                args = (y_pred, classes)
+            elif loss_func == 'pro':
+                args = (regression, y_pred, classes, hyp_mask)
+
+            loss = timer(loss_func, self.loss[loss_func], *args)
+            if loss_func == 'pts':
+                loss, hyp_mask = loss
+            elif loss_func == 'rot':
+                loss, _ = loss
+
+            losses.append(loss)
 
+        return losses
+
+    def compute_gradients(self, x, intri, y, timer):
+        """ Gradients of the summed losses with respect to the trainable weights of the model, timed by timer.
+
+        Returns
+            The gradients and the list of losses.
+        """
         with tf.GradientTape() as tape:
-            predicts = self.model((x, intri))
-            for ldx, loss_func in enumerate(self.loss):
-                loss_names.append(loss_func)
-                if loss_func != 'pro':
-                    y_now = tf.convert_to_tensor(y[ldx], dtype=tf.float32)
-                if loss_func == 'pts':
-                    keypoints_gt = y_now
-                    loss, pose_mask = self.loss[loss_func](y_now, predicts[ldx], pose_mask)
-                elif loss_func == 'rot':
-                    loss, _ = self.loss[loss_func](y_now, predicts[ldx], pose_mask)
-                elif loss_func == 'pro':
-                    loss = self.loss[loss_func](keypoints_gt, predicts[ldx], pose_mask)
-                else:
-                    loss = self.loss[loss_func](y_now, predicts[ldx])
-
-                losses.append(loss)
+            predicts = timer('forward', self.forward, (x, intri))
+            losses = self.compute_losses(y, predicts, locations_for_shape(x.shape[1:3]), tf.shape(x)[0], timer)
+            loss_sum = 0
+            for loss in losses:
                 loss_sum += loss
 
-        grads = tape.gradient(loss_sum, self.model.trainable_weights)
+            # dynamic loss scaling, the scale is reduced and the step skipped when the gradients overflow
+            scaled_loss = loss_sum
+            if isinstance(self.optimizer, keras.mixed_precision.LossScaleOptimizer):
+                scaled_loss = self.optimizer.get_scaled_loss(loss_sum)
+
+        grads = timer('backward', tape.gradient, scaled_loss, self.model.trainable_weights)
+        if isinstance(self.optimizer, keras.mixed_precision.LossScaleOptimizer):
+            grads = self.optimizer.get_unscaled_gradients(grads)
+        return grads, losses
+
+    def accumulate_gradients(self, x, intri, y, timer):
+        """ Sum the gradients of the micro-batches of a batch, timed by timer.
+
+        The losses are normalized per class by the number of annotated locations of the whole batch. The normalizers
+        of all micro-batches are summed in a first pass over the targets, the second pass normalizes the losses of
+        every micro-batch by these totals, so the accumulated gradients equal the gradients of the whole batch.
+
+        Returns
+            The accumulated gradients and the list of losses of the whole batch.
+        """
+        # the batch dimension of distributed datasets is not static
+        if x.shape[0] is not None and x.shape[0] % self.accumulation_steps != 0:
+            raise ValueError('The batch size {} is not divisible into {} micro-batches.'.format(x.shape[0], self.accumulation_steps))
+        micro_batch_size = tf.shape(x)[0] // self.accumulation_steps
+        locations = locations_for_shape(x.shape[1:3])
+        micro_batches = []
+        for step in range(self.accumulation_steps):
+            start = step * micro_batch_size
+            micro_batches.append((x[start:start + micro_batch_size], intri[start:start + micro_batch_size], slice_targets(y, start, micro_batch_size)))
+
+        # the normalizers depend on the targets only, the losses are evaluated on zeros and all but the normalizers
+        # is pruned from the graph; the micro-batches run one after the other to bound the memory of the targets
+        def sum_normalizers():
+            totals = []
+            for _, _, y_micro in micro_batches:
+                with tf.control_dependencies(totals), record_normalizers() as normalizers:
+                    zeros = [tf.zeros([micro_batch_size] + output.shape[1:].as_list(), dtype=output.dtype) for output in self.model.outputs]
+                    self.compute_losses(y_micro, zeros, locations, micro_batch_size, timer)
+                totals = normalizers if not totals else [total + normalizer for total, normalizer in zip(totals, normalizers)]
+            return totals
+
+        totals = [cross_replica_sum(total) for total in timer('normalizers', sum_normalizers)]
+
+        grads, losses = None, None
+        for x_micro, intri_micro, y_micro in micro_batches:
+            with tf.control_dependencies([grad for grad in grads or [] if grad is not None]), fixed_normalizers(totals):
+                micro_grads, micro_losses = self.compute_gradients(x_micro, intri_micro, y_micro, timer)
+            if grads is None:
+                grads, losses = micro_grads, micro_losses
+            else:
+                grads = [None if grad is None else grad + micro_grad for grad, micro_grad in zip(grads, micro_grads)]
+                losses = [loss + micro_loss for loss, micro_loss in zip(losses, micro_losses)]
+        return grads, losses
+
+    # traced by Model.make_train_function, a nested tf.function would keep the losses from all-reducing across replicas
+    def train_step(self, data):
+
+        x, intri, y = data
+        # every replica runs train_step in its own thread, the timer must not be shared through the model
+        timer = StepTimer(self.profile_step)
+        start = timer.start(x, intri)
+
+        if self.accumulation_steps > 1:
+            grads, losses = self.accumulate_gradients(x, intri, y, timer)
+        else:
+            grads, losses = self.compute_gradients(x, intri, y, timer)
         self.optimizer.apply_gradients(zip(grads, self.model.trainable_weights))
 
+        # under a tf.distribute strategy every replica holds its part of the loss of the global batch
+        losses = tf.unstack(cross_replica_sum(tf.stack(losses)))
+        loss_sum = tf.math.add_n(losses)
+
         self.loss_tracker.update_state(loss_sum)
         self.points_tracker.update_state(losses[0])
         self.box_tracker.update_state(losses[1])
@@ -62,6 +246,9 @@ class CustomModel(tf.keras.Model):
         self.consistency_tracker.update_state(losses[5])
         self.projection_tracker.update_state(losses[6])
 
+        if self.profile_step:
+            self.step_timings.assign(tf.stack([start] + [timer.durations[name] for name in self.step_timing_names]))
+
         return {"loss": self.loss_tracker.result(), "pts": self.points_tracker.result(), "box": self.box_tracker.result(), "cls": self.cls_tracker.result(), "tra": self.translations_tracker.result(), "rot": self.rotations_tracker.result(), "pro": self.projection_tracker.result(), "con": self.consistency_tracker.result()}
 
 
@@ -49,6 +49,7 @@ from ..utils.image import (
     read_image_bgr,
     augment_image
 )
+from ..utils.object_catalog import ObjectCatalog
 from ..utils.transform import transform_aabb, random_transform_generator
 
 
@@ -91,7 +92,6 @@ class CustomDataset(tf.data.Dataset):
         set_name = set_name.decode("utf-8")
         batch_size = batch_size
         path = os.path.join(data_dir, 'annotations', 'instances_' + set_name + '.json')
-        mesh_info = os.path.join(data_dir, 'annotations', 'models_info' + '.json')
 
         with open(path, 'r') as js:
             data = json.load(js)
@@ -124,51 +124,6 @@ class CustomDataset(tf.data.Dataset):
         classes, labels, labels_inverse, labels_rev = load_classes(cats)
         num_classes = len(classes)
 
-        # load 3D boxes
-        TDboxes = np.ndarray((num_classes + 1, 8, 3), dtype=np.float32)
-        sphere_diameters = np.ndarray((num_classes + 1), dtype=np.float32)
-        sym_cont = np.zeros((num_classes + 1, 2, 3), dtype=np.float32)
-        sym_disc = np.zeros((num_classes + 1, 8, 16), dtype=np.float32)
-
-        for key, value in json.load(open(mesh_info)).items():
-            x_minus = value['min_x']
-            y_minus = value['min_y']
-            z_minus = value['min_z']
-            x_plus = value['size_x'] + x_minus
-            y_plus = value['size_y'] + y_minus
-            z_plus = value['size_z'] + z_minus
-            norm_pts = np.linalg.norm(np.array([value['size_x'], value['size_y'], value['size_z']]))
-            #x_plus = (value['size_x'] / norm_pts) * (value['diameter'] * 0.5)
-            #y_plus = (value['size_y'] / norm_pts) * (value['diameter'] * 0.5)
-            #z_plus = (value['size_z'] / norm_pts) * (value['diameter'] * 0.5)
-            #x_minus = x_plus * -1.0
-            #y_minus = y_plus * -1.0
-            #z_minus = z_plus * -1.0
-            three_box_solo = np.array([[x_plus, y_plus, z_plus],
-                                       [x_plus, y_plus, z_minus],
-                                       [x_plus, y_minus, z_minus],
-                                       [x_plus, y_minus, z_plus],
-                                       [x_minus, y_plus, z_plus],
-                                       [x_minus, y_plus, z_minus],
-                                       [x_minus, y_minus, z_minus],
-                                       [x_minus, y_minus, z_plus]])
-            TDboxes[int(key), :, :] = three_box_solo
-            #sphere_diameters[int(key)] = value['diameter']
-            sphere_diameters[int(key)] = norm_pts
-
-            if 'symmetries_discrete' in value:
-                for sdx, sym in enumerate(value['symmetries_discrete']):
-                    sym_disc[int(key), sdx, :] = np.array(sym)
-                    sym_disc[int(key), sdx, [3, 7, 11]] *= 0.001
-            #else:
-                #sym_disc[int(key), :, :] = np.repeat(np.eye((4)).reshape(16)[np.newaxis, :], repeats=3, axis=0)  # np.zeros((3, 16))
-
-            if "symmetries_continuous" in value:
-                sym_cont[int(key), 0, :] = np.array(value['symmetries_continuous'][0]['axis'], dtype=np.float32)
-                sym_cont[int(key), 1, :] = np.array(value['symmetries_continuous'][0]['offset'], dtype=np.float32)
-            #else:
-            #    sym_cont[int(key), :, :] = np.zeros((2, 3))
-
         def load_image(image_index):
             """ Load an image at the image_index.
             """
@@ -314,7 +269,6 @@ class CustomDataset(tf.data.Dataset):
         set_name = set_name.decode("utf-8")
         batch_size = batch_size
         path = os.path.join(data_dir, 'annotations', 'instances_' + set_name + '.json')
-        mesh_info = os.path.join(data_dir, 'annotations', 'models_info' + '.json')
 
         batch_size = int(batch_size)
         image_min_side = image_min_side
@@ -353,43 +307,18 @@ class CustomDataset(tf.data.Dataset):
 
         classes, labels, labels_inverse, labels_rev = load_classes(cats)
 
-        # load 3D boxes
+        # per object tables indexed by category id, objects above 6 are shifted down by one
         num_classes = 7
-        TDboxes = np.ndarray((num_classes + 1, 8, 3), dtype=np.float32)
-        sphere_diameters = np.ndarray((num_classes + 1), dtype=np.float32)
+        catalog = ObjectCatalog.load_or_build(os.path.join(data_dir, 'annotations'))
+        rows = np.where(catalog.object_ids > 6, catalog.object_ids - 1, catalog.object_ids)
+        TDboxes = np.zeros((num_classes + 1, 8, 3), dtype=np.float32)
+        sphere_diameters = np.zeros((num_classes + 1), dtype=np.float32)
         sym_cont = np.zeros((num_classes + 1, 2, 3), dtype=np.float32)
         sym_disc = np.zeros((num_classes + 1, 8, 16), dtype=np.float32)
-
-        for key, value in json.load(open(mesh_info)).items():
-            if int(key) > 6:
-                key = int(key) - 1
-            x_minus = value['min_x']
-            y_minus = value['min_y']
-            z_minus = value['min_z']
-            x_plus = value['size_x'] + x_minus
-            y_plus = value['size_y'] + y_minus
-            z_plus = value['size_z'] + z_minus
-            norm_pts = np.linalg.norm(np.array([value['size_x'], value['size_y'], value['size_z']]))
-            three_box_solo = np.array([[x_plus, y_plus, z_plus],
-                                       [x_plus, y_plus, z_minus],
-                                       [x_plus, y_minus, z_minus],
-                                       [x_plus, y_minus, z_plus],
-                                       [x_minus, y_plus, z_plus],
-                                       [x_minus, y_plus, z_minus],
-                                       [x_minus, y_minus, z_minus],
-                                       [x_minus, y_minus, z_plus]])
-            TDboxes[int(key), :, :] = three_box_solo
-            #sphere_diameters[int(key)] = value['diameter']
-            sphere_diameters[int(key)] = norm_pts
-
-            if 'symmetries_discrete' in value:
-                for sdx, sym in enumerate(value['symmetries_discrete']):
-                    sym_disc[int(key), sdx, :] = np.array(sym)
-                    sym_disc[int(key), sdx, [3, 7, 11]] *= 0.001
-
-            if "symmetries_continuous" in value:
-                sym_cont[int(key), 0, :] = np.array(value['symmetries_continuous'][0]['axis'], dtype=np.float32)
-                sym_cont[int(key), 1, :] = np.array(value['symmetries_continuous'][0]['offset'], dtype=np.float32)
+        TDboxes[rows] = catalog.corners
+        sphere_diameters[rows] = catalog.diameters
+        sym_cont[rows] = catalog.sym_cont
+        sym_disc[rows] = catalog.sym_disc
 
         transform_generator = random_transform_generator(
             min_translation=(0.0, 0.0),
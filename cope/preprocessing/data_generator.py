@@ -15,18 +15,22 @@ limitations under the License.
 """
 
 from collections import defaultdict
+import contextlib
+import functools
 
 import numpy as np
 import os
 import json
 import cv2
+import imgaug as ia
 import imgaug.augmenters as iaa
 
 import tensorflow.keras as keras
 import tensorflow as tf
 
 from ..utils.anchors import (
-    anchor_targets_bbox,
+    anchor_targets_graph,
+    pack_annotations,
     guess_shapes
 )
 from ..utils.image import (
@@ -41,7 +45,10 @@ from ..utils.image import (
     read_image_bgr,
     augment_image
 )
+from ..utils.object_catalog import ObjectCatalog
 from ..utils.transform import transform_aabb, random_transform_generator
+from .multiprocess_loader import MultiprocessLoader
+from .packed_dataset import PackedDataset
 
 
 def _isArrayLike(obj):
@@ -83,7 +90,6 @@ class GeneratorDataset(tf.data.Dataset):
         set_name = set_name.decode("utf-8")
         batch_size = batch_size
         path = os.path.join(data_dir, 'annotations', 'instances_' + set_name + '.json')
-        mesh_info = os.path.join(data_dir, 'meshes', 'models_info' + '.json')
 
         with open(path, 'r') as js:
             data = json.load(js)
@@ -116,51 +122,6 @@ class GeneratorDataset(tf.data.Dataset):
         classes, labels, labels_inverse, labels_rev = load_classes(cats)
         num_classes = len(classes)
 
-        # load 3D boxes
-        TDboxes = np.ndarray((num_classes + 1, 8, 3), dtype=np.float32)
-        sphere_diameters = np.ndarray((num_classes + 1), dtype=np.float32)
-        sym_cont = np.zeros((num_classes + 1, 2, 3), dtype=np.float32)
-        sym_disc = np.zeros((num_classes + 1, 8, 16), dtype=np.float32)
-
-        for key, value in json.load(open(mesh_info)).items():
-            x_minus = value['min_x']
-            y_minus = value['min_y']
-            z_minus = value['min_z']
-            x_plus = value['size_x'] + x_minus
-            y_plus = value['size_y'] + y_minus
-            z_plus = value['size_z'] + z_minus
-            norm_pts = np.linalg.norm(np.array([value['size_x'], value['size_y'], value['size_z']]))
-            #x_plus = (value['size_x'] / norm_pts) * (value['diameter'] * 0.5)
-            #y_plus = (value['size_y'] / norm_pts) * (value['diameter'] * 0.5)
-            #z_plus = (value['size_z'] / norm_pts) * (value['diameter'] * 0.5)
-            #x_minus = x_plus * -1.0
-            #y_minus = y_plus * -1.0
-            #z_minus = z_plus * -1.0
-            three_box_solo = np.array([[x_plus, y_plus, z_plus],
-                                       [x_plus, y_plus, z_minus],
-                                       [x_plus, y_minus, z_minus],
-                                       [x_plus, y_minus, z_plus],
-                                       [x_minus, y_plus, z_plus],
-                                       [x_minus, y_plus, z_minus],
-                                       [x_minus, y_minus, z_minus],
-                                       [x_minus, y_minus, z_plus]])
-            TDboxes[int(key), :, :] = three_box_solo
-            #sphere_diameters[int(key)] = value['diameter']
-            sphere_diameters[int(key)] = norm_pts
-
-            if 'symmetries_discrete' in value:
-                for sdx, sym in enumerate(value['symmetries_discrete']):
-                    sym_disc[int(key), sdx, :] = np.array(sym)
-                    sym_disc[int(key), sdx, [3, 7, 11]] *= 0.001
-            #else:
-                #sym_disc[int(key), :, :] = np.repeat(np.eye((4)).reshape(16)[np.newaxis, :], repeats=3, axis=0)  # np.zeros((3, 16))
-
-            if "symmetries_continuous" in value:
-                sym_cont[int(key), 0, :] = np.array(value['symmetries_continuous'][0]['axis'], dtype=np.float32)
-                sym_cont[int(key), 1, :] = np.array(value['symmetries_continuous'][0]['offset'], dtype=np.float32)
-            #else:
-            #    sym_cont[int(key), :, :] = np.zeros((2, 3))
-
         def load_image(image_index):
             """ Load an image at the image_index.
             """
@@ -262,7 +223,7 @@ class GeneratorDataset(tf.data.Dataset):
             yield scene_id, anno[0], x_t, anno[1], anno[2], anno[3], anno[4]
 
     def _generate(data_dir, set_name, batch_size=8, transform_generator=None, image_min_side=480,
-                         image_max_side=640):
+                         image_max_side=640, worker_index=0, num_workers=1, seed=None, pack_dir=None, pipeline_stats=None):
 
         def _isArrayLike(obj):
             return hasattr(obj, '__iter__') and hasattr(obj, '__len__')
@@ -293,16 +254,34 @@ class GeneratorDataset(tf.data.Dataset):
         data_dir = data_dir.decode("utf-8")
         set_name = set_name.decode("utf-8")
         path = os.path.join(data_dir, 'annotations', 'instances_' + set_name + '.json')
-        mesh_info = os.path.join(data_dir, 'meshes', 'models_info' + '.json')
 
         batch_size = int(batch_size)
+
+        # every stage of producing a batch is timed when pipeline stats are given
+        def timed(stage):
+            return pipeline_stats.time(stage) if pipeline_stats is not None else contextlib.nullcontext()
+
         image_min_side = image_min_side
         image_max_side = image_max_side
         transform_parameters = TransformParameters()
-        compute_anchor_targets = anchor_targets_bbox
-
-        with open(path, 'r') as js:
-            data = json.load(js)
+        compute_anchor_targets = pack_annotations
+
+        # deterministic augmentation per worker
+        worker_index = int(worker_index)
+        num_workers = int(num_workers)
+        prng = None
+        if seed is not None and seed >= 0:
+            np.random.seed(int(seed) + worker_index)
+            ia.seed(int(seed) + worker_index)
+            prng = np.random.RandomState(int(seed) + worker_index)
+
+        # decoded images and annotations are read from a pack if one is given
+        packed = PackedDataset(pack_dir.decode("utf-8") if isinstance(pack_dir, bytes) else pack_dir) if pack_dir else None
+        if packed is None:
+            with open(path, 'r') as js:
+                data = json.load(js)
+        else:
+            data = {'images': [], 'annotations': [], 'categories': packed.categories}
 
         # load source w/ annotations
         image_ann = data["images"]
@@ -324,6 +303,10 @@ class GeneratorDataset(tf.data.Dataset):
             image_intrinsics.append([img["fx"], img["fy"], img["cx"], img["cy"]])
             image_paths.append(os.path.join(data_dir, 'images', set_name, img['file_name']))
 
+        if packed is not None:
+            image_ids = packed.image_ids.tolist()
+            image_intrinsics = packed.intrinsics.tolist()
+
         for cat in cat_ann:
             cats[cat['id']] = cat
 
@@ -334,51 +317,15 @@ class GeneratorDataset(tf.data.Dataset):
         classes, labels, labels_inverse, labels_rev = load_classes(cats)
         num_classes = len(classes)
 
-        # load 3D boxes
-        TDboxes = np.ndarray((num_classes + 1, 8, 3), dtype=np.float32)
-        sphere_diameters = np.ndarray((num_classes + 1), dtype=np.float32)
-        sym_cont = np.zeros((num_classes + 1, 2, 3), dtype=np.float32)
-        sym_disc = np.zeros((num_classes + 1, 8, 16), dtype=np.float32)
-
-        for key, value in json.load(open(mesh_info)).items():
-            x_minus = value['min_x']
-            y_minus = value['min_y']
-            z_minus = value['min_z']
-            x_plus = value['size_x'] + x_minus
-            y_plus = value['size_y'] + y_minus
-            z_plus = value['size_z'] + z_minus
-            norm_pts = np.linalg.norm(np.array([value['size_x'], value['size_y'], value['size_z']]))
-            #x_plus = (value['size_x'] / norm_pts) * (value['diameter'] * 0.5)
-            #y_plus = (value['size_y'] / norm_pts) * (value['diameter'] * 0.5)
-            #z_plus = (value['size_z'] / norm_pts) * (value['diameter'] * 0.5)
-            #x_minus = x_plus * -1.0
-            #y_minus = y_plus * -1.0
-            #z_minus = z_plus * -1.0
-            three_box_solo = np.array([[x_plus, y_plus, z_plus],
-                                       [x_plus, y_plus, z_minus],
-                                       [x_plus, y_minus, z_minus],
-                                       [x_plus, y_minus, z_plus],
-                                       [x_minus, y_plus, z_plus],
-                                       [x_minus, y_plus, z_minus],
-                                       [x_minus, y_minus, z_minus],
-                                       [x_minus, y_minus, z_plus]])
-            TDboxes[int(key), :, :] = three_box_solo
-            #sphere_diameters[int(key)] = value['diameter']
-            sphere_diameters[int(key)] = norm_pts
-
-            if 'symmetries_discrete' in value:
-                for sdx, sym in enumerate(value['symmetries_discrete']):
-                    sym_disc[int(key), sdx, :] = np.array(sym)
-            #else:
-                #sym_disc[int(key), :, :] = np.repeat(np.eye((4)).reshape(16)[np.newaxis, :], repeats=3, axis=0)  # np.zeros((3, 16))
-
-            if "symmetries_continuous" in value:
-                sym_cont[int(key), 0, :] = np.array(value['symmetries_continuous'][0]['axis'], dtype=np.float32)
-                sym_cont[int(key), 1, :] = np.array(value['symmetries_continuous'][0]['offset'], dtype=np.float32)
-            #else:
-            #    sym_cont[int(key), :, :] = np.zeros((2, 3))
+        # per object tables indexed by category id
+        catalog = ObjectCatalog.load_or_build(os.path.join(data_dir, 'meshes'))
+        TDboxes = catalog.by_id(catalog.corners)
+        sphere_diameters = catalog.by_id(catalog.diameters)
+        sym_cont = catalog.by_id(catalog.sym_cont)
+        sym_disc = catalog.by_id(catalog.sym_disc)
 
         transform_generator = random_transform_generator(
+            prng=prng,
             min_translation=(0.0, 0.0),
             max_translation=(0.0, 0.0),
             min_scaling=(0.95, 0.95),
@@ -388,6 +335,9 @@ class GeneratorDataset(tf.data.Dataset):
         def load_image(image_index):
             """ Load an image at the image_index.
             """
+            if packed is not None:
+                return packed.load_image(image_index)
+
             path = image_paths[image_index]
             path = path[:-4] + '_rgb' + path[-4:]
 
@@ -396,10 +346,22 @@ class GeneratorDataset(tf.data.Dataset):
         def load_intrinsics(image_index):
             return image_intrinsics[image_index]
 
+        def load_mask(image_index):
+            """ Load the object id mask of an image_index.
+            """
+            if packed is not None:
+                return packed.load_mask(image_index)
+
+            path = image_paths[image_index]
+            return cv2.imread(path[:-4] + '_mask.png', -1)
+
         def load_annotations(image_index):
             """ Load annotations for an image_index.
                 CHECK DONE HERE: Annotations + images correct
             """
+            if packed is not None:
+                return load_packed_annotations(image_index)
+
             # ids = image_ids[image_index]
 
             # lists = [imgToAnns[imgId] for imgId in ids if imgId in imgToAnns]
@@ -407,11 +369,7 @@ class GeneratorDataset(tf.data.Dataset):
             anns = imgToAnns[image_ids[image_index]]
             intris = load_intrinsics(image_index)
 
-            path = image_paths[image_index]
-            mask_path = path[:-4] + '_mask.png'  # + path[-4:]
-            mask = cv2.imread(mask_path, -1)
-
-            annotations = {'mask': mask, 'visibility': np.empty((0,)), 'labels': np.empty((0,)),
+            annotations = {'visibility': np.empty((0,)), 'labels': np.empty((0,)),
                            'bboxes': np.empty((0, 4)), 'poses': np.empty((0, 7)), 'segmentations': np.empty((0, 8, 3)), 'diameters': np.empty((0,)), 'cam_params': np.empty((0, 4)), 'mask_ids': np.empty((0,)), 'sym_dis': np.empty((0, 8, 16)), 'sym_con': np.empty((0, 2, 3))}
 
             for idx, a in enumerate(anns):
@@ -461,6 +419,26 @@ class GeneratorDataset(tf.data.Dataset):
 
             return annotations
 
+        def load_packed_annotations(image_index):
+            """ Load annotations for an image_index from the pack, same filtering as load_annotations.
+            """
+            objects = packed.load_objects(image_index)
+            keep = np.ones(objects['visibility'].shape, dtype=bool)
+            if set_name == 'train':
+                keep = objects['visibility'] >= 0.25
+            objIDs = objects['category_ids'][keep]
+
+            return {'visibility': objects['visibility'][keep],
+                    'labels': np.array([labels_inverse[objID] for objID in objIDs], dtype=np.float64),
+                    'bboxes': objects['bboxes'][keep],
+                    'poses': objects['poses'][keep],
+                    'segmentations': TDboxes[objIDs, :, :],
+                    'diameters': sphere_diameters[objIDs],
+                    'cam_params': np.repeat(np.array([image_intrinsics[image_index]], dtype=np.float64), len(objIDs), axis=0),
+                    'mask_ids': objects['mask_ids'][keep],
+                    'sym_dis': sym_disc[objIDs, :, :],
+                    'sym_con': sym_cont[objIDs, :, :]}
+
         def random_transform_group_entry(image, annotations, transform=None):
             """ Randomly transforms image and annotation.
             """
@@ -526,8 +504,14 @@ class GeneratorDataset(tf.data.Dataset):
             ]),
         ], random_order=True)
 
+        # a worker without images would never yield a batch
+        if worker_index >= len(image_ids):
+            raise ValueError('Loader {} of {} has no images, the set has only {} images. Use fewer workers or shards.'.format(
+                worker_index, num_workers, len(image_ids)))
+
         while True:
-            order = list(range(len(image_ids)))
+            # every worker iterates over its own shard of the images
+            order = list(range(worker_index, len(image_ids), num_workers))
             np.random.shuffle(order)
             groups = [[order[x % len(order)] for x in range(i, i + batch_size)] for i in
                           range(0, len(order), batch_size)]
@@ -535,36 +519,67 @@ class GeneratorDataset(tf.data.Dataset):
             batches = np.arange(len(groups))
 
             for btx in range(len(batches)):
-                x_s = [load_image(image_index) for image_index in groups[btx]]
-                x_intrinsics = [load_intrinsics(image_index) for image_index in groups[btx]]
-                y_s = [load_annotations(image_index) for image_index in groups[btx]]
+                x_s, x_intrinsics, y_s = [], [], []
+                for image_index in groups[btx]:
+                    with timed('decode'):
+                        x_s.append(load_image(image_index))
+                    x_intrinsics.append(load_intrinsics(image_index))
+                    with timed('mask'):
+                        mask = load_mask(image_index)
+                    with timed('annotations'):
+                        y_s.append(load_annotations(image_index))
+                    y_s[-1]['mask'] = mask
 
                 assert (len(x_s) == len(y_s))
 
                 # filter annotations
                 for index, (image, annotations) in enumerate(zip(x_s, y_s)):
 
-                    x_s[index] = augment_image(x_s[index], seq)
+                    with timed('augment'):
+                        x_s[index] = augment_image(x_s[index], seq)
 
                     # transform a single group entry
-                    x_s[index], y_s[index] = random_transform_group_entry(x_s[index], y_s[index])
+                    with timed('transform'):
+                        x_s[index], y_s[index] = random_transform_group_entry(x_s[index], y_s[index])
 
                     # preprocess
-                    x_s[index] = preprocess_image(x_s[index])
-                    x_s[index] = keras.backend.cast_to_floatx(x_s[index])
+                    with timed('preprocess'):
+                        x_s[index] = preprocess_image(x_s[index])
+                        x_s[index] = keras.backend.cast_to_floatx(x_s[index])
 
                 # x_s to image_batch
-                image_source_batch = np.zeros((batch_size,) + max_shape, dtype=keras.backend.floatx())
-                intrinsics_source_batch = np.zeros((batch_size, 4), dtype=keras.backend.floatx())
-                for image_index, image in enumerate(x_s):
-                    image_source_batch[image_index, :image.shape[0], :image.shape[1], :image.shape[2]] = image
-                    intrinsics_source_batch[image_index, :] = x_intrinsics[image_index]
-
-                target_batch = compute_anchor_targets(x_s, y_s, len(classes))
-
-                yield image_source_batch, intrinsics_source_batch, (target_batch[0], target_batch[1], target_batch[2], target_batch[3], target_batch[4], target_batch[5])
-
-    def __new__(self, data_dir, set_name, num_classes, batch_size):
+                with timed('assemble'):
+                    image_source_batch = np.zeros((batch_size,) + max_shape, dtype=keras.backend.floatx())
+                    intrinsics_source_batch = np.zeros((batch_size, 4), dtype=keras.backend.floatx())
+                    for image_index, image in enumerate(x_s):
+                        image_source_batch[image_index, :image.shape[0], :image.shape[1], :image.shape[2]] = image
+                        intrinsics_source_batch[image_index, :] = x_intrinsics[image_index]
+
+                # targets are computed by anchor_targets_graph in the input pipeline
+                with timed('pack'):
+                    annotations_batch = compute_anchor_targets(y_s)
+
+                if pipeline_stats is not None:
+                    pipeline_stats.count_batch(batch_size)
+
+                yield image_source_batch, intrinsics_source_batch, annotations_batch
+
+    def __new__(self, data_dir, set_name, num_classes, batch_size, workers=0, seed=None, pack_dir=None, shard_index=0, num_shards=1,
+                pipeline_stats=None):
+        """ Create the dataset of a set.
+
+        Args
+            data_dir: Path to the dataset directory.
+            set_name: Name of the set, either 'train' or 'val'.
+            num_classes: Number of object classes.
+            batch_size: Size of the batches.
+            workers: Number of worker processes loading training batches, 0 runs the generator in the tf.data thread.
+            seed: Base seed for the augmentation of the workers, None for random seeding.
+            pack_dir: Directory of a set packed with pack_dataset, read instead of decoding the images.
+            shard_index: Index of this dataset among the input pipelines of a multi-worker training.
+            num_shards: Number of input pipelines, every pipeline reads a disjoint subset of the images.
+            pipeline_stats: PipelineStats timing the stages of the training generator, None to not time them.
+        """
 
         if set_name=='val':
             return tf.data.Dataset.from_generator(self._sample,
@@ -579,16 +594,33 @@ class GeneratorDataset(tf.data.Dataset):
                                               args=(data_dir, set_name, batch_size))
 
         elif set_name == 'train':
-            return tf.data.Dataset.from_generator(self._generate,
+            generate = functools.partial(self._generate, pack_dir=pack_dir)
+            if workers > 0:
+                loader = MultiprocessLoader(generate, (data_dir.encode('utf-8'), set_name.encode('utf-8'), batch_size), batch_size, workers, seed=seed,
+                                            shard_index=shard_index, num_shards=num_shards, pipeline_stats=pipeline_stats)
+                generator, args = lambda: iter(loader), None
+            else:
+                generator = functools.partial(generate, worker_index=shard_index, num_workers=num_shards, seed=seed, pipeline_stats=pipeline_stats)
+                args = (data_dir, set_name, batch_size)
+            dataset = tf.data.Dataset.from_generator(generator,
                                               output_signature=(tf.TensorSpec(shape=(batch_size, 480, 640, 3),dtype=tf.float32),
                                                                 tf.TensorSpec(shape=(batch_size, 4),dtype=tf.float32),
-                                                                (tf.TensorSpec(shape=(batch_size, 6300, num_classes, 8, 17),dtype=tf.float32),
-                                                                 tf.TensorSpec(shape=(batch_size, 6300, num_classes, 5),dtype=tf.float32),
-                                                                tf.TensorSpec(shape=(batch_size, 6300, num_classes + 1),dtype=tf.float32),
-                                                                tf.TensorSpec(shape=(batch_size, 6300, num_classes, 4),dtype=tf.float32),
-                                                                tf.TensorSpec(shape=(batch_size, 6300, num_classes, 8, 7),dtype=tf.float32),
-                                                                tf.TensorSpec(shape=(batch_size, 6300, num_classes), dtype=tf.float32))),
-                                              args=(data_dir, set_name, batch_size))
+                                                                (tf.TensorSpec(shape=(batch_size, 480, 640), dtype=tf.int32),
+                                                                 (tf.TensorSpec(shape=(None, ), dtype=tf.int32),
+                                                                  tf.TensorSpec(shape=(None, ), dtype=tf.int32),
+                                                                  tf.TensorSpec(shape=(None, ), dtype=tf.int32),
+                                                                  tf.TensorSpec(shape=(None, ), dtype=tf.float32),
+                                                                  tf.TensorSpec(shape=(None, ), dtype=tf.float32),
+                                                                  tf.TensorSpec(shape=(None, 4), dtype=tf.float32),
+                                                                  tf.TensorSpec(shape=(None, 7), dtype=tf.float32),
+                                                                  tf.TensorSpec(shape=(None, 8, 3), dtype=tf.float32),
+                                                                  tf.TensorSpec(shape=(None, 4), dtype=tf.float32),
+                                                                  tf.TensorSpec(shape=(None, 8, 16), dtype=tf.float32),
+                                                                  tf.TensorSpec(shape=(None, 2, 3), dtype=tf.float32)))),
+                                              args=args)
+            # sparse anchor targets are computed in graph mode, off the python generator
+            return dataset.map(lambda image, intrinsics, annotations: (image, intrinsics, anchor_targets_graph(*annotations)),
+                               num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
         else:
             print('Define valid set_type for dataset generator [train, val].')
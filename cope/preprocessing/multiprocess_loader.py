@@ -0,0 +1,131 @@
+"""
+Multiprocess batch loading for the training generator.
+
+Every worker process runs GeneratorDataset._generate on its own shard of the images and writes the fixed size
+part of a batch (images, intrinsics and masks) into a slot of a pool of shared memory buffers. Only the slot index,
+the small per-object annotation table and, when the pipeline is timed, the stage durations of the batch are sent
+through the queue.
+"""
+
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import queue
+import traceback
+
+import numpy as np
+
+from ..utils.pipeline_stats import StageRecorder
+
+
+def _slot_arrays(buffers, slot, shapes):
+    """ Numpy views onto the shared memory buffers of a slot.
+    """
+    return [np.ndarray(shape, dtype=dtype, buffer=buffers[slot][index].buf) for index, (shape, dtype) in enumerate(shapes)]
+
+
+def _write_slot(buffers, slot, shapes, arrays):
+    """ Copy the arrays of a batch into a slot, no views onto the buffers are kept alive.
+    """
+    for target, array in zip(_slot_arrays(buffers, slot, shapes), arrays):
+        target[...] = array
+
+
+def _worker_loop(generate, generate_args, worker_index, num_workers, seed, buffer_names, shapes, free_slots, ready_batches, time_stages):
+    """ Fill free slots with batches of the generator until the parent process exits.
+    """
+    buffers = [[shared_memory.SharedMemory(name=name) for name in names] for names in buffer_names]
+    recorder = StageRecorder() if time_stages else None
+    try:
+        for image_batch, intrinsics_batch, (mask_batch, objects) in generate(*generate_args, worker_index=worker_index, num_workers=num_workers, seed=seed,
+                                                                             pipeline_stats=recorder):
+            slot = free_slots.get()
+            if slot is None:
+                break
+            _write_slot(buffers, slot, shapes, (image_batch, intrinsics_batch, mask_batch))
+            ready_batches.put((slot, objects, recorder.drain() if recorder is not None else None))
+    except Exception:
+        ready_batches.put((None, traceback.format_exc(), None))
+    finally:
+        for slot_buffers in buffers:
+            for buffer in slot_buffers:
+                buffer.close()
+
+
+class MultiprocessLoader:
+    """ Iterable over training batches produced by a pool of worker processes.
+
+    Args
+        generate: The batch generator function, called as generate(*generate_args, worker_index, num_workers, seed).
+        generate_args: Positional arguments of the generator.
+        batch_size: Size of the batches.
+        workers: Number of worker processes.
+        image_shape: Shape of a single image.
+        seed: Base seed, worker i is seeded with seed + i. None or negative for random seeding.
+        slots_per_worker: Number of shared memory batch buffers per worker.
+        shard_index: Index of this loader when several processes or hosts load the same set.
+        num_shards: Number of loaders, worker i of loader k reads shard k * workers + i of num_shards * workers.
+        pipeline_stats: PipelineStats the stage durations of the workers are merged into, None to not time them.
+    """
+
+    def __init__(self, generate, generate_args, batch_size, workers, image_shape=(480, 640, 3), seed=None, slots_per_worker=2,
+                 shard_index=0, num_shards=1, pipeline_stats=None):
+        self.generate = generate
+        self.generate_args = generate_args
+        self.workers = workers
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        self.seed = seed
+        self.pipeline_stats = pipeline_stats
+        self.num_slots = workers * slots_per_worker
+        self.shapes = [((batch_size,) + tuple(image_shape), np.float32),
+                       ((batch_size, 4), np.float32),
+                       ((batch_size,) + tuple(image_shape[:2]), np.int32)]
+
+    def __iter__(self):
+        ctx = mp.get_context('spawn')
+        buffers = [[shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(dtype).itemsize) for shape, dtype in self.shapes]
+                   for _ in range(self.num_slots)]
+        free_slots = ctx.Queue()
+        ready_batches = ctx.Queue()
+        for slot in range(self.num_slots):
+            free_slots.put(slot)
+
+        processes = []
+        for worker_index in range(self.workers):
+            process = ctx.Process(target=_worker_loop,
+                                  args=(self.generate, self.generate_args, self.shard_index * self.workers + worker_index,
+                                        self.num_shards * self.workers, self.seed,
+                                        [[buffer.name for buffer in slot_buffers] for slot_buffers in buffers],
+                                        self.shapes, free_slots, ready_batches, self.pipeline_stats is not None),
+                                  daemon=True)
+            process.start()
+            processes.append(process)
+
+        try:
+            while True:
+                try:
+                    slot, objects, timings = ready_batches.get(timeout=60)
+                except queue.Empty:
+                    if not any(process.is_alive() for process in processes):
+                        raise RuntimeError('All data loading workers exited.')
+                    continue
+                if slot is None:
+                    raise RuntimeError('Data loading worker failed:\n' + objects)
+                if timings is not None:
+                    self.pipeline_stats.merge(*timings)
+
+                # copy out of the slot, tensorflow may keep referencing the yielded arrays
+                images, intrinsics, masks = [np.array(array) for array in _slot_arrays(buffers, slot, self.shapes)]
+                free_slots.put(slot)
+                yield images, intrinsics, (masks, objects)
+        finally:
+            for _ in processes:
+                free_slots.put(None)
+            for process in processes:
+                process.join(timeout=1)
+                if process.is_alive():
+                    process.terminate()
+            for slot_buffers in buffers:
+                for buffer in slot_buffers:
+                    buffer.close()
+                    buffer.unlink()
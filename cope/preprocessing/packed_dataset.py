@@ -0,0 +1,158 @@
+"""
+Memory-mappable cache of a decoded COPE dataset.
+
+A packed set is a directory holding
+    index.json: Set name, number of images, shard size, image and mask shapes and the categories.
+    images_XXXX.npy: (N, H, W, 3) uint8 shards of the decoded BGR images.
+    masks_XXXX.npy: (N, H, W) shards of the decoded object id masks.
+    image_ids.npy, intrinsics.npy: Per image arrays.
+    object_offsets.npy: (num_images + 1,) offsets of the objects of every image into the per object arrays.
+    category_ids.npy, bboxes.npy, poses.npy, mask_ids.npy, visibility.npy: Per object arrays.
+
+All arrays are stored as .npy files and opened with mmap_mode='r', so reading a sample does not copy or decode.
+"""
+
+from collections import defaultdict
+
+import numpy as np
+import os
+import json
+import cv2
+
+from ..utils.image import read_image_bgr
+
+
+def pack_dataset(data_dir, set_name, output_dir, shard_size=1000):
+    """ Decode the images, masks and annotations of a set and write them to a packed directory.
+
+    Args
+        data_dir: Path to the COPE dataset directory.
+        set_name: Name of the set to pack, e.g. 'train'.
+        output_dir: Directory the packed set is written to.
+        shard_size: Number of images per image and mask shard.
+    """
+    with open(os.path.join(data_dir, 'annotations', 'instances_' + set_name + '.json'), 'r') as js:
+        data = json.load(js)
+
+    imgToAnns = defaultdict(list)
+    for ann in data['annotations']:
+        imgToAnns[ann['image_id']].append(ann)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    images = data['images']
+    image_ids = np.array([img['id'] for img in images], dtype=np.int64)
+    intrinsics = np.array([[img['fx'], img['fy'], img['cx'], img['cy']] for img in images], dtype=np.float32)
+
+    object_offsets = [0]
+    category_ids, bboxes, poses, mask_ids, visibility = [], [], [], [], []
+    image_shape, mask_shape, mask_dtype = None, None, None
+    images_shard, masks_shard = None, None
+
+    for image_index, img in enumerate(images):
+        path = os.path.join(data_dir, 'images', set_name, img['file_name'])
+        image = read_image_bgr(path[:-4] + '_rgb' + path[-4:])
+        mask = cv2.imread(path[:-4] + '_mask.png', -1)
+
+        if image_shape is None:
+            image_shape, mask_shape, mask_dtype = image.shape, mask.shape, mask.dtype
+        if image.shape != image_shape or mask.shape != mask_shape:
+            raise ValueError('All images and masks of a packed set need the same shape, {} differs.'.format(img['file_name']))
+
+        shard, shard_index = divmod(image_index, shard_size)
+        if shard_index == 0:
+            num_shard = min(shard_size, len(images) - image_index)
+            images_shard = np.lib.format.open_memmap(os.path.join(output_dir, 'images_{:04d}.npy'.format(shard)), mode='w+', dtype=np.uint8, shape=(num_shard,) + image_shape)
+            masks_shard = np.lib.format.open_memmap(os.path.join(output_dir, 'masks_{:04d}.npy'.format(shard)), mode='w+', dtype=mask_dtype, shape=(num_shard,) + mask_shape)
+        images_shard[shard_index] = image
+        masks_shard[shard_index] = mask
+
+        for a in imgToAnns[img['id']]:
+            pose = list(a['pose'])
+            if pose[2] < 10.0:  # needed for adjusting pose annotations
+                pose[:3] = [value * 1000.0 for value in pose[:3]]
+            category_ids.append(a['category_id'])
+            bboxes.append([a['bbox'][0], a['bbox'][1], a['bbox'][0] + a['bbox'][2], a['bbox'][1] + a['bbox'][3]])
+            poses.append(pose)
+            mask_ids.append(a['mask_id'])
+            visibility.append(a['feature_visibility'])
+        object_offsets.append(len(category_ids))
+
+    images_shard, masks_shard = None, None
+
+    np.save(os.path.join(output_dir, 'image_ids.npy'), image_ids)
+    np.save(os.path.join(output_dir, 'intrinsics.npy'), intrinsics)
+    np.save(os.path.join(output_dir, 'object_offsets.npy'), np.array(object_offsets, dtype=np.int64))
+    np.save(os.path.join(output_dir, 'category_ids.npy'), np.array(category_ids, dtype=np.int64))
+    np.save(os.path.join(output_dir, 'bboxes.npy'), np.array(bboxes, dtype=np.float64).reshape((-1, 4)))
+    np.save(os.path.join(output_dir, 'poses.npy'), np.array(poses, dtype=np.float64).reshape((-1, 7)))
+    np.save(os.path.join(output_dir, 'mask_ids.npy'), np.array(mask_ids, dtype=np.int64))
+    np.save(os.path.join(output_dir, 'visibility.npy'), np.array(visibility, dtype=np.float64))
+
+    with open(os.path.join(output_dir, 'index.json'), 'w') as js:
+        json.dump({'set_name': set_name,
+                   'num_images': len(images),
+                   'shard_size': shard_size,
+                   'image_shape': list(image_shape) if image_shape is not None else None,
+                   'mask_shape': list(mask_shape) if mask_shape is not None else None,
+                   'categories': data['categories']}, js)
+
+
+class PackedDataset:
+    """ Read access to a set written by pack_dataset, all arrays are memory-mapped.
+
+    Args
+        pack_dir: Directory of the packed set.
+    """
+
+    def __init__(self, pack_dir):
+        with open(os.path.join(pack_dir, 'index.json'), 'r') as js:
+            index = json.load(js)
+
+        self.set_name = index['set_name']
+        self.num_images = index['num_images']
+        self.shard_size = index['shard_size']
+        self.categories = index['categories']
+
+        def load(name):
+            return np.load(os.path.join(pack_dir, name), mmap_mode='r')
+
+        num_shards = (self.num_images + self.shard_size - 1) // self.shard_size
+        self.images = [load('images_{:04d}.npy'.format(shard)) for shard in range(num_shards)]
+        self.masks = [load('masks_{:04d}.npy'.format(shard)) for shard in range(num_shards)]
+        self.image_ids = load('image_ids.npy')
+        self.intrinsics = load('intrinsics.npy')
+        self.object_offsets = load('object_offsets.npy')
+        self.category_ids = load('category_ids.npy')
+        self.bboxes = load('bboxes.npy')
+        self.poses = load('poses.npy')
+        self.mask_ids = load('mask_ids.npy')
+        self.visibility = load('visibility.npy')
+
+    def __len__(self):
+        return self.num_images
+
+    def load_image(self, image_index):
+        """ Read-only view of the decoded BGR image at image_index.
+        """
+        shard, shard_index = divmod(image_index, self.shard_size)
+        return self.images[shard][shard_index]
+
+    def load_mask(self, image_index):
+        """ Read-only view of the object id mask at image_index.
+        """
+        shard, shard_index = divmod(image_index, self.shard_size)
+        return self.masks[shard][shard_index]
+
+    def load_objects(self, image_index):
+        """ Per object annotation arrays of the image at image_index.
+
+        Returns
+            A dictionary with the 'category_ids', 'bboxes', 'poses', 'mask_ids' and 'visibility' arrays.
+        """
+        start, end = self.object_offsets[image_index], self.object_offsets[image_index + 1]
+        return {'category_ids': self.category_ids[start:end],
+                'bboxes': self.bboxes[start:end],
+                'poses': self.poses[start:end],
+                'mask_ids': self.mask_ids[start:end],
+                'visibility': self.visibility[start:end]}
@@ -0,0 +1,346 @@
+"""
+Native tf.data input pipeline reading TFRecord shards.
+
+write_tfrecords stores the encoded RGB and mask files of a set together with the per-object annotations as
+tf.train.Examples. create_tfrecord_dataset decodes, augments and batches them with parallel tf.data maps and
+computes the sparse anchor targets in graph mode, so no python generator is on the training path.
+"""
+
+from collections import defaultdict
+
+import numpy as np
+import os
+import json
+import cv2
+
+import tensorflow as tf
+
+from ..utils.anchors import anchor_targets_graph
+from ..utils.object_catalog import ObjectCatalog
+
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _float_feature(values):
+    return tf.train.Feature(float_list=tf.train.FloatList(value=np.asarray(values, dtype=np.float32).reshape(-1)))
+
+
+def _int64_feature(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=np.asarray(values, dtype=np.int64).reshape(-1)))
+
+
+def write_tfrecords(data_dir, set_name, output_dir, shard_size=1000):
+    """ Write the images, masks and annotations of a set to TFRecord shards.
+
+    The image and mask files are stored encoded as they are, decoding happens in the input pipeline.
+
+    Args
+        data_dir: Path to the COPE dataset directory.
+        set_name: Name of the set to write, e.g. 'train'.
+        output_dir: Directory the shards and index.json are written to.
+        shard_size: Number of images per shard.
+    """
+    with open(os.path.join(data_dir, 'annotations', 'instances_' + set_name + '.json'), 'r') as js:
+        data = json.load(js)
+
+    imgToAnns = defaultdict(list)
+    for ann in data['annotations']:
+        imgToAnns[ann['image_id']].append(ann)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    images = data['images']
+    writer = None
+    for image_index, img in enumerate(images):
+        shard, shard_index = divmod(image_index, shard_size)
+        if shard_index == 0:
+            if writer is not None:
+                writer.close()
+            writer = tf.io.TFRecordWriter(os.path.join(output_dir, '{}_{:04d}.tfrecord'.format(set_name, shard)))
+
+        path = os.path.join(data_dir, 'images', set_name, img['file_name'])
+        with open(path[:-4] + '_rgb' + path[-4:], 'rb') as f:
+            image = f.read()
+        with open(path[:-4] + '_mask.png', 'rb') as f:
+            mask = f.read()
+        mask_bits = 16 if cv2.imread(path[:-4] + '_mask.png', -1).dtype == np.uint16 else 8
+
+        anns = imgToAnns[img['id']]
+        poses = []
+        for a in anns:
+            pose = list(a['pose'])
+            if pose[2] < 10.0:  # needed for adjusting pose annotations
+                pose[:3] = [value * 1000.0 for value in pose[:3]]
+            poses.append(pose)
+
+        example = tf.train.Example(features=tf.train.Features(feature={
+            'image_id': _int64_feature([img['id']]),
+            'image': _bytes_feature(image),
+            'mask': _bytes_feature(mask),
+            'mask_bits': _int64_feature([mask_bits]),
+            'intrinsics': _float_feature([img['fx'], img['fy'], img['cx'], img['cy']]),
+            'category_ids': _int64_feature([a['category_id'] for a in anns]),
+            'bboxes': _float_feature([[a['bbox'][0], a['bbox'][1], a['bbox'][0] + a['bbox'][2], a['bbox'][1] + a['bbox'][3]] for a in anns]),
+            'poses': _float_feature(poses),
+            'mask_ids': _int64_feature([a['mask_id'] for a in anns]),
+            'visibility': _float_feature([a['feature_visibility'] for a in anns]),
+        }))
+        writer.write(example.SerializeToString())
+
+    if writer is not None:
+        writer.close()
+
+    with open(os.path.join(output_dir, 'index.json'), 'w') as js:
+        json.dump({'set_name': set_name,
+                   'num_images': len(images),
+                   'shard_size': shard_size,
+                   'categories': data['categories']}, js)
+
+
+def _load_object_info(mesh_dir, categories):
+    """ Per category lookup tables of the label, 3D box, diameter and symmetries, indexed by category id.
+    """
+    catalog = ObjectCatalog.load_or_build(mesh_dir)
+    size = max([int(catalog.object_ids.max())] + [cat['id'] for cat in categories]) + 1
+
+    labels = np.full((size,), -1, dtype=np.int32)
+    for label, cat in enumerate(sorted(categories, key=lambda x: x['id'])):
+        labels[cat['id']] = label
+
+    TDboxes = catalog.by_id(catalog.corners, size)
+    sphere_diameters = catalog.by_id(catalog.diameters, size)
+    sym_cont = catalog.by_id(catalog.sym_cont, size)
+    sym_disc = catalog.by_id(catalog.sym_disc, size)
+
+    return labels, TDboxes, sphere_diameters, sym_cont, sym_disc
+
+
+def _maybe(probability, augment, image):
+    return tf.cond(tf.random.uniform([]) < probability, lambda: augment(image), lambda: image)
+
+
+def _per_channel(minval, maxval, per_channel=0.5):
+    """ Random factor per channel with the given probability, shared over the channels otherwise.
+    """
+    value = tf.random.uniform([3], minval, maxval)
+    return tf.where(tf.random.uniform([]) < per_channel, value, value[:1])
+
+
+def _blur(image, kernel):
+    """ Separable blur with border reflection, kernel is a 1D tensor of odd length.
+    """
+    radius = (kernel.shape[0] - 1) // 2
+    image = tf.pad(image[tf.newaxis], [[0, 0], [radius, radius], [radius, radius], [0, 0]], mode='REFLECT')
+    image = tf.nn.depthwise_conv2d(image, tf.tile(tf.reshape(kernel, (-1, 1, 1, 1)), [1, 1, 3, 1]), [1, 1, 1, 1], 'VALID')
+    image = tf.nn.depthwise_conv2d(image, tf.tile(tf.reshape(kernel, (1, -1, 1, 1)), [1, 1, 3, 1]), [1, 1, 1, 1], 'VALID')
+    return image[0]
+
+
+def _gaussian_blur(image):
+    sigma = tf.random.uniform([], 0.1, 2.0)
+    kernel = tf.exp(-0.5 * tf.square(tf.range(-6.0, 7.0) / sigma))
+    return _blur(image, kernel / tf.reduce_sum(kernel))
+
+
+def _average_blur(image):
+    size = tf.cast(tf.random.uniform([], 1, 4, dtype=tf.int32) * 2 + 1, tf.float32)
+    kernel = tf.cast(tf.abs(tf.range(-3.0, 4.0)) <= (size - 1.0) / 2.0, tf.float32)
+    return _blur(image, kernel / tf.reduce_sum(kernel))
+
+
+def _hue_saturation(image):
+    hsv = tf.image.rgb_to_hsv(image / 255.0)
+    hue = tf.math.floormod(hsv[..., 0] + tf.random.uniform([], -15.0, 15.0) / 510.0, 1.0)
+    saturation = tf.clip_by_value(hsv[..., 1] + tf.random.uniform([], -15.0, 15.0) / 255.0, 0.0, 1.0)
+    return tf.image.hsv_to_rgb(tf.stack([hue, saturation, hsv[..., 2]], axis=-1)) * 255.0
+
+
+def _grayscale(image):
+    alpha = tf.random.uniform([], 0.0, 0.2)
+    return (1.0 - alpha) * image + alpha * tf.image.rgb_to_grayscale(image)
+
+
+def _brightness(image):
+    add = lambda x: x + _per_channel(-10.0, 10.0)
+    multiply = lambda x: x * _per_channel(0.75, 1.25)
+    choice = tf.random.uniform([], 0, 3, dtype=tf.int32)
+    return tf.switch_case(choice, [lambda: multiply(add(image)), lambda: add(image), lambda: multiply(image)])
+
+
+def _gamma_contrast(image):
+    return 255.0 * tf.pow(image / 255.0, _per_channel(0.75, 1.25))
+
+
+def _sigmoid_contrast(image):
+    gain = _per_channel(0.0, 10.0)
+    cutoff = _per_channel(0.25, 0.75)
+    return 255.0 / (1.0 + tf.exp(gain * (cutoff - image / 255.0)))
+
+
+def _log_contrast(image):
+    return 255.0 * _per_channel(0.75, 1.0) * tf.math.log(1.0 + image / 255.0) / np.log(2.0)
+
+
+def _linear_contrast(image):
+    return 128.0 + _per_channel(0.7, 1.3) * (image - 128.0)
+
+
+def augment_image_graph(image):
+    """ Photometric augmentation of an RGB image in graph mode.
+
+    Re-expresses the imgaug sequence of the generator with TF ops. Median, bilateral and motion blur and the
+    frequency noise blending have no TF counterpart and are left out.
+
+    Args
+        image: (H, W, 3) float32 RGB image in [0, 255].
+
+    Returns
+        The augmented image, clipped to [0, 255].
+    """
+    clip = lambda x: tf.clip_by_value(x, 0.0, 255.0)
+
+    # blur, color, brightness and contrast are applied in the order of the imgaug sequence
+    image = _maybe(0.2, _gaussian_blur, image)
+    image = _maybe(0.2, _average_blur, image)
+    image = clip(_maybe(0.5, _hue_saturation, image))
+    image = clip(_maybe(0.5, _grayscale, image))
+    image = clip(_brightness(image))
+    for contrast in [_gamma_contrast, _sigmoid_contrast, _log_contrast, _linear_contrast]:
+        image = clip(_maybe(0.25, contrast, image))
+
+    return image
+
+
+def random_scaling_graph(image, mask, bboxes, poses, cam_params, min_scaling=0.95, max_scaling=1.05):
+    """ Random scaling around the image center, the graph version of the generator's random transform.
+
+    Args
+        image: (H, W, 3) float32 image.
+        mask: (H, W) int32 mask.
+        bboxes: (N, 4) boxes as x1, y1, x2, y2.
+        poses: (N, 7) poses, translation in mm followed by the quaternion.
+        cam_params: (N, 4) intrinsics fx, fy, cx, cy of every object.
+
+    Returns
+        The transformed image, mask, bboxes and poses.
+    """
+    height, width = image.shape[0], image.shape[1]
+    scale = tf.random.uniform([], min_scaling, max_scaling)
+    tx = 0.5 * width * (1.0 - scale)
+    ty = 0.5 * height * (1.0 - scale)
+
+    # projective transforms map output to input coordinates
+    transform = tf.stack([1.0 / scale, 0.0, -tx / scale, 0.0, 1.0 / scale, -ty / scale, 0.0, 0.0])[tf.newaxis]
+    image = tf.raw_ops.ImageProjectiveTransformV3(images=image[tf.newaxis], transforms=transform, output_shape=[height, width],
+                                                  fill_value=0.0, interpolation='BILINEAR', fill_mode='NEAREST')[0]
+    mask = tf.raw_ops.ImageProjectiveTransformV3(images=mask[tf.newaxis, :, :, tf.newaxis], transforms=transform, output_shape=[height, width],
+                                                 fill_value=0.0, interpolation='NEAREST', fill_mode='CONSTANT')[0, :, :, 0]
+
+    bboxes = bboxes * scale + tf.stack([tx, ty, tx, ty])[tf.newaxis]
+
+    # same as adjust_pose_annotation, requires image and optical center to be aligned
+    z = poses[:, 2] / scale
+    x = poses[:, 0] + ((tx + (cam_params[:, 2] * scale) - cam_params[:, 2]) * z) / cam_params[:, 0]
+    y = poses[:, 1] + ((ty + (cam_params[:, 3] * scale) - cam_params[:, 3]) * z) / cam_params[:, 1]
+    poses = tf.concat([tf.stack([x, y, z], axis=1), poses[:, 3:]], axis=1)
+
+    return image, mask, bboxes, poses
+
+
+def create_tfrecord_dataset(record_dir, data_dir, set_name, batch_size, image_min_side=480, image_max_side=640, augment=True, seed=None,
+                            shard_index=0, num_shards=1):
+    """ Create the training dataset from TFRecord shards written by write_tfrecords.
+
+    Args
+        record_dir: Directory holding the shards and index.json.
+        data_dir: Path to the dataset directory, the mesh info is read from it.
+        set_name: Name of the set.
+        batch_size: Size of the batches.
+        image_min_side: Height of the network input.
+        image_max_side: Width of the network input.
+        augment: Apply photometric and geometric augmentation.
+        seed: Seed of the shard and example shuffling.
+        shard_index: Index of the input pipeline, e.g. of the worker in multi-worker training.
+        num_shards: Number of input pipelines, every pipeline reads a disjoint subset of the record files.
+
+    Returns
+        A dataset of (images, intrinsics, sparse targets) batches like GeneratorDataset.
+    """
+    with open(os.path.join(record_dir, 'index.json'), 'r') as js:
+        index = json.load(js)
+    labels, TDboxes, sphere_diameters, sym_cont, sym_disc = _load_object_info(os.path.join(data_dir, 'meshes'), index['categories'])
+
+    feature_spec = {
+        'image': tf.io.FixedLenFeature([], tf.string),
+        'mask': tf.io.FixedLenFeature([], tf.string),
+        'mask_bits': tf.io.FixedLenFeature([], tf.int64),
+        'intrinsics': tf.io.FixedLenFeature([4], tf.float32),
+        'category_ids': tf.io.VarLenFeature(tf.int64),
+        'bboxes': tf.io.VarLenFeature(tf.float32),
+        'poses': tf.io.VarLenFeature(tf.float32),
+        'mask_ids': tf.io.VarLenFeature(tf.int64),
+        'visibility': tf.io.VarLenFeature(tf.float32),
+    }
+
+    def parse(serialized):
+        features = tf.io.parse_single_example(serialized, feature_spec)
+        dense = lambda key: tf.sparse.to_dense(features[key])
+
+        image = tf.cast(tf.io.decode_image(features['image'], channels=3, expand_animations=False), tf.float32)
+        image = tf.image.pad_to_bounding_box(image, 0, 0, image_min_side, image_max_side)
+        # 8 bit masks are scaled by 257 when decoded to 16 bit
+        mask = tf.cast(tf.io.decode_png(features['mask'], dtype=tf.uint16), tf.int32)
+        mask = tf.where(features['mask_bits'] == 8, mask // 257, mask)
+        mask = tf.image.resize(mask, (image_min_side, image_max_side), method='nearest')[:, :, 0]
+
+        # same object filtering as the generator
+        category_ids = dense('category_ids')
+        visibility = dense('visibility')
+        keep = visibility >= 0.25 if set_name == 'train' else tf.ones_like(visibility, dtype=tf.bool)
+        category_ids = tf.boolean_mask(category_ids, keep)
+        bboxes = tf.boolean_mask(tf.reshape(dense('bboxes'), (-1, 4)), keep)
+        poses = tf.boolean_mask(tf.reshape(dense('poses'), (-1, 7)), keep)
+        cam_params = tf.tile(features['intrinsics'][tf.newaxis], [tf.shape(category_ids)[0], 1])
+
+        if augment:
+            image = augment_image_graph(image)
+            image, mask, bboxes, poses = random_scaling_graph(image, mask, bboxes, poses, cam_params)
+
+        # RGB to BGR and caffe preprocessing, as preprocess_image
+        image = image[:, :, ::-1] - tf.constant([103.939, 116.779, 123.68])
+
+        objects = (tf.gather(labels, category_ids),
+                   tf.cast(tf.boolean_mask(dense('mask_ids'), keep), tf.int32),
+                   tf.gather(sphere_diameters, category_ids),
+                   tf.boolean_mask(visibility, keep),
+                   bboxes,
+                   poses,
+                   tf.gather(TDboxes, category_ids),
+                   cam_params,
+                   tf.gather(sym_disc, category_ids),
+                   tf.gather(sym_cont, category_ids))
+
+        return image, features['intrinsics'], mask, objects
+
+    def targets(images, intrinsics, masks, objects):
+        # flatten the ragged objects of the batch, the batch index is the row id
+        batch_index = tf.cast(objects[0].value_rowids(), tf.int32)
+        objects = (batch_index,) + tuple(ragged.values for ragged in objects)
+        return images, intrinsics, anchor_targets_graph(masks, objects)
+
+    # files are dealt to the input pipelines in sorted order, so the subsets are disjoint without a shared seed
+    paths = sorted(tf.io.gfile.glob(os.path.join(record_dir, set_name + '_*.tfrecord')))
+    if len(paths) < num_shards:
+        raise ValueError('{} record files can not be split between {} input pipelines, write more shards.'.format(len(paths), num_shards))
+    paths = paths[shard_index::num_shards]
+    files = tf.data.Dataset.from_tensor_slices(paths).shuffle(len(paths), seed=seed, reshuffle_each_iteration=True)
+    dataset = files.interleave(tf.data.TFRecordDataset, cycle_length=tf.data.experimental.AUTOTUNE,
+                               num_parallel_calls=tf.data.experimental.AUTOTUNE, deterministic=False)
+    dataset = dataset.shuffle(256, seed=seed, reshuffle_each_iteration=True).repeat()
+    dataset = dataset.map(parse, num_parallel_calls=tf.data.experimental.AUTOTUNE, deterministic=False)
+    dataset = dataset.apply(tf.data.experimental.dense_to_ragged_batch(batch_size, drop_remainder=True))
+    dataset = dataset.map(targets, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
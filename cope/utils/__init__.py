@@ -1 +1 @@
-from .pose_error import reproj, add, adi, re, te   # noqa: F401,F403
+from .pose_error import reproj, add, adi, re, te, reproj_batch, add_batch, adi_batch, re_batch, te_batch   # noqa: F401,F403
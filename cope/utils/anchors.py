@@ -19,20 +19,24 @@ def anchor_targets_bbox(
     annotations_group,
     num_classes,
 ):
+    """ Compute dense anchor targets for a batch of images.
 
-    assert(len(image_group) == len(annotations_group)), "The length of the images and annotations need to be equal."
-    assert(len(annotations_group) > 0), "No data received to compute anchor targets for."
-    for annotations in annotations_group:
-        assert('bboxes' in annotations), "Annotations should contain boxes."
-        assert('labels' in annotations), "Annotations should contain labels."
-        assert('poses' in annotations), "Annotations should contain labels."
-        assert('segmentations' in annotations), "Annotations should contain poses"
+    The targets are computed by anchor_targets_sparse and scattered into the dense
+    (batch, locations, num_classes, ...) arrays.
+
+    Args
+        image_group: List of preprocessed images of the batch.
+        annotations_group: List of annotation dictionaries of the batch.
+        num_classes: Number of object classes.
+
+    Returns
+        The (regression, detections, labels, locations, rotations, reprojection) target arrays.
+    """
+    label_indices, pose_indices, boxes3D, symmetry_mask, bboxes, diameters, translations, rotations = anchor_targets_sparse(image_group, annotations_group)
 
     batch_size = len(image_group)
-    pyramid_levels = [3, 4, 5]
-    image_shapes = guess_shapes(image_group[0].shape[:2], pyramid_levels)
-    location_shape = int(image_shapes[0][1] * image_shapes[0][0]) + int(image_shapes[1][1] * image_shapes[1][0]) + int(image_shapes[2][1] * image_shapes[2][0])
-    location_offset = [0, int(image_shapes[0][1] * image_shapes[0][0]), int(image_shapes[0][1] * image_shapes[0][0]) + int(image_shapes[1][1] * image_shapes[1][0])]
+    image_locations = locations_for_shape(image_group[0].shape)
+    location_shape = image_locations.shape[0]
 
     regression_batch = np.zeros((batch_size, location_shape, num_classes, 8, 16 + 1), dtype=keras.backend.floatx())
     detections_batch = np.zeros((batch_size, location_shape, num_classes, 4 + 1), dtype=keras.backend.floatx())
@@ -41,232 +45,151 @@ def anchor_targets_bbox(
     rotations_batch = np.zeros((batch_size, location_shape, num_classes, 8, 6 + 1), dtype=keras.backend.floatx())
     reprojection_batch = np.zeros((batch_size, location_shape, num_classes), dtype=keras.backend.floatx())
 
-    # compute labels and regression targets
-    for index, (image, annotations) in enumerate(zip(image_group, annotations_group)):
-
-        #image_raw = image
-        #image_raw[..., 0] += 103.939
-        #image_raw[..., 1] += 116.779
-        #image_raw[..., 2] += 123.68
-        #is_there_sym = False
-        #raw_images = []
-        #raw_images.append(copy.deepcopy(image_raw))
-        #raw_images.append(copy.deepcopy(image_raw))
-        #raw_images.append(copy.deepcopy(image_raw))
-        ##raw_images.append(copy.deepcopy(image_raw))
-        #image_raw_P3 = copy.deepcopy(image_raw)
-        #image_raw_P4 = copy.deepcopy(image_raw)
-        #image_raw_P5 = copy.deepcopy(image_raw)
-        #randex = str(np.random.randint(1000))
-
-        image_locations = locations_for_shape(image.shape)
-        image_locations_rep = np.repeat(image_locations[:, np.newaxis, :], repeats=8, axis=1)
-        # w/o mask
-        mask = annotations['mask'][0]
-        mask = cv2.medianBlur(mask, 7)
-
-        # vanilla
-        masks_level = []
-        for jdx, resx in enumerate(image_shapes):
-            mask_level = np.asarray(Image.fromarray(mask).resize((resx[1], resx[0]), Image.NEAREST)).flatten()
-            masks_level.append(mask_level.flatten())
-            back_objs = np.where(mask_level == 0)[0] + location_offset[jdx]
-            labels_batch[index, back_objs, -1] = 0
-
-        #calculated_boxes = np.empty((0, 16))
-
-        for idx, pose in enumerate(annotations['poses']):
-
-            if pose[2] < 0.0:
-                continue
-
-            cls = int(annotations['labels'][idx])
-            mask_id = annotations['mask_ids'][idx]
-            obj_diameter = annotations['diameters'][idx]
-
-            # pyrmid_index from diameter
-            ex = obj_diameter / pose[2]
-            #reso_van = np.round(np.log(ex) / np.log(3.5))
-            reso_van = np.round(np.log(ex) / np.log(3.0))
-            #for norm of object diemnsions
-            # reason:
-            # long-shaped object fall into lower levels than diameter
-            # while boxy objects
-            if reso_van < -2:
-                reso_van = -2
-            reso_idx = int(2 + reso_van)
-            locations_positive_obj = np.where(masks_level[reso_idx] == int(mask_id))[0] + location_offset[reso_idx]
-
-            #locations_positive_obj = []
-            #for reso_idx in range(len(masks_level)):
-            #    locations_positive_obj.append(
-            #        np.where(masks_level[reso_idx] == int(mask_id))[0] + location_offset[reso_idx])
-            #locations_positive_obj = np.concatenate(locations_positive_obj, axis=0)
-
-            '''
-            if reso_idx==0:
-                vizmask = np.zeros((4800, 3))
-                locations_positive_obj_3 = np.where(masks_level[0] == int(mask_id))[0]
-                vizmask[locations_positive_obj_3, :] = (np.random.randint(255), np.random.randint(255), np.random.randint(255))
-                vizmask = np.reshape(vizmask, (60, 80, 3))
-                vizmask = cv2.resize(vizmask, (640, 480), interpolation=cv2.INTER_NEAREST)
-                image_raw_P3 = np.where(vizmask > 0, vizmask, image_raw_P3)
-            elif reso_idx==1:
-                vizmask = np.zeros((1200, 3))
-                locations_positive_obj_4 = np.where(masks_level[1] == int(mask_id))[0]
-                vizmask[locations_positive_obj_4, :] = (np.random.randint(255), np.random.randint(255), np.random.randint(255))
-                vizmask = np.reshape(vizmask, (30, 40, 3))
-                vizmask = cv2.resize(vizmask, (640, 480), interpolation=cv2.INTER_NEAREST)
-                image_raw_P4 = np.where(vizmask > 0, vizmask, image_raw_P4)
-            elif reso_idx==2:
-                vizmask = np.zeros((300, 3))
-                locations_positive_obj_5 = np.where(masks_level[2] == int(mask_id))[0]
-                vizmask[locations_positive_obj_5, :] = (np.random.randint(255), np.random.randint(255), np.random.randint(255))
-                vizmask = np.reshape(vizmask, (15, 20, 3))
-                vizmask = cv2.resize(vizmask, (640, 480), interpolation=cv2.INTER_NEAREST)
-                image_raw_P5 = np.where(vizmask > 0, vizmask, image_raw_P5)
-            '''
-
-            #ego_pose = np.eye(4)
-            #ego_pose[:3, :3] = tf3d.quaternions.quat2mat(pose[3:])
-            #ego_pose[:3, 3] = pose[:3]
-            #allo_pose = egocentric_to_allocentric(ego_pose)
-
-            if locations_positive_obj.shape[0] > 1:
-
-                labels_batch[index, locations_positive_obj, -1] = 1
-                labels_batch[index, locations_positive_obj, cls] = 1
-
-                if annotations['visibility'][idx] < 0.5:
-                    continue
-
-                # handling rotational symmetries
-                if np.sum(annotations['sym_con'][idx][0, :]) > 0:
-                    #allo_pose = get_cont_sympose(allo_full, annotations['sym_con'][idx])
-                    trans = np.eye(4)
-                    trans[:3, :3] = tf3d.quaternions.quat2mat(pose[3:]).reshape((3, 3))
-                    trans[:3, 3] = pose[:3]
-                    pose_mat = get_cont_sympose(trans, annotations['sym_con'][idx])
-                    pose[3:] = tf3d.quaternions.mat2quat(pose_mat[:3, :3])
-
-                rot = tf3d.quaternions.quat2mat(pose[3:])
-                rot = np.asarray(rot, dtype=np.float32)
-                tra = pose[:3]
-                #rot = np.asarray(allo_pose[:3, :3], dtype=np.float32)
-                #tra = allo_pose[:3, 3]
-                full_T = np.eye((4))
-                full_T[:3, :3] = rot
-                full_T[:3, 3] = tra
-                tDbox = rot[:3, :3].dot(annotations['segmentations'][idx].T).T
-                tDbox = tDbox + np.repeat(tra[np.newaxis, 0:3], 8, axis=0)
-
-                box3D = toPix_array(tDbox, fx=annotations['cam_params'][idx][0], fy=annotations['cam_params'][idx][1],
-                                    cx=annotations['cam_params'][idx][2], cy=annotations['cam_params'][idx][3])
-                box3D = np.reshape(box3D, (16))
-                #calculated_boxes = np.concatenate([calculated_boxes, [box3D]], axis=0)
-
-                # handling discrete symmetries
-                hyps_boxes = np.repeat(box3D[np.newaxis, :], repeats=8, axis=0)
-                #calculated_boxes = np.concatenate([calculated_boxes, hyps_boxes], axis=0)
-
-                #hyps_pose = np.repeat(allo_pose[np.newaxis, :, :], repeats=8, axis=0)
-                hyps_pose = np.repeat(full_T[np.newaxis, :, :], repeats=8, axis=0)
-                symmetry_mask = np.zeros(8)
-                symmetry_mask[0] = 1
-
-                is_sym = False
-                sym_disc = annotations['sym_dis'][idx]
-                if np.sum(np.abs(sym_disc)) != 0:
-                    for sdx in range(sym_disc.shape[0]):
-                        if np.sum(np.abs(sym_disc[sdx, :])) != 0:
-                            T_sym = np.matmul(full_T, np.array(sym_disc[sdx, :]).reshape((4, 4)))
-                            hyps_pose[sdx, :, :] = T_sym
-                            rot_sym = T_sym[:3, :3]
-                            tra = T_sym[:3, 3]
-                            tDbox = rot_sym.dot(annotations['segmentations'][idx].T).T
-                            tDbox = tDbox + np.repeat(tra[np.newaxis, 0:3], 8, axis=0)
-
-                            box3D_sym = toPix_array(tDbox, fx=annotations['cam_params'][idx][0],
-                                                    fy=annotations['cam_params'][idx][1],
-                                                    cx=annotations['cam_params'][idx][2],
-                                                    cy=annotations['cam_params'][idx][3])
-                            box3D_sym = np.reshape(box3D_sym, (16))
-                            hyps_boxes[sdx, :] = box3D_sym
-                            symmetry_mask[sdx+1] = 1
-                            # viz from here on
-
-                #points = box3D_transform(box3D, image_locations[locations_positive_obj, :], obj_diameter)
-                points = box3D_transform_symmetric(hyps_boxes, image_locations_rep[locations_positive_obj, :, :], obj_diameter)
-                regression_batch[index, locations_positive_obj, cls, :, :16] = points
-                regression_batch[index, locations_positive_obj, cls, :, -1] = symmetry_mask
-
-                boxes2D = boxes_transform(annotations['bboxes'][idx], image_locations[locations_positive_obj, :], obj_diameter)
-                detections_batch[index, locations_positive_obj, cls, :4] = boxes2D
-                detections_batch[index, locations_positive_obj, cls, -1] = 1
-
-                #locations_batch[index, locations_positive_obj, cls, :, :2] = hyps_pose[:, :2, 3] * 0.002
-                #locations_batch[index, locations_positive_obj, cls, :, 2] = ((hyps_pose[:, 2, 3] * 0.001) - 1.0) * 3.0
-                #locations_batch[index, locations_positive_obj, cls, :, -1] = 1
-
-                locations_batch[index, locations_positive_obj, cls, :2] = tra[:2] * 0.002
-                locations_batch[index, locations_positive_obj, cls, 2] = ((tra[2] * 0.001) - 1.0) * 3.0
-                locations_batch[index, locations_positive_obj, cls, -1] = 1
-
-                rotations_batch[index, locations_positive_obj, cls, :, :6] = np.transpose(hyps_pose[:, :3, :2], axes=(0, 2, 1)).reshape(8, 6)
-                #rotations_batch[index, locations_positive_obj, cls, :6] = full_T[:3, :2].T.reshape(6)
-                #rotations_batch[index, locations_positive_obj, cls, :, -1] = 1
-                rotations_batch[index, locations_positive_obj, cls, :, -1] = symmetry_mask
-
-                #reprojection_batch[index, locations_positive_obj, cls, 16:] = 1
-                reprojection_batch[index, locations_positive_obj, cls] = 1
-
-                #est_box = annotations['bboxes'][idx]
-                #image_raw = cv2.rectangle(image_raw, (int(est_box[0]), int(est_box[1])),
-                #                    (int(est_box[2]), int(est_box[3])), (42, 205, 50), 2)
-
-                # font
-                #font = cv2.FONT_HERSHEY_SIMPLEX
-                #org = (int(est_box[2]), int(est_box[3]))
-                #fontScale = 1
-                #color = (255, 0, 0)
-                #thickness = 2
-                #image_raw = cv2.putText(image_raw, str(cls), org, font,
-                #                    fontScale, color, thickness, cv2.LINE_AA)
-
-                #pose = box3D.astype(np.uint16)
-#
-                #colR = 250
-                #colG = 25
-                #colB = 175
-#
-                #image_raw = cv2.line(image_raw, tuple(pose[0:2].ravel()), tuple(pose[2:4].ravel()), (130, 245, 13), 2)
-                #image_raw = cv2.line(image_raw, tuple(pose[2:4].ravel()), tuple(pose[4:6].ravel()), (50, 112, 220), 2)
-                #image_raw = cv2.line(image_raw, tuple(pose[4:6].ravel()), tuple(pose[6:8].ravel()), (50, 112, 220), 2)
-                #image_raw = cv2.line(image_raw, tuple(pose[6:8].ravel()), tuple(pose[0:2].ravel()), (50, 112, 220), 2)
-                #image_raw = cv2.line(image_raw, tuple(pose[0:2].ravel()), tuple(pose[8:10].ravel()), (colR, colG, colB),
-                #               2)
-                #image_raw = cv2.line(image_raw, tuple(pose[2:4].ravel()), tuple(pose[10:12].ravel()),
-                #               (colR, colG, colB), 2)
-                #image_raw = cv2.line(image_raw, tuple(pose[4:6].ravel()), tuple(pose[12:14].ravel()),
-                #               (colR, colG, colB), 2)
-                #image_raw = cv2.line(image_raw, tuple(pose[6:8].ravel()), tuple(pose[14:16].ravel()),
-                #               (colR, colG, colB), 2)
-                #image_raw = cv2.line(image_raw, tuple(pose[8:10].ravel()), tuple(pose[10:12].ravel()),
-                #               (colR, colG, colB), 2)
-                #image_raw = cv2.line(image_raw, tuple(pose[10:12].ravel()), tuple(pose[12:14].ravel()),
-                #               (colR, colG, colB), 2)
-                #image_raw = cv2.line(image_raw, tuple(pose[12:14].ravel()), tuple(pose[14:16].ravel()),
-                #               (colR, colG, colB), 2)
-                #image_raw = cv2.line(image_raw, tuple(pose[14:16].ravel()), tuple(pose[8:10].ravel()),
-                #               (colR, colG, colB), 2)
-
-    #cv2.imwrite('/home/stefan/debug_viz/' + randex + 'image.png', image_raw)
-    #cv2.imwrite('/home/stefan/debug_viz/' + randex + 'P4.png', image_raw_P4)
-    #cv2.imwrite('/home/stefan/debug_viz/' + randex + 'P5.png', image_raw_P5)
+    labels_batch[label_indices[:, 0], label_indices[:, 1], label_indices[:, 2]] = 1
+    labels_batch[label_indices[:, 0], label_indices[:, 1], -1] = 1
+
+    b, loc, cls, obj = pose_indices.T
+    locations_positive = image_locations[loc, :]
+    obj_diameter = diameters[obj]
+    regression_batch[b, loc, cls, :, :16] = (np.tile(locations_positive, (1, 8))[:, np.newaxis, :] - boxes3D[obj]) / (0.65 * obj_diameter[:, np.newaxis, np.newaxis])
+    regression_batch[b, loc, cls, :, -1] = symmetry_mask[obj]
+    detections_batch[b, loc, cls, :4] = boxes_transform(bboxes[obj].T, locations_positive, obj_diameter[:, np.newaxis])
+    detections_batch[b, loc, cls, -1] = 1
+    locations_batch[b, loc, cls, :2] = translations[obj, :2] * 0.002
+    locations_batch[b, loc, cls, 2] = ((translations[obj, 2] * 0.001) - 1.0) * 3.0
+    locations_batch[b, loc, cls, -1] = 1
+    rotations_batch[b, loc, cls, :, :6] = rotations[obj]
+    rotations_batch[b, loc, cls, :, -1] = symmetry_mask[obj]
+    reprojection_batch[b, loc, cls] = 1
 
     return regression_batch, detections_batch, labels_batch, locations_batch, rotations_batch, reprojection_batch
 
 
+def anchor_targets_sparse(
+    image_group,
+    annotations_group,
+):
+    """ Compute sparse anchor targets for a batch of images.
+
+    Instead of the dense (batch, locations, num_classes, ...) tensors of anchor_targets_bbox only the positive
+    locations and one payload per object are returned. The per-location regression targets are derived from
+    them on the device, see losses.gather_targets.
+    All objects of all images are processed at once, only the mask downsampling iterates over the images.
+
+    Args
+        image_group: List of preprocessed images of the batch.
+        annotations_group: List of annotation dictionaries of the batch.
+
+    Returns
+        label_indices: (N, 3) int32 array of [batch, location, class] for every positive location.
+        pose_indices: (P, 4) int32 array of [batch, location, class, object] for locations with pose supervision.
+        boxes3D: (M, 8, 16) array of the projected 3D box corners for every symmetry hypothesis of an object.
+        symmetry_mask: (M, 8) array indicating the valid symmetry hypotheses of an object.
+        bboxes: (M, 4) array of the 2D bounding boxes of an object.
+        diameters: (M,) array of the object diameters.
+        translations: (M, 3) array of the object translations.
+        rotations: (M, 8, 6) array of the first two rotation columns for every symmetry hypothesis of an object.
+    """
+
+    assert(len(image_group) == len(annotations_group)), "The length of the images and annotations need to be equal."
+    assert(len(annotations_group) > 0), "No data received to compute anchor targets for."
+    for annotations in annotations_group:
+        assert('bboxes' in annotations), "Annotations should contain boxes."
+        assert('labels' in annotations), "Annotations should contain labels."
+        assert('poses' in annotations), "Annotations should contain labels."
+        assert('segmentations' in annotations), "Annotations should contain poses"
+
+    pyramid_levels = [3, 4, 5]
+    image_shapes = guess_shapes(image_group[0].shape[:2], pyramid_levels)
+
+    # mask ids and pyramid level of every location
+    masks_batch = np.stack([np.concatenate(downsample_mask(annotations['mask'][0], image_shapes), axis=0) for annotations in annotations_group], axis=0)
+    location_level = np.concatenate([np.full(int(resx[0] * resx[1]), jdx) for jdx, resx in enumerate(image_shapes)], axis=0)
+
+    # stack the objects of all images
+    floatx = keras.backend.floatx()
+    batch_index = np.concatenate([np.full(annotations['poses'].shape[0], index, dtype=np.int32) for index, annotations in enumerate(annotations_group)], axis=0)
+    def stack(key, shape):
+        return np.concatenate([np.asarray(annotations[key], dtype=np.float64).reshape((-1,) + shape) for annotations in annotations_group], axis=0)
+    poses = stack('poses', (7,))
+    labels = stack('labels', ()).astype(np.int32)
+    mask_ids = stack('mask_ids', ()).astype(np.int64)
+    diameters = stack('diameters', ())
+    visibility = stack('visibility', ())
+    bboxes = stack('bboxes', (4,))
+    segmentations = stack('segmentations', (8, 3))
+    cam_params = stack('cam_params', (4,))
+    sym_dis = stack('sym_dis', (8, 16))
+    sym_con = stack('sym_con', (2, 3))
+
+    # pyramid index from diameter, objects behind the camera get no level
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reso_van = np.round(np.log(diameters / poses[:, 2]) / np.log(3.0))
+    reso_idx = np.clip(np.nan_to_num(reso_van, nan=0.0), -2, 0).astype(np.int64) + 2
+    reso_idx = np.where(poses[:, 2] < 0.0, -1, reso_idx)
+
+    positives = (masks_batch[batch_index, :] == mask_ids[:, np.newaxis]) & (location_level[np.newaxis, :] == reso_idx[:, np.newaxis])
+    valid_objects = np.sum(positives, axis=1) > 1
+    positives &= valid_objects[:, np.newaxis]
+    pose_objects = valid_objects & (visibility >= 0.5)
+
+    pos_obj, pos_loc = np.nonzero(positives)
+    label_indices = np.stack([batch_index[pos_obj], pos_loc, labels[pos_obj]], axis=1).astype(np.int32)
+
+    # objects with pose supervision
+    object_index = np.cumsum(pose_objects) - 1
+    pose_positive = pose_objects[pos_obj]
+    pose_indices = np.concatenate([label_indices[pose_positive], object_index[pos_obj[pose_positive]][:, np.newaxis].astype(np.int32)], axis=1)
+
+    poses = poses[pose_objects]
+    segmentations = segmentations[pose_objects]
+    cam_params = cam_params[pose_objects]
+    sym_dis = sym_dis[pose_objects]
+    sym_con = sym_con[pose_objects]
+    num_objects = poses.shape[0]
+
+    rot = quat2mat_array(poses[:, 3:])
+    tra = poses[:, :3]
+
+    # handling rotational symmetries
+    rot = cont_sympose_array(rot, tra, sym_con)
+
+    full_T = np.repeat(np.eye(4)[np.newaxis, :, :], num_objects, axis=0)
+    full_T[:, :3, :3] = rot
+    full_T[:, :3, 3] = tra
+
+    # handling discrete symmetries, hypothesis sdx is replaced by the symmetric pose while sdx + 1 is marked valid
+    sym_valid = np.sum(np.abs(sym_dis), axis=2) != 0
+    hyps_pose = np.repeat(full_T[:, np.newaxis, :, :], repeats=8, axis=1)
+    sym_pose = np.matmul(full_T[:, np.newaxis, :, :], sym_dis.reshape((num_objects, 8, 4, 4)))
+    hyps_pose = np.where(sym_valid[:, :, np.newaxis, np.newaxis], sym_pose, hyps_pose)
+    symmetry_mask = np.zeros((num_objects, 8))
+    symmetry_mask[:, 0] = 1
+    symmetry_mask[:, 1:] = np.maximum(symmetry_mask[:, 1:], sym_valid[:, :7])
+
+    # translation of the last symmetric hypothesis
+    last_sym = 7 - np.argmax(sym_valid[:, ::-1], axis=1)
+    translations = np.where(np.any(sym_valid, axis=1)[:, np.newaxis], hyps_pose[np.arange(num_objects), last_sym, :3, 3], tra)
+
+    # project the 8 corners of all hypotheses of all objects
+    tDbox = np.einsum('mhij,mkj->mhki', hyps_pose[:, :, :3, :3], segmentations) + hyps_pose[:, :, np.newaxis, :3, 3]
+    fx, fy, cx, cy = [cam_params[:, i, np.newaxis, np.newaxis] for i in range(4)]
+    xpix = ((tDbox[..., 0] * fx) / tDbox[..., 2]) + cx
+    ypix = ((tDbox[..., 1] * fy) / tDbox[..., 2]) + cy
+    boxes3D = np.stack([xpix, ypix], axis=3).reshape((num_objects, 8, 16))
+
+    rotations = np.transpose(hyps_pose[:, :, :3, :2], axes=(0, 1, 3, 2)).reshape((num_objects, 8, 6))
+
+    return (label_indices,
+            pose_indices,
+            boxes3D.astype(floatx),
+            symmetry_mask.astype(floatx),
+            bboxes[pose_objects].astype(floatx),
+            diameters[pose_objects].astype(floatx),
+            translations.astype(floatx),
+            rotations.astype(floatx))
+
+
 def layer_shapes(image_shape, model):
     """Compute layer shapes given input image shape and the model.
 
@@ -411,111 +334,266 @@ def boxes_transform(box, locations, obj_diameter, mean=None, std=None):
     return targets
 
 
-def box3D_transform(box, locations, obj_diameter, mean=None, std=None):
-    """Compute bounding-box regression targets for an image."""
+def downsample_mask(mask, image_shapes, ksize=7):
+    """ Median filter a mask and downsample it to the pyramid levels with nearest neighbour sampling.
 
-    if mean is None:
-        mean = np.full(16, 0)  # np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])
-    if std is None:
-        std = np.full(16, 0.65)
+    Equivalent to cv2.medianBlur followed by a PIL nearest resize, but the median is only evaluated at the
+    sampled pixels.
 
-    if isinstance(mean, (list, tuple)):
-        mean = np.array(mean)
-    elif not isinstance(mean, np.ndarray):
-        raise ValueError('Expected mean to be a np.ndarray, list or tuple. Received: {}'.format(type(mean)))
-
-    if isinstance(std, (list, tuple)):
-        std = np.array(std) 
-    elif not isinstance(std, np.ndarray):
-        raise ValueError('Expected std to be a np.ndarray, list or tuple. Received: {}'.format(type(std)))
-
-    targets_dx0 = locations[:, 0] - box[0]
-    targets_dy0 = locations[:, 1] - box[1]
-    targets_dx1 = locations[:, 0] - box[2]
-    targets_dy1 = locations[:, 1] - box[3]
-    targets_dx2 = locations[:, 0] - box[4]
-    targets_dy2 = locations[:, 1] - box[5]
-    targets_dx3 = locations[:, 0] - box[6]
-    targets_dy3 = locations[:, 1] - box[7]
-    targets_dx4 = locations[:, 0] - box[8]
-    targets_dy4 = locations[:, 1] - box[9]
-    targets_dx5 = locations[:, 0] - box[10]
-    targets_dy5 = locations[:, 1] - box[11]
-    targets_dx6 = locations[:, 0] - box[12]
-    targets_dy6 = locations[:, 1] - box[13]
-    targets_dx7 = locations[:, 0] - box[14]
-    targets_dy7 = locations[:, 1] - box[15]
-
-    targets = np.stack((targets_dx0, targets_dy0, targets_dx1, targets_dy1, targets_dx2, targets_dy2, targets_dx3, targets_dy3, targets_dx4, targets_dy4, targets_dx5, targets_dy5, targets_dx6, targets_dy6, targets_dx7, targets_dy7), axis=1)
-    targets = (targets - mean) / (std * obj_diameter)
+    Args
+        mask: The (H, W) mask of object ids.
+        image_shapes: List of the (rows, cols) shapes of the pyramid levels.
+        ksize: Aperture of the median filter.
 
-    return targets
+    Returns
+        A list with the flattened mask of every pyramid level.
+    """
+    radius = ksize // 2
+    padded = np.pad(mask, radius, mode='edge')
+    offsets = np.arange(ksize)
 
+    masks_level = []
+    for rows, cols in image_shapes:
+        rows, cols = int(rows), int(cols)
+        y = np.minimum(np.floor((np.arange(rows) + 0.5) * (mask.shape[0] / rows)).astype(np.int64), mask.shape[0] - 1)
+        x = np.minimum(np.floor((np.arange(cols) + 0.5) * (mask.shape[1] / cols)).astype(np.int64), mask.shape[1] - 1)
+        y = y[:, np.newaxis] + offsets[np.newaxis, :]
+        x = x[:, np.newaxis] + offsets[np.newaxis, :]
+        patches = padded[y[:, np.newaxis, :, np.newaxis], x[np.newaxis, :, np.newaxis, :]].reshape((rows * cols, ksize * ksize))
+        masks_level.append(np.partition(patches, (ksize * ksize) // 2, axis=1)[:, (ksize * ksize) // 2])
 
-def box3D_transform_symmetric(box, locations, obj_diameter, mean=None, std=None):
-    """Compute bounding-box regression targets for an image."""
+    return masks_level
 
-    if mean is None:
-        mean = np.full(16, 0)  # np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])
-    if std is None:
-        std = np.full(16, 0.65)
 
-    if isinstance(mean, (list, tuple)):
-        mean = np.array(mean)
-    elif not isinstance(mean, np.ndarray):
-        raise ValueError('Expected mean to be a np.ndarray, list or tuple. Received: {}'.format(type(mean)))
+def quat2mat_array(quaternions):
+    """ Convert an array of (w, x, y, z) quaternions of shape (N, 4) to rotation matrices of shape (N, 3, 3).
+    """
+    w, x, y, z = [quaternions[:, i] for i in range(4)]
+    Nq = w * w + x * x + y * y + z * z
+    s = np.where(Nq < np.finfo(np.float64).eps, 0.0, 2.0 / np.where(Nq == 0.0, 1.0, Nq))
+    X = x * s
+    Y = y * s
+    Z = z * s
+    wX = w * X; wY = w * Y; wZ = w * Z
+    xX = x * X; xY = x * Y; xZ = x * Z
+    yY = y * Y; yZ = y * Z; zZ = z * Z
+    mats = np.stack([1.0 - (yY + zZ), xY - wZ, xZ + wY,
+                     xY + wZ, 1.0 - (xX + zZ), yZ - wX,
+                     xZ - wY, yZ + wX, 1.0 - (xX + yY)], axis=1)
 
-    if isinstance(std, (list, tuple)):
-        std = np.array(std)
-    elif not isinstance(std, np.ndarray):
-        raise ValueError('Expected std to be a np.ndarray, list or tuple. Received: {}'.format(type(std)))
+    return mats.reshape((-1, 3, 3))
 
-    targets_dx0 = locations[:, :, 0] - box[:, 0]
-    targets_dy0 = locations[:, :, 1] - box[:, 1]
-    targets_dx1 = locations[:, :, 0] - box[:, 2]
-    targets_dy1 = locations[:, :, 1] - box[:, 3]
-    targets_dx2 = locations[:, :, 0] - box[:, 4]
-    targets_dy2 = locations[:, :, 1] - box[:, 5]
-    targets_dx3 = locations[:, :, 0] - box[:, 6]
-    targets_dy3 = locations[:, :, 1] - box[:, 7]
-    targets_dx4 = locations[:, :, 0] - box[:, 8]
-    targets_dy4 = locations[:, :, 1] - box[:, 9]
-    targets_dx5 = locations[:, :, 0] - box[:, 10]
-    targets_dy5 = locations[:, :, 1] - box[:, 11]
-    targets_dx6 = locations[:, :, 0] - box[:, 12]
-    targets_dy6 = locations[:, :, 1] - box[:, 13]
-    targets_dx7 = locations[:, :, 0] - box[:, 14]
-    targets_dy7 = locations[:, :, 1] - box[:, 15]
-
-    targets = np.stack((targets_dx0, targets_dy0, targets_dx1, targets_dy1, targets_dx2, targets_dy2, targets_dx3, targets_dy3, targets_dx4, targets_dy4, targets_dx5, targets_dy5, targets_dx6, targets_dy6, targets_dx7, targets_dy7), axis=2)
-    targets = (targets - mean) / (std * obj_diameter)
 
-    return targets
+def cont_sympose_array(rot, tra, sym):
+    """ Rotates objects with continuous symmetries to face the camera.
 
+    Args
+        rot: (N, 3, 3) array of rotation matrices.
+        tra: (N, 3) array of translations.
+        sym: (N, 2, 3) array of the continuous symmetry axis and offset per object.
 
-def toPix_array(translation, fx=None, fy=None, cx=None, cy=None):
+    Returns
+        The (N, 3, 3) array of rotation matrices, unchanged for objects without continuous symmetry.
+    """
+    cam_in_obj = -np.einsum('nji,nj->ni', rot, tra)
+    is_sym = np.sum(sym[:, 0, :], axis=1) > 0
+    axis = np.where(sym[:, 0, 2] == 1, 2, np.where(sym[:, 0, 1] == 1, 1, np.where(sym[:, 0, 0] == 1, 0, -1)))
+    alpha = np.select([axis == 2, axis == 1, axis == 0],
+                      [np.arctan2(cam_in_obj[:, 1], cam_in_obj[:, 0]),
+                       np.arctan2(cam_in_obj[:, 0], cam_in_obj[:, 2]),
+                       np.arctan2(cam_in_obj[:, 2], cam_in_obj[:, 1])], default=0.0)
+    ca = np.cos(alpha)
+    sa = np.sin(alpha)
+    zeros = np.zeros_like(alpha)
+    ones = np.ones_like(alpha)
+    rot_z = np.stack([ca, -sa, zeros, sa, ca, zeros, zeros, zeros, ones], axis=1).reshape((-1, 3, 3))
+    rot_y = np.stack([ca, zeros, sa, zeros, ones, zeros, -sa, zeros, ca], axis=1).reshape((-1, 3, 3))
+    rot_x = np.stack([ones, zeros, zeros, zeros, ca, -sa, zeros, sa, ca], axis=1).reshape((-1, 3, 3))
+    sym_rot = np.where((axis == 2)[:, np.newaxis, np.newaxis], rot_z, np.where((axis == 1)[:, np.newaxis, np.newaxis], rot_y, rot_x))
+    apply = (is_sym & (axis >= 0))[:, np.newaxis, np.newaxis]
+
+    return np.where(apply, np.matmul(rot, sym_rot), rot)
+
+
+def pack_annotations(annotations_group):
+    """ Pack the raw annotations of a batch for anchor_targets_graph.
 
-    xpix = ((translation[:, 0] * fx) / translation[:, 2]) + cx
-    ypix = ((translation[:, 1] * fy) / translation[:, 2]) + cy
+    Args
+        annotations_group: List of annotation dictionaries of the batch.
 
-    return np.stack((xpix, ypix), axis=1)
+    Returns
+        masks: (B, H, W) int32 array of the object id masks.
+        objects: Tuple of the per-object arrays of all images, starting with the batch index of every object.
+    """
+    floatx = keras.backend.floatx()
+    masks = np.stack([annotations['mask'][0] for annotations in annotations_group], axis=0).astype(np.int32)
+    batch_index = np.concatenate([np.full(annotations['poses'].shape[0], index, dtype=np.int32) for index, annotations in enumerate(annotations_group)], axis=0)
+    def stack(key, shape, dtype=floatx):
+        return np.concatenate([np.asarray(annotations[key]).reshape((-1,) + shape) for annotations in annotations_group], axis=0).astype(dtype)
+
+    return masks, (batch_index,
+                   stack('labels', (), np.int32),
+                   stack('mask_ids', (), np.int32),
+                   stack('diameters', ()),
+                   stack('visibility', ()),
+                   stack('bboxes', (4,)),
+                   stack('poses', (7,)),
+                   stack('segmentations', (8, 3)),
+                   stack('cam_params', (4,)),
+                   stack('sym_dis', (8, 16)),
+                   stack('sym_con', (2, 3)))
+
+
+@tf.function
+def anchor_targets_graph(masks, objects):
+    """ TensorFlow version of anchor_targets_sparse, computes the sparse anchor targets from the packed annotations.
+
+    Runs in graph mode, either as map of the input pipeline or on the device at the start of the train step.
 
+    Args
+        masks: (B, H, W) int32 tensor of the object id masks, H and W have to be static.
+        objects: Tuple of per-object tensors as returned by pack_annotations.
 
-def get_cont_sympose(rot_pose, sym):
+    Returns
+        The same tuple of sparse targets as anchor_targets_sparse.
+    """
+    batch_index, labels, mask_ids, diameters, visibility, bboxes, poses, segmentations, cam_params, sym_dis, sym_con = objects
+    floatx = keras.backend.floatx()
+    poses = tf.cast(poses, tf.float32)
 
-    #print('trans: ', rot_pose)
-    cam_in_obj = np.dot(np.linalg.inv(rot_pose), (0, 0, 0, 1))
-    if sym[0][2] == 1:
-        alpha = math.atan2(cam_in_obj[1], cam_in_obj[0])
-        rota = np.dot(rot_pose[:3, :3], tf3d.euler.euler2mat(0.0, 0.0, alpha, 'sxyz'))
-    elif sym[0][1] == 1:
-        alpha = math.atan2(cam_in_obj[0], cam_in_obj[2])
-        rota = np.dot(rot_pose[:3, :3], tf3d.euler.euler2mat(0.0, alpha, 0.0, 'sxyz'))
-    elif sym[0][0] == 1:
-        alpha = math.atan2(cam_in_obj[2], cam_in_obj[1])
-        rota = np.dot(rot_pose[:3, :3], tf3d.euler.euler2mat(alpha, 0.0, 0.0, 'sxyz'))
-    #rot_pose[3:] = tf3d.quaternions.mat2quat(rota)
-    rot_pose[:3, :3] = rota
+    # mask ids and pyramid level of every location
+    pyramid_levels = [3, 4, 5]
+    image_shapes = guess_shapes(masks.shape[1:3], pyramid_levels)
+    masks_batch = tf.concat(downsample_mask_graph(masks, image_shapes), axis=1)
+    location_level = np.concatenate([np.full(int(resx[0] * resx[1]), jdx, dtype=np.int32) for jdx, resx in enumerate(image_shapes)], axis=0)
+
+    # pyramid index from diameter, objects behind the camera get no level
+    reso_van = tf.round(tf.math.log(tf.cast(diameters, tf.float32) / poses[:, 2]) / math.log(3.0))
+    reso_idx = tf.cast(tf.clip_by_value(tf.where(tf.math.is_nan(reso_van), 0.0, reso_van), -2.0, 0.0), tf.int32) + 2
+    reso_idx = tf.where(poses[:, 2] < 0.0, -1, reso_idx)
+
+    positives = tf.logical_and(tf.equal(tf.gather(masks_batch, batch_index), mask_ids[:, tf.newaxis]),
+                               tf.equal(location_level[tf.newaxis, :], reso_idx[:, tf.newaxis]))
+    valid_objects = tf.reduce_sum(tf.cast(positives, tf.int32), axis=1) > 1
+    positives = tf.logical_and(positives, valid_objects[:, tf.newaxis])
+    pose_objects = tf.logical_and(valid_objects, visibility >= 0.5)
+
+    positive_indices = tf.cast(tf.where(positives), tf.int32)
+    pos_obj = positive_indices[:, 0]
+    label_indices = tf.stack([tf.gather(batch_index, pos_obj), positive_indices[:, 1], tf.gather(labels, pos_obj)], axis=1)
+
+    # objects with pose supervision
+    object_index = tf.cumsum(tf.cast(pose_objects, tf.int32)) - 1
+    pose_positive = tf.gather(pose_objects, pos_obj)
+    pose_indices = tf.concat([tf.boolean_mask(label_indices, pose_positive),
+                              tf.boolean_mask(tf.gather(object_index, pos_obj), pose_positive)[:, tf.newaxis]], axis=1)
+
+    poses = tf.boolean_mask(poses, pose_objects)
+    segmentations = tf.cast(tf.boolean_mask(segmentations, pose_objects), tf.float32)
+    cam_params = tf.cast(tf.boolean_mask(cam_params, pose_objects), tf.float32)
+    sym_dis = tf.cast(tf.boolean_mask(sym_dis, pose_objects), tf.float32)
+    sym_con = tf.cast(tf.boolean_mask(sym_con, pose_objects), tf.float32)
+    num_objects = tf.shape(poses)[0]
+
+    tra = poses[:, :3]
+    rot = cont_sympose_graph(quat2mat_graph(poses[:, 3:]), tra, sym_con)
+
+    # handling discrete symmetries, hypothesis sdx is replaced by the symmetric pose while sdx + 1 is marked valid
+    full_T = tf.concat([tf.concat([rot, tra[:, :, tf.newaxis]], axis=2),
+                        tf.tile(tf.constant([[[0.0, 0.0, 0.0, 1.0]]]), [num_objects, 1, 1])], axis=1)
+    sym_valid = tf.reduce_sum(tf.abs(sym_dis), axis=2) != 0
+    sym_pose = tf.matmul(full_T[:, tf.newaxis, :, :], tf.reshape(sym_dis, (-1, 8, 4, 4)))
+    hyps_pose = tf.where(sym_valid[:, :, tf.newaxis, tf.newaxis], sym_pose, full_T[:, tf.newaxis, :, :])
+    symmetry_mask = tf.concat([tf.ones_like(sym_dis[:, :1, 0]), tf.cast(sym_valid[:, :7], tf.float32)], axis=1)
+
+    # translation of the last symmetric hypothesis
+    last_sym = 7 - tf.argmax(tf.cast(tf.reverse(sym_valid, axis=[1]), tf.int32), axis=1, output_type=tf.int32)
+    translations = tf.where(tf.reduce_any(sym_valid, axis=1)[:, tf.newaxis], tf.gather(hyps_pose[:, :, :3, 3], last_sym, batch_dims=1), tra)
+
+    # project the 8 corners of all hypotheses of all objects
+    tDbox = tf.einsum('mhij,mkj->mhki', hyps_pose[:, :, :3, :3], segmentations) + hyps_pose[:, :, tf.newaxis, :3, 3]
+    fx, fy, cx, cy = [cam_params[:, i, tf.newaxis, tf.newaxis] for i in range(4)]
+    xpix = ((tDbox[..., 0] * fx) / tDbox[..., 2]) + cx
+    ypix = ((tDbox[..., 1] * fy) / tDbox[..., 2]) + cy
+    boxes3D = tf.reshape(tf.stack([xpix, ypix], axis=3), (-1, 8, 16))
+
+    rotations = tf.reshape(tf.transpose(hyps_pose[:, :, :3, :2], perm=(0, 1, 3, 2)), (-1, 8, 6))
+
+    return (label_indices,
+            pose_indices,
+            tf.cast(boxes3D, floatx),
+            tf.cast(symmetry_mask, floatx),
+            tf.cast(tf.boolean_mask(bboxes, pose_objects), floatx),
+            tf.cast(tf.boolean_mask(diameters, pose_objects), floatx),
+            tf.cast(translations, floatx),
+            tf.cast(rotations, floatx))
+
+
+def downsample_mask_graph(masks, image_shapes, ksize=7):
+    """ TensorFlow version of downsample_mask for a batch of masks.
 
-    return rot_pose
+    Args
+        masks: (B, H, W) int32 tensor of the object id masks, H and W have to be static.
+        image_shapes: List of the (rows, cols) shapes of the pyramid levels.
+        ksize: Aperture of the median filter.
 
+    Returns
+        A list with the (B, rows * cols) masks of every pyramid level.
+    """
+    height, width = masks.shape[1], masks.shape[2]
+    offsets = np.arange(ksize) - ksize // 2
+
+    masks_level = []
+    for rows, cols in image_shapes:
+        rows, cols = int(rows), int(cols)
+        # border replication of the median filter is done by clipping the patch indices
+        y = np.minimum(np.floor((np.arange(rows) + 0.5) * (height / rows)).astype(np.int64), height - 1)
+        x = np.minimum(np.floor((np.arange(cols) + 0.5) * (width / cols)).astype(np.int64), width - 1)
+        y = np.clip(y[:, np.newaxis] + offsets[np.newaxis, :], 0, height - 1)
+        x = np.clip(x[:, np.newaxis] + offsets[np.newaxis, :], 0, width - 1)
+        patches = tf.gather(tf.gather(masks, y, axis=1), x, axis=3)
+        patches = tf.reshape(tf.transpose(patches, perm=(0, 1, 3, 2, 4)), (-1, rows * cols, ksize * ksize))
+        masks_level.append(tf.sort(patches, axis=2)[:, :, (ksize * ksize) // 2])
+
+    return masks_level
+
+
+def quat2mat_graph(quaternions):
+    """ TensorFlow version of quat2mat_array.
+    """
+    w, x, y, z = [quaternions[:, i] for i in range(4)]
+    Nq = w * w + x * x + y * y + z * z
+    s = tf.where(Nq < np.finfo(np.float32).eps, 0.0, 2.0 / tf.where(Nq == 0.0, 1.0, Nq))
+    X = x * s
+    Y = y * s
+    Z = z * s
+    wX = w * X; wY = w * Y; wZ = w * Z
+    xX = x * X; xY = x * Y; xZ = x * Z
+    yY = y * Y; yZ = y * Z; zZ = z * Z
+    mats = tf.stack([1.0 - (yY + zZ), xY - wZ, xZ + wY,
+                     xY + wZ, 1.0 - (xX + zZ), yZ - wX,
+                     xZ - wY, yZ + wX, 1.0 - (xX + yY)], axis=1)
+
+    return tf.reshape(mats, (-1, 3, 3))
+
+
+def cont_sympose_graph(rot, tra, sym):
+    """ TensorFlow version of cont_sympose_array.
+    """
+    cam_in_obj = -tf.einsum('nji,nj->ni', rot, tra)
+    is_sym = tf.reduce_sum(sym[:, 0, :], axis=1) > 0
+    axis = tf.where(sym[:, 0, 2] == 1, 2, tf.where(sym[:, 0, 1] == 1, 1, tf.where(sym[:, 0, 0] == 1, 0, -1)))
+    alpha = tf.where(axis == 2, tf.atan2(cam_in_obj[:, 1], cam_in_obj[:, 0]),
+                     tf.where(axis == 1, tf.atan2(cam_in_obj[:, 0], cam_in_obj[:, 2]),
+                              tf.where(axis == 0, tf.atan2(cam_in_obj[:, 2], cam_in_obj[:, 1]), tf.zeros_like(cam_in_obj[:, 0]))))
+    ca = tf.cos(alpha)
+    sa = tf.sin(alpha)
+    zeros = tf.zeros_like(alpha)
+    ones = tf.ones_like(alpha)
+    rot_z = tf.reshape(tf.stack([ca, -sa, zeros, sa, ca, zeros, zeros, zeros, ones], axis=1), (-1, 3, 3))
+    rot_y = tf.reshape(tf.stack([ca, zeros, sa, zeros, ones, zeros, -sa, zeros, ca], axis=1), (-1, 3, 3))
+    rot_x = tf.reshape(tf.stack([ones, zeros, zeros, zeros, ca, -sa, zeros, sa, ca], axis=1), (-1, 3, 3))
+    sym_rot = tf.where((axis == 2)[:, tf.newaxis, tf.newaxis], rot_z, tf.where((axis == 1)[:, tf.newaxis, tf.newaxis], rot_y, rot_x))
+    apply = tf.logical_and(is_sym, axis >= 0)[:, tf.newaxis, tf.newaxis]
+
+    return tf.where(apply, tf.matmul(rot, sym_rot), rot)
@@ -0,0 +1,70 @@
+"""
+Streaming writer of pose estimates in the csv format of the BOP challenge.
+
+Each line is scene_id,im_id,obj_id,score,R,t,time with R the row major rotation and t the translation in mm, both
+space separated, and time the runtime of the image in seconds, identical for all estimates of an image.
+"""
+
+import csv
+import os
+import shutil
+
+HEADER = ('scene_id', 'im_id', 'obj_id', 'score', 'R', 't', 'time')
+
+
+class BOPResultsWriter:
+    """ Writes BOP result lines through one buffered handle as they are produced.
+
+    The lines go to a temporary file next to path, which replaces path on close, so an interrupted evaluation never
+    leaves a truncated submission behind.
+
+    Args
+        path: Path of the csv file, an existing file is overwritten.
+        buffer_size: Size of the write buffer in bytes.
+    """
+
+    def __init__(self, path, buffer_size=1 << 20):
+        self.path = path
+        self._temporary = '{}.{}.tmp'.format(path, os.getpid())
+        self._file = open(self._temporary, 'w', newline='', buffering=buffer_size)
+        self._writer = csv.writer(self._file, delimiter=',')
+        self._writer.writerow(HEADER)
+
+    def write(self, lines):
+        """ Append result lines, lists in the order of HEADER.
+        """
+        self._writer.writerows(lines)
+
+    def extend(self, path):
+        """ Append the result lines of another BOP csv file, e.g. of an evaluation shard.
+        """
+        with open(path, 'r', newline='') as results:
+            results.readline()
+            shutil.copyfileobj(results, self._file)
+
+    def close(self):
+        """ Flush the lines and move the file to its path.
+        """
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.replace(self._temporary, self.path)
+
+    def discard(self):
+        """ Drop the lines written so far, path is left untouched.
+        """
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.remove(self._temporary)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
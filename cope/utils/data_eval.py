@@ -21,10 +21,13 @@ import transforms3d as tf3d
 import copy
 import cv2
 import open3d
-from .pose_error import reproj, add, adi, re, te, vsd
+from .object_catalog import ObjectCatalog
+from .bop_results import BOPResultsWriter
+from .pose_error import add_batch
 import json
 import time
-import csv
+import multiprocessing
+from collections import deque
 
 
 def toPix_array(translation, fx, fy, cx, cy):
@@ -121,302 +124,294 @@ def boxoverlap(a, b):
     return ovlap
 
 
-def evaluate_data(generator, model, dataset_name, data_path, threshold=0.3):
-
-    mesh_info = os.path.join(data_path, "meshes/models_info.json")
-    threeD_boxes = np.ndarray((99, 8, 3), dtype=np.float32)
-    model_dia = np.zeros((99), dtype=np.float32)
-    avg_dimension = np.ndarray((99), dtype=np.float32)
-
-    num_classes = 0
-    max_class = 0
-    for key, value in json.load(open(mesh_info)).items():
-        fac = 0.001
-        x_minus = value['min_x'] * fac
-        y_minus = value['min_y'] * fac
-        z_minus = value['min_z'] * fac
-        x_plus = value['size_x'] * fac + x_minus
-        y_plus = value['size_y'] * fac + y_minus
-        z_plus = value['size_z'] * fac + z_minus
-        three_box_solo = np.array([
-                                    #[0.0, 0.0, 0.0],
-                                    [x_plus, y_plus, z_plus],
-                                  [x_plus, y_plus, z_minus],
-                                  [x_plus, y_minus, z_minus],
-                                  [x_plus, y_minus, z_plus],
-                                  [x_minus, y_plus, z_plus],
-                                  [x_minus, y_plus, z_minus],
-                                  [x_minus, y_minus, z_minus],
-                                  [x_minus, y_minus, z_plus]])
-        threeD_boxes[int(key), :, :] = three_box_solo
-        model_dia[int(key)] = value['diameter'] * fac
-        avg_dimension[int(key)] = ((value['size_x'] + value['size_y'] + value['size_z'])/3) * fac
-        num_classes += 1
-        if int(key) > max_class:
-            max_class = int(key)
-
-    mesh_path = os.path.join(data_path, "meshes")
-    meshes = [None] * (max_class + 1)
-    for mesh_name in os.listdir(mesh_path):
-        print(mesh_name)
-        if mesh_name.endswith('.ply'):
-            if mesh_name[:4] != 'obj_':
-                mesh_name = 'obj_' + mesh_name
-            pc, mv, md = load_pcd(mesh_path, mesh_name[:-4])
-            meshes[int(mesh_name[4:-4])] = mv
-
-    allPoses = np.zeros((max_class + 1), dtype=np.uint32)
-    truePoses = np.zeros((max_class + 1), dtype=np.uint32)
-    falsePoses = np.zeros((max_class + 1), dtype=np.uint32)
-    trueDets = np.zeros((max_class + 1), dtype=np.uint32)
-    falseDets = np.zeros((max_class + 1), dtype=np.uint32)
-    times = np.zeros((max_class + 1), dtype=np.float32)
-    times_count = np.zeros((max_class + 1), dtype=np.float32)
-
-    colors_viz = np.random.randint(255, size=(num_classes, 3))
+# counters per object id, stacked in this order by evaluate_image
+COUNTERS = ('allPoses', 'truePoses', 'falsePoses', 'trueDets', 'falseDets')
+
+# pairs of corners of the 3D bounding boxes connected by an edge
+BOX_EDGES = ((0, 1), (1, 2), (2, 3), (3, 0), (0, 4), (1, 5), (2, 6), (3, 7), (4, 5), (5, 6), (6, 7), (7, 4))
+
+# per process state of the evaluation workers, set by _init_worker
+_worker = {}
+
+
+def _init_worker(data_path, num_points, save_path):
+    """ Load the object catalog once per evaluation process.
+    """
+    catalog = ObjectCatalog.load_or_build(os.path.join(data_path, "meshes"), num_points=num_points)
+    _worker['catalog'] = catalog
+    # 3D boxes and diameters in m, indexed by object id
+    _worker['threeD_boxes'] = catalog.by_id(catalog.corners) * 0.001
+    _worker['model_dia'] = catalog.by_id(catalog.model_diameters) * 0.001
+    _worker['max_class'] = int(catalog.object_ids.max())
+    _worker['save_path'] = save_path
+
+
+def draw_box3D(image, corners, R, t, fx, fy, cx, cy, color):
+    """ Draw the edges of the 3D bounding box corners (8, 3) posed with R, t into image.
+    """
+    box3D = toPix_array(R.dot(corners.T).T + t[np.newaxis, :], fx, fy, cx, cy)
+    box3D = np.where(box3D < 3, 3, box3D).astype(np.int32).tolist()
+    for start, end in BOX_EDGES:
+        image = cv2.line(image, tuple(box3D[start]), tuple(box3D[end]), color, 2)
+    return image
+
+
+def evaluate_image(task):
+    """ Match the detections of one image against its ground truth and optionally visualize them.
+
+    Runs in the evaluation processes, after _init_worker.
+
+    Args
+        task: Dictionary with the ground truth ('index', 'scene_id', 'image_id', 'gt_labels', 'gt_poses', 'gt_calib'),
+              the detections ('scores', 'labels', 'poses', 'boxes') of the image, the inference time per image 't_img'
+              and the de-normalized uint8 'image' if images are saved.
+
+    Returns
+        counters: (len(COUNTERS), max_class + 1) counts of the image.
+        eval_img: BOP result lines of the detections.
+    """
+    catalog = _worker['catalog']
+    threeD_boxes = _worker['threeD_boxes']
+    model_dia = _worker['model_dia']
+    allPoses, truePoses, falsePoses, trueDets, falseDets = counters = np.zeros((len(COUNTERS), _worker['max_class'] + 1), dtype=np.uint32)
+
+    gt_labels = task['gt_labels']
+    gt_poses = np.array(task['gt_poses'])
+    allLabels = copy.deepcopy(gt_labels)
+    fx, fy, cx, cy = task['gt_calib'][0, :4]
+    scores, labels, poses, boxes = task['scores'], task['labels'], task['poses'], task['boxes']
+    image_raw = task['image']
+
+    for obj in range(gt_labels.shape[0]):
+        allPoses[int(gt_labels[obj]) + 1] += 1
+
+        if image_raw is not None:
+            R_gt = np.array(tf3d.quaternions.quat2mat(gt_poses[obj, 3:]), dtype=np.float32).reshape(3, 3)
+            t_gt = np.array(gt_poses[obj, :3], dtype=np.float32) * 0.001
+            image_raw = draw_box3D(image_raw, threeD_boxes[int(gt_labels[obj]) + 1], R_gt, t_gt, fx, fy, cx, cy, (245, 102, 65))
+
+    # ADD of every detection against the first GT of its class, one batched call per class
+    R_est_all = np.transpose(poses[:, :9].reshape((-1, 3, 3)), (0, 2, 1))
+    t_est_all = poses[:, -3:] * 0.001
+    errors_add = np.full((labels.shape[0],), np.inf)
+    for inv_cls in np.intersect1d(labels, gt_labels):
+        detections = np.flatnonzero(labels == inv_cls)
+        gt_pose = gt_poses[np.argwhere(gt_labels == inv_cls)[0][0]]
+        R_gt = np.repeat(tf3d.quaternions.quat2mat(gt_pose[3:])[np.newaxis], detections.shape[0], axis=0)
+        t_gt = np.repeat(gt_pose[np.newaxis, :3] * 0.001, detections.shape[0], axis=0)
+        pts = catalog.object_points(catalog.index(inv_cls + 1)) * 0.001
+        errors_add[detections] = add_batch(R_est_all[detections], t_est_all[detections], R_gt, t_gt, pts)
 
     eval_img = []
-    for index, sample in enumerate(generator):
+    for odx, inv_cls in enumerate(labels):
+
+        true_cls = inv_cls + 1
+        R_est = R_est_all[odx]
+        t_est = t_est_all[odx]
+
+        eval_line = []
+        eval_line.append(int(task['scene_id'][0]))
+        eval_line.append(int(task['image_id']))
+        eval_line.append(int(true_cls))
+        eval_line.append(float(scores[odx]))
+        eval_line.append(' '.join([str(i) for i in R_est.flatten().tolist()]))
+        eval_line.append(' '.join([str(i) for i in (t_est * 1000.0).flatten().tolist()]))
+        eval_line.append(float(task['t_img']))
+        eval_img.append(eval_line)
+
+        if inv_cls in gt_labels:
+
+            gt_idx = np.argwhere(gt_labels == inv_cls)
+
+            # a class is matched once, further detections of it are false poses
+            if errors_add[odx] < model_dia[true_cls] * 0.1 and np.max(gt_poses[gt_idx, :]) != -1:
+                truePoses[true_cls] += 1
+                gt_poses[gt_idx, :] = -1
+            else:
+                falsePoses[true_cls] += 1
+
+            if inv_cls in allLabels:
+                trueDets[true_cls] += 1
+                allLabels[gt_idx] = -1
+
+        if image_raw is not None:
+            image_raw = draw_box3D(image_raw, threeD_boxes[true_cls], R_est, t_est, fx, fy, cx, cy, (50, 205, 50))
+            box = boxes[odx, :]
+            org = (int(box[0] + 0.5 * (box[2] - box[0])), int(box[1] + 0.5 * (box[3] - box[1])))
+            image_raw = cv2.putText(image_raw, str(true_cls), org, cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA)
 
-        scene_id = sample[0].numpy()
-        image_id = sample[1].numpy()
-        image = sample[2]
-        gt_labels = sample[3].numpy()
-        gt_boxes = sample[4].numpy()
-        gt_poses = sample[5].numpy()
-        gt_calib = sample[6].numpy()
-        allLabels = copy.deepcopy(gt_labels)
+    if image_raw is not None:
+        cv2.imwrite(os.path.join(_worker['save_path'], 'sample_' + str(task['index']) + '.png'), image_raw)
 
-        if gt_labels.size == 0: #or int(gt_labels[0]) in [2, 6]:
+    return counters, eval_img
+
+
+def _batches(generator, batch_size, shard_index, num_shards):
+    """ Group the annotated images of this shard of the generator into lists of at most batch_size samples.
+    """
+    batch = []
+    for index, sample in enumerate(generator):
+        if index % num_shards != shard_index:
             continue
 
-        fx = gt_calib[0, 0]
-        fy = gt_calib[0, 1]
-        cx = gt_calib[0, 2]
-        cy = gt_calib[0, 3]
-
-        image_raw = image.numpy()
-        image_raw[..., 0] += 103.939
-        image_raw[..., 1] += 116.779
-        image_raw[..., 2] += 123.68
-
-        image_raw = image_raw.astype(np.uint8)
-        image_ori = image_raw.astype(np.uint8)
-
-        image_mask = copy.deepcopy(image_raw)
-        image_box = copy.deepcopy(image_raw)
-        image_poses = copy.deepcopy(image_raw)
-
-        for obj in range(gt_labels.shape[0]):
-            allPoses[int(gt_labels[obj]) + 1] += 1
-
-            t_rot = tf3d.quaternions.quat2mat(gt_poses[obj, 3:])
-            R_gt = np.array(t_rot, dtype=np.float32).reshape(3, 3)
-            t_gt = np.array(gt_poses[obj, :3], dtype=np.float32)
-            t_gt = t_gt * 0.001
-
-            ori_points = np.ascontiguousarray(threeD_boxes[int(gt_labels[obj]) + 1, :, :], dtype=np.float32)
-            tDbox = R_gt.dot(ori_points.T).T
-            tDbox = tDbox + np.repeat(t_gt[:, np.newaxis], 8, axis=1).T  # * 0.001
-            box3D = toPix_array(tDbox, fx, fy, cx, cy)
-            tDbox = np.reshape(box3D, (16))
-            tDbox = tDbox.astype(np.uint16)
-            tDbox = np.where(tDbox < 3, 3, tDbox)
-
-            colGT = (245, 102, 65)
-
-            image_raw = cv2.line(image_raw, tuple(tDbox[0:2].ravel()), tuple(tDbox[2:4].ravel()), colGT, 2)
-            image_raw = cv2.line(image_raw, tuple(tDbox[2:4].ravel()), tuple(tDbox[4:6].ravel()), colGT, 2)
-            image_raw = cv2.line(image_raw, tuple(tDbox[4:6].ravel()), tuple(tDbox[6:8].ravel()), colGT,
-                                 2)
-            image_raw = cv2.line(image_raw, tuple(tDbox[6:8].ravel()), tuple(tDbox[0:2].ravel()), colGT,
-                                 2)
-            image_raw = cv2.line(image_raw, tuple(tDbox[0:2].ravel()), tuple(tDbox[8:10].ravel()), colGT,
-                                 2)
-            image_raw = cv2.line(image_raw, tuple(tDbox[2:4].ravel()), tuple(tDbox[10:12].ravel()), colGT,
-                                 2)
-            image_raw = cv2.line(image_raw, tuple(tDbox[4:6].ravel()), tuple(tDbox[12:14].ravel()), colGT,
-                                 2)
-            image_raw = cv2.line(image_raw, tuple(tDbox[6:8].ravel()), tuple(tDbox[14:16].ravel()), colGT,
-                                 2)
-            image_raw = cv2.line(image_raw, tuple(tDbox[8:10].ravel()), tuple(tDbox[10:12].ravel()),
-                                 colGT,
-                                 2)
-            image_raw = cv2.line(image_raw, tuple(tDbox[10:12].ravel()), tuple(tDbox[12:14].ravel()),
-                                 colGT,
-                                 2)
-            image_raw = cv2.line(image_raw, tuple(tDbox[12:14].ravel()), tuple(tDbox[14:16].ravel()),
-                                 colGT,
-                                 2)
-            image_raw = cv2.line(image_raw, tuple(tDbox[14:16].ravel()), tuple(tDbox[8:10].ravel()),
-                                 colGT,
-                                 2)
-
-        # run network
-        start_t = time.time()
-        t_error = 0
-        t_img = 0
-        n_img = 0
-
-        print(np.expand_dims(np.array([fx, fy, cx, cy]), axis=0).shape, np.expand_dims(np.array([fx, fy, cx, cy]), axis=0))
-        scores, labels, poses, mask, boxes = model.predict_on_batch(np.expand_dims(image, axis=0))#, np.expand_dims(np.array([fx, fy, cx, cy]), axis=0)))
-        t_img = time.time() - start_t
-
-        scores = scores[labels != -1]
-        poses = poses[labels != -1]
-        boxes = boxes[labels != -1]
-        labels = labels[labels != -1]
-
-        for odx, inv_cls in enumerate(labels):
-
-            true_cls = inv_cls + 1
-            pose = poses[odx, :]
-            box = boxes[odx, :]
+        scene_id, image_id, image, gt_labels, gt_boxes, gt_poses, gt_calib = [value.numpy() for value in sample[:7]]
+        if gt_labels.size == 0:
+            continue
 
-            #if inv_cls not in gt_labels:
-            #    continue
-            n_img += 1
-
-            R_est = np.array(pose[:9]).reshape((3, 3)).T
-            t_est = np.array(pose[-3:]) * 0.001
-
-            eval_line = []
-            sc_id = int(scene_id[0])
-            eval_line.append(sc_id)
-            im_id = int(image_id)
-            eval_line.append(im_id)
-            obj_id = int(true_cls)
-            eval_line.append(obj_id)
-            score = float(scores[odx])
-            eval_line.append(score)
-            R_bop = [str(i) for i in R_est.flatten().tolist()]
-            R_bop = ' '.join(R_bop)
-            eval_line.append(R_bop)
-            t_bop = t_est * 1000.0
-            t_bop = [str(i) for i in t_bop.flatten().tolist()]
-            t_bop = ' '.join(t_bop)
-            eval_line.append(t_bop)
-            time_bop = float(t_img)
-            eval_line.append(time_bop)
-            eval_img.append(eval_line)
-
-            if inv_cls in gt_labels:
-
-                gt_idx = np.argwhere(gt_labels == inv_cls)
-                gt_pose = gt_poses[gt_idx, :]
-                gt_box = gt_boxes[gt_idx, :]
-                gt_pose = gt_pose[0][0]
-                gt_box = gt_box[0][0]
-
-                t_rot = tf3d.quaternions.quat2mat(gt_pose[3:])
-                R_gt = np.array(t_rot, dtype=np.float32).reshape(3, 3)
-                t_gt = np.array(gt_pose[:3], dtype=np.float32)
-                t_gt = t_gt * 0.001
-
-                model_vsd = meshes[true_cls - 1]
-
-                err_add = add(R_est, t_est, R_gt, t_gt, model_vsd["pts"])
-
-                if err_add < model_dia[true_cls] * 0.1:
-                    if np.max(gt_poses[gt_idx, :]) != -1:
-                        truePoses[true_cls] += 1
-                        gt_poses[gt_idx, :] = -1
+        batch.append((index, scene_id, image_id, image, gt_labels, gt_poses, gt_calib))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _merge(counters, results, result):
+    """ Add the counters of one image to the totals and stream its BOP result lines.
+    """
+    counters += result[0]
+    results.write(result[1])
+
+
+def evaluate_data(generator, model, dataset_name, data_path, threshold=0.3, num_points=2000, batch_size=1, workers=0,
+                  save_path=None, shard_index=0, num_shards=1, shard_output=None, results_path=None,
+                  cache=None):
+    """ Evaluate the poses estimated by model on the images of generator.
+
+    Inference runs batched in this process while a pool of workers computes the ADD errors, matches the detections
+    and draws the visualizations, so the model never waits on the metrics. The BOP result lines are streamed to
+    results_path as the images finish, their time is the inference time of the image only.
+
+    Args
+        generator: Dataset yielding (scene_id, image_id, image, labels, boxes, poses, calibration) per image.
+        model: Inference model taking [images, intrinsics].
+        dataset_name: Name of the dataset in the name of the BOP result file.
+        data_path: Dataset directory with the meshes.
+        threshold: Score threshold of the detections (applied by the model).
+        num_points: Number of mesh points of the ADD computation.
+        batch_size: Number of images per inference call.
+        workers: Number of evaluation processes, 0 evaluates in this process.
+        save_path: Directory for the visualized poses, None to not draw them.
+        shard_index: Index of the shard of the images evaluated here, every num_shards'th image starting at shard_index.
+        num_shards: Number of shards the images are split in.
+        shard_output: If given, the counters are written to this file for merge_evaluations instead of reported.
+        results_path: BOP csv of the detections, defaults to sthalham-cope-<dataset_name>-test.csv in the working
+                      directory, or to the shard_output path with a .csv extension for shards.
+        cache: PredictionCache serving the detections from cached network outputs, filtered with its parameters.
+
+    Returns
+        (len(COUNTERS), max_class + 1) counts per object id.
+    """
+    _init_worker(data_path, num_points, save_path)
+    num_classes = _worker['catalog'].num_classes
+    counters = np.zeros((len(COUNTERS), _worker['max_class'] + 1), dtype=np.uint32)
+    inference_time = 0.0
+    num_images = 0
+
+    if results_path is None and shard_output is not None:
+        results_path = os.path.splitext(shard_output)[0] + '.csv'
+    elif results_path is None:
+        results_path = os.path.join(os.getcwd(), 'sthalham-cope-' + str(dataset_name) + '-test.csv')
+
+    # the pool starts before the writer opens its temporary file, which is removed again if the evaluation fails
+    pool = None
+    if workers > 0:
+        pool = multiprocessing.get_context('spawn').Pool(workers, initializer=_init_worker, initargs=(data_path, num_points, save_path))
+    pending = deque()
+
+    try:
+        with BOPResultsWriter(results_path) as results:
+            for batch in _batches(generator, batch_size, shard_index, num_shards):
+                images = np.stack([sample[3] for sample in batch])
+                intrinsics = np.stack([sample[6][0, :4] for sample in batch])
+
+                # run network, the BOP time of an image is its share of the batch
+                if cache is None:
+                    start_t = time.time()
+                    scores, labels, poses, _, boxes = model.predict_on_batch([images, intrinsics])
+                    times = [(time.time() - start_t) / len(batch)] * len(batch)
                 else:
-                    falsePoses[true_cls] += 1
-
-                if inv_cls in allLabels:
-                    trueDets[true_cls] +=1
-                    allLabels[gt_idx] = -1
-
-                print(' ')
-                print('error: ', err_add, 'threshold', model_dia[true_cls] * 0.1)
-
-            ori_points = np.ascontiguousarray(threeD_boxes[true_cls, :, :], dtype=np.float32)
-            eDbox = R_est.dot(ori_points.T).T
-            eDbox = eDbox + np.repeat(t_est[np.newaxis, :], 8, axis=0)  # * 0.001
-            est3D = toPix_array(eDbox, fx, fy, cx, cy)
-            eDbox = np.reshape(est3D, (16))
-            pose = eDbox.astype(np.int16)
-            pose = np.where(pose < 3, 3, pose)
-
-            colEst = (50, 205, 50)
-            #if err_add > model_dia[true_cls] * 0.1:
-            #    colEst = (0, 39, 236)
-
-            image_raw = cv2.line(image_raw, tuple(pose[0:2].ravel()), tuple(pose[2:4].ravel()), colEst, 2)
-            image_raw = cv2.line(image_raw, tuple(pose[2:4].ravel()), tuple(pose[4:6].ravel()), colEst, 2)
-            image_raw = cv2.line(image_raw, tuple(pose[4:6].ravel()), tuple(pose[6:8].ravel()), colEst, 2)
-            image_raw = cv2.line(image_raw, tuple(pose[6:8].ravel()), tuple(pose[0:2].ravel()), colEst, 2)
-            image_raw = cv2.line(image_raw, tuple(pose[0:2].ravel()), tuple(pose[8:10].ravel()), colEst, 2)
-            image_raw = cv2.line(image_raw, tuple(pose[2:4].ravel()), tuple(pose[10:12].ravel()), colEst, 2)
-            image_raw = cv2.line(image_raw, tuple(pose[4:6].ravel()), tuple(pose[12:14].ravel()), colEst, 2)
-            image_raw = cv2.line(image_raw, tuple(pose[6:8].ravel()), tuple(pose[14:16].ravel()), colEst, 2)
-            image_raw = cv2.line(image_raw, tuple(pose[8:10].ravel()), tuple(pose[10:12].ravel()), colEst, 2)
-            image_raw = cv2.line(image_raw, tuple(pose[10:12].ravel()), tuple(pose[12:14].ravel()), colEst, 2)
-            image_raw = cv2.line(image_raw, tuple(pose[12:14].ravel()), tuple(pose[14:16].ravel()), colEst, 2)
-            image_raw = cv2.line(image_raw, tuple(pose[14:16].ravel()), tuple(pose[8:10].ravel()), colEst, 2)
-
-            # font
-            font = cv2.FONT_HERSHEY_SIMPLEX
-            org = (int(box[0] + 0.5 * (box[2] - box[0])), int(box[1] + 0.5 * (box[3] - box[1])))
-            fontScale = 1
-            color = (0, 0, 255)
-            thickness = 2
-            image_raw = cv2.putText(image_raw, str(true_cls), org, font,
-                                fontScale, color, thickness, cv2.LINE_AA)
-
-            image_box = cv2.putText(image_box, str(true_cls), org, font,
-                                    fontScale, color, thickness, cv2.LINE_AA)
-            est_box = np.array([float(box[0]), float(box[1]), float(box[2]), float(box[3])])
-
-            image_box = cv2.rectangle(image_box, (int(est_box[0]), int(est_box[1])), (int(est_box[2]), int(est_box[3])), (42, 205, 50), 2)
-
-
-            #colEst = (50, 205, 50)
-            #if err_add > model_dia[true_cls] * 0.1:
-            #    colEst = (25, 119, 242)
-
-            #pts = model_vsd["pts"]
-            #proj_pts = R_est.dot(pts.T).T
-            #proj_pts = proj_pts + np.repeat(t_est[np.newaxis, :], pts.shape[0], axis=0)
-            #proj_pts = toPix_array(proj_pts, fxkin, fykin, cxkin, cykin)
-            #proj_pts = proj_pts.astype(np.uint16)
-            #proj_pts[:, 0] = np.where(proj_pts[:, 0] > 639, 0, proj_pts[:, 0])
-            #proj_pts[:, 0] = np.where(proj_pts[:, 0] < 0, 0, proj_pts[:, 0])
-            #proj_pts[:, 1] = np.where(proj_pts[:, 1] > 479, 0, proj_pts[:, 1])
-            #proj_pts[:, 1] = np.where(proj_pts[:, 1] < 0, 0, proj_pts[:, 1])
-            #image_raw[proj_pts[:, 1], proj_pts[:, 0], :] = colEst
-
-        #if index > 0:
-        #    times[n_img] += t_img
-        #    times_count[n_img] += 1
-
-        name = '/home/stefan/PyraPose_viz/' + 'sample_' + str(index) + '.png'
-        name_box = '/home/stefan/PyraPose_viz/' + 'box_' + str(index) + '.png'
-        #image_row1 = np.concatenate([image_ori, image_raw], axis=1)
-        #image_row2 = np.concatenate([image_mask, image_poses], axis=1)
-        #image_rows = np.concatenate([image_row1, image_row2], axis=0)
-        #cv2.imwrite(name_box, image_box)
-        cv2.imwrite(name, image_raw)
-
-        #name = '/home/stefan/PyraPose_viz/' + 'ori_' + str(index) + '.png'
-        #cv2.imwrite(name, image_ori)
-
-    #times
-    print('Number of objects ----- t')
-    for tfx in range(1, times.shape[0]):
-        t_ins = times[tfx] / times_count[tfx]
-        print(tfx, '       ------ ', t_ins, tfx)
-
-    recall = np.zeros((num_classes+1), dtype=np.float32)
-    precision = np.zeros((num_classes+1), dtype=np.float32)
-    detections = np.zeros((num_classes+1), dtype=np.float32)
-    det_precision = np.zeros((num_classes+1), dtype=np.float32)
+                    keys = [(sample[1][0], sample[2]) for sample in batch]
+                    (scores, labels, poses, _, boxes), times = cache.predict_on_batch(model, images, intrinsics, keys)
+                inference_time += sum(times)
+                num_images += len(batch)
+
+                for bdx, (index, scene_id, image_id, image, gt_labels, gt_poses, gt_calib) in enumerate(batch):
+                    image_raw = None
+                    if save_path is not None:
+                        image_raw = (image + np.array([103.939, 116.779, 123.68])).astype(np.uint8)
+
+                    valid = labels[bdx] != -1
+                    task = {'index': index, 'scene_id': scene_id, 'image_id': image_id, 'image': image_raw,
+                            'gt_labels': gt_labels, 'gt_poses': gt_poses, 'gt_calib': gt_calib, 't_img': times[bdx],
+                            'scores': scores[bdx][valid], 'labels': labels[bdx][valid], 'poses': poses[bdx][valid], 'boxes': boxes[bdx][valid]}
+                    if pool is None:
+                        _merge(counters, results, evaluate_image(task))
+                    else:
+                        pending.append(pool.apply_async(evaluate_image, (task,)))
+
+                # bound the images in flight, results are merged in order
+                while len(pending) > 2 * workers:
+                    _merge(counters, results, pending.popleft().get())
+
+            while pending:
+                _merge(counters, results, pending.popleft().get())
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    if shard_output is not None:
+        with open(shard_output, 'w') as js:
+            json.dump({'num_classes': num_classes, 'counters': counters.tolist(), 'results': results_path,
+                       'inference_time': inference_time, 'num_images': num_images}, js)
+    else:
+        report(counters, num_classes, inference_time, num_images)
+        print('BOP results: ', results_path)
+
+    return counters
+
+
+def merge_evaluations(shard_outputs, dataset_name, results_path=None):
+    """ Sum the counters of the shards written by evaluate_data, report them and concatenate their BOP results.
+    """
+    if results_path is None:
+        results_path = os.path.join(os.getcwd(), 'sthalham-cope-' + str(dataset_name) + '-test.csv')
+
+    counters = None
+    inference_time = 0.0
+    num_images = 0
+    with BOPResultsWriter(results_path) as results:
+        for path in shard_outputs:
+            with open(path, 'r') as js:
+                shard = json.load(js)
+            num_classes = shard['num_classes']
+            shard_counters = np.array(shard['counters'], dtype=np.uint32)
+            counters = shard_counters if counters is None else counters + shard_counters
+            inference_time += shard['inference_time']
+            num_images += shard['num_images']
+            results.extend(shard['results'])
+
+    report(counters, num_classes, inference_time, num_images)
+    print('BOP results: ', results_path)
+    return counters
+
+
+def report(counters, num_classes, inference_time, num_images):
+    """ Print detection and pose recall and precision per class and the mean inference time per image.
+    """
+    allPoses, truePoses, falsePoses, trueDets, falseDets = counters
+
+    recall = np.zeros((allPoses.shape[0]), dtype=np.float32)
+    precision = np.zeros((allPoses.shape[0]), dtype=np.float32)
+    detections = np.zeros((allPoses.shape[0]), dtype=np.float32)
+    det_precision = np.zeros((allPoses.shape[0]), dtype=np.float32)
     for i in range(1, (allPoses.shape[0])):
-        recall[i] = truePoses[i] / allPoses[i]
-        precision[i] = truePoses[i] / (truePoses[i] + falsePoses[i])
-        detections[i] = trueDets[i] / allPoses[i]
-        det_precision[i] = trueDets[i] / (trueDets[i] + falseDets[i])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            recall[i] = truePoses[i] / allPoses[i]
+            precision[i] = truePoses[i] / (truePoses[i] + falsePoses[i])
+            detections[i] = trueDets[i] / allPoses[i]
+            det_precision[i] = trueDets[i] / (trueDets[i] + falseDets[i])
 
         if np.isnan(recall[i]):
             recall[i] = 0.0
@@ -445,15 +440,4 @@ def evaluate_data(generator, model, dataset_name, data_path, threshold=0.3):
     print('mean pose recall: ', recall_all)
     print('mean pose precision: ', precision_all)
 
-    wd_path = os.getcwd()
-    csv_target = os.path.join(wd_path, 'sthalham-cope-' + str(dataset_name) + '-test.csv')
-
-    line_head = ['scene_id','im_id','obj_id','score','R','t','time']
-    with open(csv_target, 'a') as outfile:
-        myWriter = csv.writer(outfile, delimiter=',')  # Write out the Headers for the CSV file
-        myWriter.writerow(line_head)
-
-    for line_indexed in eval_img:
-        with open(csv_target, 'a') as outfile:
-            myWriter = csv.writer(outfile, delimiter=',')  # Write out the Headers for the CSV file
-            myWriter.writerow(line_indexed)
+    print('mean inference time per image: ', inference_time / max(num_images, 1))
@@ -0,0 +1,211 @@
+"""
+Per object geometry of a dataset, parsed once from models_info.json and cached as a compact .npz.
+
+An ObjectCatalog holds contiguous arrays with one row per object, in the order of the object ids (the keys of
+models_info.json), so the row of an object is its label when the ids are 1..num_classes:
+    object_ids: (N,) int32 object ids.
+    corners: (N, 8, 3) corners of the 3D bounding boxes in mm, in the corner order of the correspondences.
+    diameters: (N,) diagonals of the 3D bounding boxes in mm, the diameters the network is trained with.
+    model_diameters: (N,) mesh diameters of models_info.json in mm, the diameters of the ADD(-S) thresholds.
+    sym_disc: (N, 8, 16) flattened 4x4 discrete symmetry transforms, zero rows are no symmetry.
+    sym_cont: (N, 2, 3) axis and offset of the continuous symmetry, zero for none.
+    points: (N, P, 3) randomly subsampled mesh vertices in mm, only the first point_counts rows are valid.
+    point_counts: (N,) number of valid points per object, 0 if the object has no mesh.
+
+The cache is written next to models_info.json and rebuilt when models_info.json or the meshes change.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+CATALOG_FILE = 'object_catalog.npz'
+ARRAYS = ('object_ids', 'corners', 'diameters', 'model_diameters', 'sym_disc', 'sym_cont', 'points', 'point_counts')
+
+
+def _mesh_files(mesh_dir):
+    """ Object id and path of every .ply mesh in mesh_dir, named obj_<id>.ply or <id>.ply.
+    """
+    meshes = {}
+    for mesh_name in sorted(os.listdir(mesh_dir)):
+        if not mesh_name.endswith('.ply'):
+            continue
+        object_id = mesh_name[:-4]
+        if object_id.startswith('obj_'):
+            object_id = object_id[4:]
+        if object_id.isdigit():
+            meshes[int(object_id)] = os.path.join(mesh_dir, mesh_name)
+    return meshes
+
+
+def _fingerprint(mesh_dir, num_points):
+    """ Hash of models_info.json and, if points are sampled, of the names, sizes and modification times of the meshes.
+    """
+    digest = hashlib.sha1()
+    with open(os.path.join(mesh_dir, 'models_info.json'), 'rb') as js:
+        digest.update(js.read())
+    if num_points > 0:
+        for object_id, path in sorted(_mesh_files(mesh_dir).items()):
+            stat = os.stat(path)
+            digest.update('{}:{}:{}'.format(object_id, stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _load_vertices(path):
+    """ Vertices of a mesh in mm, meshes in m are detected by their extent.
+    """
+    import open3d
+
+    vertices = np.asarray(open3d.io.read_point_cloud(path).points)
+    if vertices.size and np.nanmax(np.abs(vertices)) < 10.0:
+        vertices = vertices * 1000.0
+    return vertices
+
+
+class ObjectCatalog:
+    """ Contiguous per object arrays of a dataset, see the module docstring.
+
+    Args
+        arrays: Dictionary with an array for every name of ARRAYS.
+        num_points: Number of points sampled per mesh when the catalog was built.
+        fingerprint: Hash of the sources the catalog was built from.
+    """
+
+    def __init__(self, arrays, num_points=0, fingerprint=None):
+        for name in ARRAYS:
+            setattr(self, name, np.ascontiguousarray(arrays[name]))
+        self.num_points = num_points
+        self.fingerprint = fingerprint
+
+    @property
+    def num_classes(self):
+        return self.object_ids.shape[0]
+
+    @classmethod
+    def build(cls, mesh_dir, num_points=0, seed=0):
+        """ Parse models_info.json and sample num_points vertices of every mesh in mesh_dir.
+
+        Args
+            mesh_dir: Directory with models_info.json and optionally the meshes as obj_<id>.ply.
+            num_points: Number of vertices sampled per mesh, 0 to not load the meshes.
+            seed: Seed of the vertex sampling.
+
+        Returns
+            The ObjectCatalog.
+        """
+        with open(os.path.join(mesh_dir, 'models_info.json'), 'r') as js:
+            models_info = {int(key): value for key, value in json.load(js).items()}
+
+        object_ids = np.array(sorted(models_info.keys()), dtype=np.int32)
+        num_objects = object_ids.shape[0]
+        corners = np.zeros((num_objects, 8, 3), dtype=np.float32)
+        diameters = np.zeros((num_objects,), dtype=np.float32)
+        model_diameters = np.zeros((num_objects,), dtype=np.float32)
+        sym_disc = np.zeros((num_objects, 8, 16), dtype=np.float32)
+        sym_cont = np.zeros((num_objects, 2, 3), dtype=np.float32)
+
+        for index, object_id in enumerate(object_ids):
+            value = models_info[object_id]
+            minimum = np.array([value['min_x'], value['min_y'], value['min_z']])
+            size = np.array([value['size_x'], value['size_y'], value['size_z']])
+            maximum = minimum + size
+            corners[index] = [[x, y, z] for x in (maximum[0], minimum[0]) for y, z in
+                              ((maximum[1], maximum[2]), (maximum[1], minimum[2]), (minimum[1], minimum[2]), (minimum[1], maximum[2]))]
+            diameters[index] = np.linalg.norm(size)
+            model_diameters[index] = value.get('diameter', diameters[index])
+
+            for sdx, sym in enumerate(value.get('symmetries_discrete', [])[:8]):
+                sym_disc[index, sdx] = sym
+            if value.get('symmetries_continuous'):
+                sym_cont[index, 0] = value['symmetries_continuous'][0]['axis']
+                sym_cont[index, 1] = value['symmetries_continuous'][0]['offset']
+
+        points = np.zeros((num_objects, num_points, 3), dtype=np.float32)
+        point_counts = np.zeros((num_objects,), dtype=np.int32)
+        if num_points > 0:
+            # a random permutation per mesh, every prefix of the points is a uniform sample as well
+            rng = np.random.RandomState(seed)
+            meshes = _mesh_files(mesh_dir)
+            for index, object_id in enumerate(object_ids):
+                if object_id not in meshes:
+                    continue
+                vertices = _load_vertices(meshes[object_id])
+                sample = rng.permutation(vertices.shape[0])[:num_points]
+                points[index, :sample.shape[0]] = vertices[sample]
+                point_counts[index] = sample.shape[0]
+
+        arrays = {'object_ids': object_ids, 'corners': corners, 'diameters': diameters, 'model_diameters': model_diameters,
+                  'sym_disc': sym_disc, 'sym_cont': sym_cont, 'points': points, 'point_counts': point_counts}
+        return cls(arrays, num_points=num_points, fingerprint=_fingerprint(mesh_dir, num_points))
+
+    def save(self, path):
+        """ Write the catalog to path, atomically so concurrent readers never see a partial file.
+        """
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary, 'wb') as npz:
+            np.savez(npz, num_points=self.num_points, fingerprint=self.fingerprint, **{name: getattr(self, name) for name in ARRAYS})
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        """ Read a catalog written by save.
+        """
+        with np.load(path) as npz:
+            arrays = {name: npz[name] for name in ARRAYS}
+            return cls(arrays, num_points=int(npz['num_points']), fingerprint=str(npz['fingerprint']))
+
+    @classmethod
+    def load_or_build(cls, mesh_dir, num_points=0):
+        """ The catalog of mesh_dir, read from its cache if that is up to date, otherwise built and cached.
+
+        Args
+            mesh_dir: Directory with models_info.json and optionally the meshes as obj_<id>.ply.
+            num_points: Minimum number of vertices sampled per mesh, a cache with more points is reused.
+
+        Returns
+            The ObjectCatalog.
+        """
+        path = os.path.join(mesh_dir, CATALOG_FILE)
+        if os.path.exists(path):
+            try:
+                catalog = cls.load(path)
+            except (OSError, ValueError, KeyError):
+                catalog = None
+            if catalog is not None and catalog.num_points >= num_points and catalog.fingerprint == _fingerprint(mesh_dir, catalog.num_points):
+                return catalog
+
+        catalog = cls.build(mesh_dir, num_points=num_points)
+        try:
+            catalog.save(path)
+        except OSError:
+            # read-only datasets are parsed on every start
+            pass
+        return catalog
+
+    def index(self, object_ids):
+        """ Rows of the objects with the given ids, raises a KeyError for ids that are not in the catalog.
+        """
+        rows = np.minimum(np.searchsorted(self.object_ids, object_ids), self.num_classes - 1)
+        unknown = self.object_ids[rows] != object_ids
+        if np.any(unknown):
+            raise KeyError('Object ids {} are not in the catalog.'.format(np.unique(np.asarray(object_ids)[unknown]).tolist()))
+        return rows
+
+    def by_id(self, values, size=None):
+        """ Scatter per object values into a table indexed by object id, rows of unused ids are zero.
+
+        Args
+            values: Array with one row per object, e.g. catalog.corners.
+            size: Number of rows of the table, at least the largest object id + 1.
+        """
+        size = int(self.object_ids.max()) + 1 if size is None else size
+        table = np.zeros((size,) + values.shape[1:], dtype=values.dtype)
+        table[self.object_ids] = values
+        return table
+
+    def object_points(self, index):
+        """ The valid sampled points of the object in row index in mm.
+        """
+        return self.points[index, :self.point_counts[index]]
@@ -0,0 +1,180 @@
+"""
+Per-stage timing of the training data pipeline.
+
+GeneratorDataset._generate times every stage of producing a batch (image decode, mask read, annotation parsing,
+augmentation, geometric transform, preprocessing, batch assembly and packing of the annotations) with a
+PipelineStats. It keeps a rolling window of the durations of every stage and counts the produced samples, every
+report_every batches its report is passed to a sink: LogSink prints it, TensorBoardSink writes it as scalars and
+StatsSink keeps the latest report in the training process.
+
+Data loading worker processes time their stages with a StageRecorder and send the records along with every batch,
+the MultiprocessLoader merges them into the PipelineStats of the training process. The anchor targets are computed
+by anchor_targets_graph in the tf.data graph and are not part of the generator stages.
+"""
+
+from abc import ABC, abstractmethod
+from collections import deque
+import contextlib
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+class StageTimer(ABC):
+    """ Base of the stage timers, subclasses implement record and count_batch.
+    """
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        """ Context manager recording the duration of its body as stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    @abstractmethod
+    def record(self, stage, seconds):
+        """ Record a duration of stage in seconds.
+        """
+
+    @abstractmethod
+    def count_batch(self, batch_size):
+        """ Count a produced batch of batch_size samples.
+        """
+
+
+class StageRecorder(StageTimer):
+    """ Collects the durations of the timed stages and the number of produced samples until they are drained.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.samples = 0
+
+    def record(self, stage, seconds):
+        self.records.append((stage, seconds))
+
+    def count_batch(self, batch_size):
+        self.samples += batch_size
+
+    def drain(self):
+        """ Returns the records and the number of samples since the last drain and resets them.
+        """
+        records, samples = self.records, self.samples
+        self.records, self.samples = [], 0
+        return records, samples
+
+
+class PipelineStats(StageTimer):
+    """ Rolling statistics of the stages of the data pipeline.
+
+    Args
+        sink: Called with the report and the number of batches every report_every batches, None to only collect.
+        window: Number of most recent durations per stage the percentiles are computed over.
+        report_every: Number of batches between two reports.
+        percentiles: Percentiles of the stage durations in the report.
+    """
+
+    def __init__(self, sink=None, window=1000, report_every=100, percentiles=(50, 90, 99)):
+        self.sink = sink
+        self.window = window
+        self.report_every = report_every
+        self.percentiles = percentiles
+        self.durations = {}
+        self.totals = {}
+        self.batches = 0
+        self.samples = 0
+        self.start = None
+
+    def record(self, stage, seconds):
+        # the throughput is measured from the first record, not from the start of the workers
+        if self.start is None:
+            self.start = time.monotonic() - seconds
+        if stage not in self.durations:
+            self.durations[stage] = deque(maxlen=self.window)
+            self.totals[stage] = 0.0
+        self.durations[stage].append(seconds)
+        self.totals[stage] += seconds
+
+    def count_batch(self, batch_size):
+        """ Count a produced batch, reports to the sink every report_every batches.
+        """
+        self.batches += 1
+        self.samples += batch_size
+        if self.sink is not None and self.batches % self.report_every == 0:
+            self.sink(self.report(), self.batches)
+
+    def merge(self, records, samples):
+        """ Add the drained records of a StageRecorder, samples were produced as one batch.
+        """
+        for stage, seconds in records:
+            self.record(stage, seconds)
+        self.count_batch(samples)
+
+    def report(self):
+        """ Statistics of every stage since the start.
+
+        Returns
+            Dictionary with the samples/s of the whole pipeline and per stage the percentiles of its durations in
+            ms over the window ('p50', ...), its mean time per sample in ms ('ms_per_sample') and the samples/s a
+            single process would be limited to by the stage alone ('samples_per_second').
+        """
+        elapsed = time.monotonic() - self.start if self.start is not None else 0.0
+        report = {'samples': self.samples, 'samples_per_second': self.samples / elapsed if elapsed > 0 else 0.0, 'stages': {}}
+        for stage, durations in self.durations.items():
+            values = np.array(durations) * 1000.0
+            stats = {'p{}'.format(percentile): float(np.percentile(values, percentile)) for percentile in self.percentiles}
+            per_sample = self.totals[stage] / max(self.samples, 1)
+            stats['ms_per_sample'] = per_sample * 1000.0
+            stats['samples_per_second'] = 1.0 / per_sample if per_sample > 0 else float('inf')
+            report['stages'][stage] = stats
+        return report
+
+
+class LogSink:
+    """ Prints the reports, the stage limiting the samples/s first.
+    """
+
+    def __call__(self, report, step):
+        print('Data pipeline after {} batches: {:.1f} samples/s'.format(step, report['samples_per_second']))
+        for stage, stats in sorted(report['stages'].items(), key=lambda item: -item[1]['ms_per_sample']):
+            percentiles = ', '.join('{} {:.1f} ms'.format(key, value) for key, value in stats.items() if key.startswith('p'))
+            print('    {:<12} {:8.2f} ms/sample  {}'.format(stage, stats['ms_per_sample'], percentiles))
+
+
+class TensorBoardSink:
+    """ Writes the reports as scalars to a TensorBoard log directory.
+
+    Args
+        log_dir: Directory of the summaries, created on the first report.
+    """
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.writer = None
+
+    def __call__(self, report, step):
+        if self.writer is None:
+            self.writer = tf.summary.create_file_writer(self.log_dir)
+        with self.writer.as_default():
+            tf.summary.scalar('data_pipeline/samples_per_second', report['samples_per_second'], step=step)
+            for stage, stats in report['stages'].items():
+                for key, value in stats.items():
+                    tf.summary.scalar('data_pipeline/{}/{}'.format(stage, key), value, step=step)
+        self.writer.flush()
+
+
+class StatsSink:
+    """ Keeps the latest report, to inspect the pipeline from the training process.
+    """
+
+    def __init__(self):
+        self.report = None
+        self.step = 0
+
+    def __call__(self, report, step):
+        self.report = report
+        self.step = step
@@ -75,6 +75,24 @@ def transform_pts_Rt(pts, R, t):
     return pts_t.T
 
 
+def transform_pts_Rt_batch(pts, R, t):
+    """
+    Applies N rigid transformations to 3D points.
+
+    :param pts: nx3 ndarray with 3D points shared by all transformations or Nxnx3 ndarray with points per transformation.
+    :param R: Nx3x3 ndarray with rotation matrices.
+    :param t: Nx3 ndarray with translation vectors.
+    :return: Nxnx3 ndarray with transformed 3D points.
+    """
+    assert(pts.shape[-1] == 3)
+    return np.swapaxes(_transform_pts_Rt_batch_T(pts, R, t), 1, 2)
+
+
+def _transform_pts_Rt_batch_T(pts, R, t):
+    # Nx3xn layout, the products and the reductions over the coordinates run on contiguous rows of points
+    return np.matmul(R, np.swapaxes(pts, -1, -2)) + t[:, :, np.newaxis]
+
+
 def project2img(model, img_size, K, R, t):
 
     model = transform_pts_Rt(model, R, t)
@@ -273,3 +291,90 @@ def te(t_est, t_gt):
     assert(t_est.size == t_gt.size == 3)
     error = np.linalg.norm(t_gt - t_est)
     return error
+
+
+def reproj_batch(K, R_est, t_est, R_gt, t_gt, pts):
+    """
+    Reprojection errors of N pose pairs at once, see reproj.
+
+    :param K: 3x3 intrinsic matrix or Nx3x3 ndarray with an intrinsic matrix per pose pair.
+    :param R_est, t_est: Estimated poses (Nx3x3 rot. matrices and Nx3 trans. vectors).
+    :param R_gt, t_gt: GT poses (Nx3x3 rot. matrices and Nx3 trans. vectors).
+    :param pts: nx3 ndarray with the 3D model points or Nxnx3 ndarray with model points per pose pair.
+    :return: N ndarray with the errors of pose_est w.r.t. pose_gt.
+    """
+    pixels_est = np.matmul(K, _transform_pts_Rt_batch_T(pts, R_est, t_est))
+    pixels_gt = np.matmul(K, _transform_pts_Rt_batch_T(pts, R_gt, t_gt))
+
+    diff = pixels_est[:, :2] / pixels_est[:, 2:] - pixels_gt[:, :2] / pixels_gt[:, 2:]
+    return np.sqrt(np.sum(diff * diff, axis=1)).mean(axis=1)
+
+
+def add_batch(R_est, t_est, R_gt, t_gt, pts):
+    """
+    Average Distance of Model Points of N pose pairs at once, see add.
+
+    :param R_est, t_est: Estimated poses (Nx3x3 rot. matrices and Nx3 trans. vectors).
+    :param R_gt, t_gt: GT poses (Nx3x3 rot. matrices and Nx3 trans. vectors).
+    :param pts: nx3 ndarray with the 3D model points or Nxnx3 ndarray with model points per pose pair.
+    :return: N ndarray with the errors of pose_est w.r.t. pose_gt.
+    """
+    # R_est x + t_est - (R_gt x + t_gt) for every model point x
+    diff = _transform_pts_Rt_batch_T(pts, R_est - R_gt, t_est - t_gt)
+    return np.sqrt(np.sum(diff * diff, axis=1)).mean(axis=1)
+
+
+def adi_batch(R_est, t_est, R_gt, t_gt, pts, tree=None):
+    """
+    Average Distance of Model Points for objects with indistinguishable views of N pose pairs at once, see adi.
+
+    If every R_est is orthonormal, a single KD-tree over the model points is queried with the GT points mapped into
+    the model coordinates of the estimated pose, R_est^T (R_gt x + t_gt - t_est). The distances are invariant to the
+    orthonormal R_est, so the errors equal adi. Otherwise, e.g. for averaged pose hypotheses, a KD-tree over the
+    transformed estimated points is built per pose pair as in adi.
+
+    :param R_est, t_est: Estimated poses (Nx3x3 rot. matrices and Nx3 trans. vectors).
+    :param R_gt, t_gt: GT poses (Nx3x3 rot. matrices and Nx3 trans. vectors).
+    :param pts: nx3 ndarray with the 3D model points shared by all pose pairs.
+    :param tree: scipy.spatial.cKDTree over pts, built if None, only used if every R_est is orthonormal.
+    :return: N ndarray with the errors of pose_est w.r.t. pose_gt.
+    """
+    R_est_T = np.swapaxes(R_est, -1, -2)
+    if not np.allclose(np.matmul(R_est_T, R_est), np.eye(3), atol=1e-5):
+        pts_est = transform_pts_Rt_batch(pts, R_est, t_est)
+        pts_gt = transform_pts_Rt_batch(pts, R_gt, t_gt)
+        return np.array([spatial.cKDTree(est).query(gt, k=1)[0].mean() for est, gt in zip(pts_est, pts_gt)])
+
+    if tree is None:
+        tree = spatial.cKDTree(pts)
+
+    R = np.matmul(R_est_T, R_gt)
+    t = np.matmul(R_est_T, (t_gt - t_est)[:, :, np.newaxis])[:, :, 0]
+    pts_gt = transform_pts_Rt_batch(pts, R, t)
+
+    nn_dists, _ = tree.query(pts_gt.reshape((-1, 3)), k=1)
+    return nn_dists.reshape(pts_gt.shape[:2]).mean(axis=1)
+
+
+def re_batch(R_est, R_gt):
+    """
+    Rotational Errors of N pose pairs at once, see re.
+
+    :param R_est: Rotational elements of the estimated poses (Nx3x3 ndarray).
+    :param R_gt: Rotational elements of the ground truth poses (Nx3x3 ndarray).
+    :return: N ndarray with the errors of R_est w.r.t. R_gt in degrees.
+    """
+    error_cos = 0.5 * (np.einsum('nij,nji->n', R_est, np.linalg.inv(R_gt)) - 1.0)
+    error_cos = np.clip(error_cos, -1.0, 1.0) # Avoid invalid values due to numerical errors
+    return np.degrees(np.arccos(error_cos))
+
+
+def te_batch(t_est, t_gt):
+    """
+    Translational Errors of N pose pairs at once, see te.
+
+    :param t_est: Translation elements of the estimated poses (Nx3 ndarray).
+    :param t_gt: Translation elements of the ground truth poses (Nx3 ndarray).
+    :return: N ndarray with the errors of t_est w.r.t. t_gt.
+    """
+    return np.linalg.norm(t_gt - t_est, axis=1)
@@ -0,0 +1,163 @@
+"""
+On-disk cache of the unfiltered network outputs of the inference model, for re-running FilterDetections and the
+metrics with other thresholds without running the network again.
+
+The cache of a checkpoint is a directory named by checkpoint_key, with one .npz per image named by its scene and image
+id. Only the locations with a class score above min_score are stored, so every filter with a score_threshold of at
+least min_score gives the same detections from the cache as the full network outputs:
+    locations: (L,) location indices of the stored rows.
+    classification: (L, num_classes) classification scores.
+    boxes: (L, num_classes, 4) boxes in (x1, y1, x2, y2) format.
+    poses: (L, num_classes, 12) poses.
+    confidence: (L, num_classes) summed consistency, lower is better.
+    time: inference time of the image in seconds.
+"""
+
+import hashlib
+import os
+import time
+
+import numpy as np
+
+OUTPUTS = ('classification', 'boxes', 'poses', 'confidence')
+
+
+def checkpoint_key(path, *extras):
+    """ Key of the checkpoint file or directory at path and of extras, e.g. the diameters a model is converted with.
+
+    The key hashes the absolute path and the names, sizes and modification times of the checkpoint files, not their
+    content, so it is cheap for large checkpoints and changes whenever a checkpoint is overwritten.
+    """
+    digest = hashlib.sha1(os.path.abspath(path).encode('utf-8'))
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    else:
+        files = [path]
+    for name in files:
+        stat = os.stat(name)
+        digest.update('{}:{}:{}'.format(os.path.relpath(name, path), stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    for extra in extras:
+        digest.update(np.ascontiguousarray(extra).tobytes() if isinstance(extra, np.ndarray) else repr(extra).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def raw_model(model):
+    """ Model with the inputs of model and the [boxes, classification, poses, confidence] inputs of its
+    filtered_detections layer as outputs, batched with one row per location.
+    """
+    import tensorflow.keras as keras
+
+    inputs = model.get_layer('filtered_detections').input
+    return keras.models.Model(inputs=model.inputs, outputs=inputs[1:], name='{}_raw'.format(model.name))
+
+
+class PredictionCache:
+    """ Serves the detections of an inference model from cached network outputs, see the module docstring.
+
+    Args
+        cache_dir: Root directory of the caches.
+        key: Key of the checkpoint, see checkpoint_key.
+        num_classes: Number of classes of the model.
+        min_score: Score below which locations are not cached, the lowest score_threshold the cache serves.
+        score_threshold, iou_threshold, pose_hyps, max_detections, max_candidates: Parameters of FilterDetections.
+    """
+
+    def __init__(self, cache_dir, key, num_classes, min_score=0.05, score_threshold=0.5, iou_threshold=0.5, pose_hyps=10,
+                 max_detections=100, max_candidates=1000):
+        if score_threshold < min_score:
+            raise ValueError('score_threshold {} is below the min_score {} of the cache.'.format(score_threshold, min_score))
+
+        self.directory = os.path.join(cache_dir, '{}_{}'.format(key, min_score))
+        os.makedirs(self.directory, exist_ok=True)
+        self.num_classes = num_classes
+        self.min_score = min_score
+        self.filter_kwargs = {'num_classes': num_classes, 'score_threshold': score_threshold, 'iou_threshold': iou_threshold,
+                              'pose_hyps': pose_hyps, 'max_detections': max_detections, 'max_candidates': max_candidates}
+        self._raw_model = None
+        self._filter = None
+
+    def path(self, scene_id, image_id):
+        return os.path.join(self.directory, '{}_{}.npz'.format(int(scene_id), int(image_id)))
+
+    def get(self, scene_id, image_id):
+        """ The cached outputs of an image as a dictionary, None if the image is not cached.
+        """
+        path = self.path(scene_id, image_id)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as npz:
+            return {name: npz[name] for name in npz.files}
+
+    def put(self, scene_id, image_id, classification, boxes, poses, confidence, inference_time):
+        """ Cache the network outputs of an image, one row per location, and return the cached entry.
+        """
+        locations = np.flatnonzero(np.max(classification, axis=1) > self.min_score).astype(np.int32)
+        entry = {'locations': locations, 'time': np.float64(inference_time)}
+        for name, value in zip(OUTPUTS, (classification, boxes, poses, confidence)):
+            entry[name] = np.ascontiguousarray(value[locations], dtype=np.float32)
+
+        # written atomically, shards evaluating concurrently never read a partial file
+        path = self.path(scene_id, image_id)
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary, 'wb') as npz:
+            np.savez(npz, **entry)
+        os.replace(temporary, path)
+        return entry
+
+    def filter(self, entry):
+        """ Run FilterDetections on a cached entry.
+
+        Returns
+            scores, labels, poses, indices and boxes of the detections as the inference model returns them for a
+            single image, the indices refer to the locations of the full network outputs.
+        """
+        if self._filter is None:
+            import tensorflow as tf
+            from ..layers.filter_detections import filter_detections
+            self._filter = tf.function(lambda boxes, classification, poses, confidence: filter_detections(
+                None, boxes, classification, poses, confidence, **self.filter_kwargs))
+
+        # zero rows are below every threshold, padding to a power of two bounds the number of traced shapes
+        num_rows = entry['locations'].shape[0]
+        size = max(64, 1 << max(num_rows - 1, 0).bit_length())
+        padded = [np.pad(entry[name], [(0, size - num_rows)] + [(0, 0)] * (entry[name].ndim - 1)) for name in OUTPUTS]
+
+        classification, boxes, poses, confidence = padded
+        scores, labels, poses, indices, boxes = [output.numpy() for output in self._filter(boxes, classification, poses, confidence)]
+        indices = np.where(indices >= 0, np.append(entry['locations'], -1)[np.minimum(indices, num_rows)], -1).astype(np.int32)
+        return scores, labels, poses, indices, boxes
+
+    def predict_on_batch(self, model, images, intrinsics, keys):
+        """ Detections of a batch of images, the network only runs on the images that are not cached yet.
+
+        Args
+            model: Inference model with a filtered_detections layer.
+            images: Batch of preprocessed images.
+            intrinsics: Batch of (fx, fy, cx, cy).
+            keys: (scene_id, image_id) of every image.
+
+        Returns
+            outputs: [scores, labels, poses, indices, boxes] batched like the outputs of the inference model.
+            times: Inference time of every image in seconds, the cached network time plus the time of the filter.
+        """
+        entries = [self.get(scene_id, image_id) for scene_id, image_id in keys]
+
+        missing = [index for index, entry in enumerate(entries) if entry is None]
+        if missing:
+            if self._raw_model is None:
+                self._raw_model = raw_model(model)
+            start_t = time.time()
+            boxes, classification, poses, confidence = self._raw_model.predict_on_batch([images[missing], intrinsics[missing]])
+            inference_time = (time.time() - start_t) / len(missing)
+            for bdx, index in enumerate(missing):
+                entries[index] = self.put(keys[index][0], keys[index][1], classification[bdx], boxes[bdx], poses[bdx],
+                                          confidence[bdx], inference_time)
+
+        outputs = []
+        times = []
+        for entry in entries:
+            start_t = time.time()
+            outputs.append(self.filter(entry))
+            times.append(float(entry['time']) + time.time() - start_t)
+
+        return [np.stack(output) for output in zip(*outputs)], times
@@ -0,0 +1,238 @@
+"""
+Batched inference service around the inference model.
+
+Requests carrying an image and its intrinsics are collected by a MicroBatcher, which runs the model once for
+all requests that arrive within a latency budget. InferenceServer exposes the batcher over a
+multiprocessing.connection listener with one thread per client connection (e.g. one per camera),
+InferenceClient is the matching client and run_load_test measures throughput and latency over loopback.
+
+multiprocessing.connection unpickles the requests, so the authentication key is all that keeps a client from
+running code on the server. There is no default key; share a random one only with trusted clients.
+"""
+
+from concurrent.futures import Future
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+import queue
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from .image import preprocess_image
+
+
+class MicroBatcher:
+    """ Collects requests into batches and runs the model once per batch.
+
+    Args
+        model: The inference model, outputs [scores, labels, poses, indices, boxes].
+        max_batch_size: Maximum number of requests run at once.
+        max_latency_ms: Time the first request of a batch waits for further requests.
+        jit_compile: Compile the model with XLA, once per padded batch size.
+    """
+
+    def __init__(self, model, max_batch_size=8, max_latency_ms=10.0, jit_compile=False):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.use_intrinsics = len(model.inputs) > 1
+        self.requests = queue.Queue()
+        self._predict = tf.function(lambda inputs: model(inputs, training=False), jit_compile=jit_compile)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._running = True
+        self._thread.start()
+
+    def submit(self, image, intrinsics):
+        """ Queue an image and its intrinsics (fx, fy, cx, cy), returns a Future of the detections.
+        """
+        future = Future()
+        self.requests.put((image, np.asarray(intrinsics, dtype=np.float32), future))
+        return future
+
+    def close(self):
+        self._running = False
+        self.requests.put(None)
+        self._thread.join()
+
+    def _collect(self):
+        """ Wait for a request, then for more until the batch is full or the latency budget is used up.
+        """
+        first = self.requests.get()
+        if first is None:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                self._running = False
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while self._running:
+            batch = self._collect()
+            if not batch:
+                continue
+            try:
+                results = self._run_batch([image for image, _, _ in batch], [intrinsics for _, intrinsics, _ in batch])
+                for (_, _, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+
+    def _run_batch(self, images, intrinsics):
+        batch_size = len(images)
+
+        # pad to a power of two to bound the number of traced batch shapes
+        padded_size = min(1 << (batch_size - 1).bit_length(), self.max_batch_size)
+        image_batch = np.zeros((padded_size,) + images[0].shape, dtype=np.float32)
+        intrinsics_batch = np.zeros((padded_size, 4), dtype=np.float32)
+        for index, image in enumerate(images):
+            image_batch[index] = preprocess_image(image)
+            intrinsics_batch[index] = intrinsics[index]
+
+        inputs = [image_batch, intrinsics_batch] if self.use_intrinsics else image_batch
+        scores, labels, poses, indices, boxes = [output.numpy() for output in self._predict(inputs)]
+
+        results = []
+        for index in range(batch_size):
+            valid = labels[index] != -1
+            results.append({'scores': scores[index][valid],
+                            'labels': labels[index][valid],
+                            'poses': poses[index][valid],
+                            'boxes': boxes[index][valid],
+                            'batch_size': batch_size})
+        return results
+
+
+class InferenceServer:
+    """ Serves a MicroBatcher to clients connecting to address.
+
+    Args
+        batcher: The MicroBatcher running the model.
+        authkey: Authentication key clients have to present, a secret shared with the trusted clients only.
+        address: (host, port) to listen on.
+    """
+
+    def __init__(self, batcher, authkey, address=('localhost', 6000)):
+        if not authkey:
+            raise ValueError('The inference server requires an authentication key.')
+        self.batcher = batcher
+        self.listener = Listener(address, authkey=authkey, backlog=64)
+        self.address = self.listener.address
+
+    def serve_forever(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except (AuthenticationError, EOFError, ConnectionError):
+                # a client with a wrong key or a dropped handshake must not stop the server
+                continue
+            threading.Thread(target=self._handle, args=(connection,), daemon=True).start()
+
+    def _handle(self, connection):
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except EOFError:
+                    break
+                try:
+                    result = self.batcher.submit(request['image'], request['intrinsics']).result()
+                except Exception as e:
+                    result = {'error': repr(e)}
+                connection.send(result)
+
+    def close(self):
+        self.listener.close()
+
+
+class InferenceClient:
+    """ Client of an InferenceServer.
+
+    Args
+        authkey: Authentication key of the server.
+        address: (host, port) of the server.
+    """
+
+    def __init__(self, authkey, address=('localhost', 6000)):
+        self.connection = Client(address, authkey=authkey)
+
+    def predict(self, image, intrinsics):
+        """ Detect objects in a BGR image.
+
+        Args
+            image: (H, W, 3) uint8 BGR image.
+            intrinsics: Camera intrinsics fx, fy, cx, cy.
+
+        Returns
+            Dictionary with the scores, labels, poses and boxes of the detections and the batch_size it was run with.
+        """
+        self.connection.send({'image': image, 'intrinsics': intrinsics})
+        result = self.connection.recv()
+        if 'error' in result:
+            raise RuntimeError('Inference failed on the server: ' + result['error'])
+        return result
+
+    def close(self):
+        self.connection.close()
+
+
+def run_load_test(authkey, address=('localhost', 6000), cameras=6, requests_per_camera=100, fps=None,
+                  image_shape=(480, 640, 3), intrinsics=(572.4114, 573.57043, 325.2611, 242.04899)):
+    """ Send requests from several simulated cameras and measure latency and throughput.
+
+    Args
+        authkey: Authentication key of the server.
+        address: (host, port) of the server.
+        cameras: Number of concurrent clients.
+        requests_per_camera: Number of requests every camera sends.
+        fps: Frame rate of every camera, None sends the next request as soon as the previous one returned.
+        image_shape: Shape of the random images that are sent.
+        intrinsics: Camera intrinsics sent with every image.
+
+    Returns
+        Dictionary with the throughput in images/s, latency percentiles in ms and the mean batch size.
+    """
+    latencies = [[] for _ in range(cameras)]
+    batch_sizes = [[] for _ in range(cameras)]
+
+    def camera(index):
+        client = InferenceClient(authkey, address)
+        image = np.random.randint(0, 255, image_shape, dtype=np.uint8)
+        next_frame = time.monotonic()
+        for _ in range(requests_per_camera):
+            if fps is not None:
+                time.sleep(max(0.0, next_frame - time.monotonic()))
+                next_frame += 1.0 / fps
+            start = time.monotonic()
+            result = client.predict(image, intrinsics)
+            latencies[index].append(time.monotonic() - start)
+            batch_sizes[index].append(result['batch_size'])
+        client.close()
+
+    threads = [threading.Thread(target=camera, args=(index,)) for index in range(cameras)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.monotonic() - start
+
+    latencies = np.concatenate(latencies) * 1000.0
+    return {'throughput': len(latencies) / duration,
+            'latency_p50': float(np.percentile(latencies, 50)),
+            'latency_p90': float(np.percentile(latencies, 90)),
+            'latency_p99': float(np.percentile(latencies, 99)),
+            'mean_batch_size': float(np.mean(np.concatenate(batch_sizes)))}
@@ -31,6 +31,7 @@ from PIL import Image as Pilimage
 
 sys.path.append("/stefan/PyraPoseAF")
 from PyraPose import models
+from PyraPose.utils.object_catalog import ObjectCatalog
 
 from object_detector_msgs.srv import get_poses, get_posesResponse
 from object_detector_msgs.msg import PoseWithConfidence
@@ -140,30 +141,10 @@ class PoseEstimationClass:
         self.image_sub = rospy.Subscriber(topic, Image, self.callback)
         self.depth_sub = rospy.Subscriber('/hsrb/head_rgbd_sensor/depth_registered/image_raw', Image, self.depth_callback)
 
-        self.threeD_boxes = np.ndarray((1, 8, 3), dtype=np.float32)
-        self.sphere_diameters = np.ndarray((1), dtype=np.float32)
-        self.num_classes = 0
-        mesh_info = os.path.join(mesh_path, 'models_info.json')
-        for key, value in json.load(open(mesh_info)).items():
-            fac = 0.001
-            x_minus = value['min_x'] * fac
-            y_minus = value['min_y'] * fac
-            z_minus = value['min_z'] * fac
-            x_plus = value['size_x'] * fac + x_minus
-            y_plus = value['size_y'] * fac + y_minus
-            z_plus = value['size_z'] * fac + z_minus
-            norm_pts = np.linalg.norm(np.array([value['size_x'], value['size_y'], value['size_z']]))
-            three_box_solo = np.array([[x_plus, y_plus, z_plus],
-                                   [x_plus, y_plus, z_minus],
-                                   [x_plus, y_minus, z_minus],
-                                   [x_plus, y_minus, z_plus],
-                                   [x_minus, y_plus, z_plus],
-                                   [x_minus, y_plus, z_minus],
-                                   [x_minus, y_minus, z_minus],
-                                   [x_minus, y_minus, z_plus]])
-            self.threeD_boxes[int(key)-1, :, :] = three_box_solo
-            self.sphere_diameters[int(key)-1] = norm_pts
-            self.num_classes += 1
+        catalog = ObjectCatalog.load_or_build(mesh_path)
+        self.threeD_boxes = catalog.corners * 0.001
+        self.sphere_diameters = catalog.diameters
+        self.num_classes = catalog.num_classes
 
         self._model = model = load_model(model, self.sphere_diameters, self.num_classes)
 
@@ -252,30 +233,10 @@ class PoseEstimationServer:
         self.viz_pub = rospy.Publisher("/pyrapose/visualize", Image, queue_size=10)
 
 
-        self.threeD_boxes = np.ndarray((1, 8, 3), dtype=np.float32)
-        self.sphere_diameters = np.ndarray((1), dtype=np.float32)
-        self.num_classes = 0
-        mesh_info = os.path.join(mesh_path, 'models_info.json')
-        for key, value in json.load(open(mesh_info)).items():
-            fac = 0.001
-            x_minus = value['min_x'] * fac
-            y_minus = value['min_y'] * fac
-            z_minus = value['min_z'] * fac
-            x_plus = value['size_x'] * fac + x_minus
-            y_plus = value['size_y'] * fac + y_minus
-            z_plus = value['size_z'] * fac + z_minus
-            norm_pts = np.linalg.norm(np.array([value['size_x'], value['size_y'], value['size_z']]))
-            three_box_solo = np.array([[x_plus, y_plus, z_plus],
-                                   [x_plus, y_plus, z_minus],
-                                   [x_plus, y_minus, z_minus],
-                                   [x_plus, y_minus, z_plus],
-                                   [x_minus, y_plus, z_plus],
-                                   [x_minus, y_plus, z_minus],
-                                   [x_minus, y_minus, z_minus],
-                                   [x_minus, y_minus, z_plus]])
-            self.threeD_boxes[int(key)-1, :, :] = three_box_solo
-            self.sphere_diameters[int(key)-1] = norm_pts
-            self.num_classes += 1
+        catalog = ObjectCatalog.load_or_build(mesh_path)
+        self.threeD_boxes = catalog.corners * 0.001
+        self.sphere_diameters = catalog.diameters
+        self.num_classes = catalog.num_classes
 
         self._model = model = load_model(model, self.sphere_diameters, self.num_classes)
     
@@ -0,0 +1,125 @@
+import collections
+
+import numpy as np
+import pytest
+import tensorflow as tf
+import tensorflow.keras as keras
+
+# the logical devices have to be configured before the runtime is initialized
+_cpu = tf.config.list_physical_devices('CPU')[0]
+try:
+    tf.config.set_logical_device_configuration(_cpu, [tf.config.LogicalDeviceConfiguration()] * 2)
+except RuntimeError:
+    pass
+
+from cope import losses
+from cope.models import model as cope_model
+from cope.models import train_step
+from cope.utils import anchors
+
+NUM_CLASSES = 3
+# the locations of the model are fixed to the image size of the datasets
+IMAGE_SHAPE = (480, 640)
+
+
+def _backbone_model():
+    inputs = (keras.layers.Input(shape=IMAGE_SHAPE + (3,)), keras.layers.Input(shape=(4,)))
+    c3 = keras.layers.Conv2D(8, 3, strides=8, padding='same')(inputs[0])
+    c4 = keras.layers.Conv2D(8, 3, strides=2, padding='same')(c3)
+    c5 = keras.layers.Conv2D(8, 3, strides=2, padding='same')(c4)
+    rng = np.random.RandomState(0)
+    correspondences = rng.uniform(-50.0, 50.0, (NUM_CLASSES, 8, 3)).astype(np.float32)
+    diameters = np.full(NUM_CLASSES, 150.0, dtype=np.float32)
+    return cope_model.cope(inputs, [c3, c4, c5], NUM_CLASSES, obj_correspondences=correspondences, obj_diameters=diameters)
+
+
+def _annotations(rng, num_objects=2):
+    mask = np.zeros(IMAGE_SHAPE, dtype=np.uint8)
+    objects = collections.defaultdict(list)
+    for index in range(num_objects):
+        x1, y1 = rng.randint(0, IMAGE_SHAPE[1] - 100), rng.randint(0, IMAGE_SHAPE[0] - 100)
+        mask[y1:y1 + 80, x1:x1 + 80] = index + 1
+        quaternion = rng.randn(4)
+        objects['poses'].append(np.concatenate([rng.uniform(-50.0, 50.0, 2), [rng.uniform(300.0, 1000.0)], quaternion / np.linalg.norm(quaternion)]))
+        objects['bboxes'].append([x1, y1, x1 + 80, y1 + 80])
+        objects['segmentations'].append(rng.uniform(-50.0, 50.0, (8, 3)))
+        objects['labels'].append(index % NUM_CLASSES)
+        objects['mask_ids'].append(index + 1)
+        objects['diameters'].append(150.0)
+        objects['visibility'].append(1.0)
+        objects['cam_params'].append([572.4, 573.5, 325.2, 242.0])
+        objects['sym_dis'].append(np.zeros((8, 16)))
+        objects['sym_con'].append(np.zeros((2, 3)))
+    annotations = {key: np.array(value, dtype=np.float64) for key, value in objects.items()}
+    annotations['mask'] = [mask]
+    return annotations
+
+
+class RecordingTimer(train_step.StepTimer):
+    """ StepTimer that records the replica calling every timed stage, one list of stages per timer.
+    """
+    calls = []
+
+    def __call__(self, name, function, *args):
+        if self.enabled and not self.in_stage:
+            replica_id = tf.get_static_value(tf.distribute.get_replica_context().replica_id_in_sync_group)
+            RecordingTimer.calls.append((id(self), int(replica_id), name))
+        return super(RecordingTimer, self).__call__(name, function, *args)
+
+
+@pytest.mark.parametrize('accumulation_steps', [1, 2])
+def test_profile_step_per_replica(monkeypatch, accumulation_steps):
+    devices = tf.config.list_logical_devices('CPU')
+    if len(devices) < 2:
+        pytest.skip('the runtime was initialized before two logical devices could be configured')
+    strategy = tf.distribute.MirroredStrategy([device.name for device in devices[:2]])
+    monkeypatch.setattr(train_step, 'StepTimer', RecordingTimer)
+    RecordingTimer.calls = []
+
+    with strategy.scope():
+        custom_model = train_step.CustomModel(model=_backbone_model())
+        custom_model.compile(
+            loss={
+                'pts': losses.per_cls_l1_sym(num_classes=NUM_CLASSES, weight=1.3),
+                'box': losses.per_cls_l1(num_classes=NUM_CLASSES, weight=1.0),
+                'cls': losses.focal(),
+                'tra': losses.per_cls_l1_trans(num_classes=NUM_CLASSES, weight=1.0),
+                'rot': losses.per_cls_l1_sym(num_classes=NUM_CLASSES, weight=0.3),
+                'con': losses.projection_deviation(num_classes=NUM_CLASSES, weight=0.1),
+                'pro': losses.per_cls_l1_rep(num_classes=NUM_CLASSES, weight=0.15),
+            },
+            optimizer=keras.optimizers.Adam(learning_rate=1e-5),
+            accumulation_steps=accumulation_steps
+        )
+    custom_model.profile_step = True
+
+    rng = np.random.RandomState(0)
+    batch_size = accumulation_steps
+    elements = []
+    for _ in range(2):
+        masks, objects = anchors.pack_annotations([_annotations(rng) for _ in range(batch_size)])
+        images = rng.uniform(0.0, 100.0, (batch_size,) + IMAGE_SHAPE + (3,)).astype(np.float32)
+        intrinsics = np.tile([[572.4, 573.5, 325.2, 242.0]], (batch_size, 1)).astype(np.float32)
+        elements.append((images, intrinsics, anchors.anchor_targets_graph(masks, objects)))
+
+    def dataset_fn(context):
+        dataset = tf.data.Dataset.from_tensors(elements[0])
+        return dataset.concatenate(tf.data.Dataset.from_tensors(elements[1]))
+
+    custom_model.fit(strategy.distribute_datasets_from_function(dataset_fn), steps_per_epoch=1, epochs=1, verbose=0)
+
+    # every trace of the step creates a timer per replica, each times the stages of its replica and the
+    # micro-batch stages once per micro-batch
+    stages = {}
+    for timer, replica_id, name in RecordingTimer.calls:
+        stages.setdefault(timer, []).append((replica_id, name))
+    expected = collections.Counter({name: accumulation_steps for name in ['forward', 'targets'] + list(custom_model.loss) + ['backward']})
+    if accumulation_steps > 1:
+        expected['normalizers'] = 1
+    assert sorted({replica_id for calls in stages.values() for replica_id, _ in calls}) == [0, 1]
+    for calls in stages.values():
+        assert len({replica_id for replica_id, _ in calls}) == 1
+        assert collections.Counter(name for _, name in calls) == expected
+
+    timings = custom_model.step_timings.numpy()
+    assert np.all(np.isfinite(timings)) and np.all(timings[1:] >= 0.0)
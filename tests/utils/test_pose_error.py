@@ -0,0 +1,46 @@
+import numpy as np
+from transforms3d.euler import euler2mat
+
+from cope.utils.pose_error import add, adi, add_batch, adi_batch
+
+
+def _poses(rng, n):
+    R = np.stack([euler2mat(*rng.uniform(-np.pi, np.pi, 3)) for _ in range(n)])
+    t = rng.uniform(-100.0, 100.0, (n, 3)) + [0.0, 0.0, 800.0]
+    return R, t
+
+
+def test_add_batch():
+    rng = np.random.RandomState(0)
+    pts = rng.uniform(-50.0, 50.0, (500, 3))
+    R_est, t_est = _poses(rng, 8)
+    R_gt, t_gt = _poses(rng, 8)
+
+    errors = add_batch(R_est, t_est, R_gt, t_gt, pts)
+    expected = [add(R_est[i], t_est[i], R_gt[i], t_gt[i], pts) for i in range(8)]
+    np.testing.assert_allclose(errors, expected, rtol=1e-9)
+
+
+def test_adi_batch_rotations():
+    rng = np.random.RandomState(1)
+    pts = rng.uniform(-50.0, 50.0, (500, 3))
+    R_est, t_est = _poses(rng, 8)
+    R_gt, t_gt = _poses(rng, 8)
+
+    errors = adi_batch(R_est, t_est, R_gt, t_gt, pts)
+    expected = [adi(R_est[i], t_est[i], R_gt[i], t_gt[i], pts) for i in range(8)]
+    np.testing.assert_allclose(errors, expected, rtol=1e-9)
+
+
+def test_adi_batch_not_orthonormal():
+    # averaged pose hypotheses are not orthonormal, the errors still have to equal adi
+    rng = np.random.RandomState(2)
+    pts = rng.uniform(-50.0, 50.0, (500, 3))
+    R_est, t_est = _poses(rng, 8)
+    R_est = R_est * rng.uniform(0.5, 1.5, (8, 1, 1))
+    R_est[0] = 0.5 * (R_est[0] + euler2mat(0.3, -0.2, 0.1))
+    R_gt, t_gt = _poses(rng, 8)
+
+    errors = adi_batch(R_est, t_est, R_gt, t_gt, pts)
+    expected = [adi(R_est[i], t_est[i], R_gt[i], t_gt[i], pts) for i in range(8)]
+    np.testing.assert_allclose(errors, expected, rtol=1e-9)